@@ -0,0 +1,296 @@
+"""
+Austin Wong
+001355444
+2/22/2021
+"""
+
+# IMPORTS
+# Logging
+import logging
+import logging.handlers
+import queue
+
+# Database
+import sqlite3 as sql
+
+# General
+import sys
+import atexit
+import argparse
+import datetime
+from pathlib import Path
+
+
+# CONSTANTS
+# Size (bytes) at which error_log.txt and user_log.txt are rotated, and number of old files kept
+MAX_LOG_BYTES = 1000000
+LOG_BACKUPS = 5
+
+# Records written to the log database per transaction, and longest time (seconds) a record waits to be written
+LOG_BATCH_SIZE = 100
+LOG_FLUSH_INTERVAL = 1.0
+
+# Logger names for errors and user activity
+ERROR_LOGGER = 'fetal_health.error'
+USER_LOGGER = 'fetal_health.user'
+
+
+# CLASSES
+class AppLog:
+    """
+    Class for easy access to the logging subsystem.
+    Callers only put records on queue; listener writes them to the log files and log database on a background thread.
+    """
+    queue = None
+    listener = None
+    folder = None
+    user = None
+
+
+class BatchListener(logging.handlers.QueueListener):
+    """
+    Queue listener that also flushes its handlers whenever the queue has been idle for LOG_FLUSH_INTERVAL,
+    so batched records are written promptly even when no more records arrive
+    """
+
+    def dequeue(self, block):
+        while True:
+            try:
+                return self.queue.get(block, timeout=LOG_FLUSH_INTERVAL if block else None)
+            except queue.Empty:
+                if not block:
+                    raise
+                for handler in self.handlers:
+                    handler.flush()
+
+
+class RecordQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler that enqueues records unchanged.
+    Messages are plain strings with no arguments or exception info, so the copy and pre-formatting done by
+    QueueHandler.prepare are skipped to keep the cost on the calling thread low.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+class SQLiteLogHandler(logging.Handler):
+    """
+    Stores structured log records in a SQLite database, LOG_BATCH_SIZE records per transaction
+    """
+
+    def __init__(self, db_filepath):
+        """
+        :param db_filepath: Path to the log database (created if missing)
+        """
+        super().__init__()
+        self.db_filepath = db_filepath
+        self.conn = None
+        self.buffer = []
+
+    def emit(self, record):
+        if record.name == USER_LOGGER:
+            source = 'user'
+        elif record.name == ERROR_LOGGER:
+            source = 'error'
+        else:
+            source = 'app'
+        self.buffer.append((datetime.datetime.fromtimestamp(record.created).isoformat(sep=' '),
+                            record.levelname,
+                            source,
+                            getattr(record, 'event', None),
+                            getattr(record, 'user', None),
+                            getattr(record, 'duration_ms', None),
+                            record.getMessage()))
+        if len(self.buffer) >= LOG_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if len(self.buffer) == 0:
+            return
+        try:
+            # Only the listener thread writes while it runs; stop_logging flushes the rest after it has stopped
+            if self.conn is None:
+                self.conn = sql.connect(self.db_filepath, check_same_thread=False)
+                self.conn.execute('CREATE TABLE IF NOT EXISTS log ('
+                                  'id INTEGER PRIMARY KEY AUTOINCREMENT, created TEXT NOT NULL, level TEXT NOT NULL, '
+                                  'category TEXT NOT NULL, event TEXT, user TEXT, duration_ms REAL, message TEXT)')
+                self.conn.execute('CREATE INDEX IF NOT EXISTS log_event_idx ON log (event, created)')
+            with self.conn:
+                self.conn.executemany('INSERT INTO log (created, level, category, event, user, duration_ms, message) '
+                                      'VALUES (?, ?, ?, ?, ?, ?, ?)', self.buffer)
+            self.buffer = []
+        except sql.Error as e:
+            # Logging must never stop the application; report the lost records on the console instead
+            sys.stderr.write('Could not write {} log records: {}\n'.format(len(self.buffer), e))
+            self.buffer = []
+
+    def close(self):
+        self.flush()
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+        super().close()
+
+
+class LogFormatter(logging.Formatter):
+    """
+    Formats log file lines the way the application always has: '<datetime> - <message>'
+    """
+
+    def format(self, record):
+        timestamp = datetime.datetime.fromtimestamp(record.created)
+        if record.name == USER_LOGGER and getattr(record, 'event', None) == 'login':
+            return '{} logged in at {}'.format(record.user, timestamp)
+        return '{} - {}'.format(timestamp, record.getMessage())
+
+
+# FUNCTIONS
+def start_logging(folder=None):
+    """
+    Starts the background log writer. Called automatically by the first log call; stopped automatically at exit.
+    :param folder: Optional folder for error_log.txt, user_log.txt and app_log.db (defaults to the folder of this file)
+    :return: None
+    """
+    if AppLog.listener is not None:
+        return
+    if folder is None:
+        folder = Path(__file__).parent.absolute()
+    AppLog.folder = Path(folder)
+    AppLog.queue = queue.Queue()
+
+    error_handler = logging.handlers.RotatingFileHandler(Path(folder, 'error_log').with_suffix('.txt'),
+                                                         maxBytes=MAX_LOG_BYTES, backupCount=LOG_BACKUPS, delay=True)
+    error_handler.addFilter(lambda record: record.name == ERROR_LOGGER)
+    user_handler = logging.handlers.RotatingFileHandler(Path(folder, 'user_log').with_suffix('.txt'),
+                                                        maxBytes=MAX_LOG_BYTES, backupCount=LOG_BACKUPS, delay=True)
+    user_handler.addFilter(lambda record: record.name == USER_LOGGER and getattr(record, 'event', None) == 'login')
+    for handler in (error_handler, user_handler):
+        handler.setFormatter(LogFormatter())
+    db_handler = SQLiteLogHandler(Path(folder, 'app_log').with_suffix('.db'))
+
+    for name in (ERROR_LOGGER, USER_LOGGER):
+        logger = logging.getLogger(name)
+        logger.setLevel(logging.DEBUG)
+        logger.propagate = False
+        logger.handlers = [RecordQueueHandler(AppLog.queue)]
+
+    AppLog.listener = BatchListener(AppLog.queue, error_handler, user_handler, db_handler, respect_handler_level=True)
+    AppLog.listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """
+    Writes every queued record and stops the background log writer
+    :return: None
+    """
+    listener = AppLog.listener
+    if listener is None:
+        return
+    AppLog.listener = None
+    listener.stop()
+    for handler in listener.handlers:
+        handler.close()
+
+
+def set_log_user(user):
+    """
+    Sets the user recorded with later log records
+    :param user: String (username)
+    :return: None
+    """
+    AppLog.user = user
+
+
+def log_event(event, message='', duration=None, user=None, level=logging.INFO, logger=USER_LOGGER):
+    """
+    Records a structured event without waiting for it to be written
+    :param event: Short event name (e.g. 'login', 'insert', 'predict')
+    :param message: Optional details
+    :param duration: Optional duration of the event in seconds
+    :param user: Username (defaults to the user set with set_log_user)
+    :param level: Logging level
+    :param logger: Logger name (USER_LOGGER or ERROR_LOGGER)
+    :return: None
+    """
+    start_logging()
+    logging.getLogger(logger).log(level, str(message), extra={
+        'event': event,
+        'user': user if user is not None else AppLog.user,
+        'duration_ms': 1000 * duration if duration is not None else None})
+
+
+def log_error(error, event='error', duration=None):
+    """
+    Records an error in error_log.txt and the log database without waiting for it to be written
+    :param error: Exception or message
+    :param event: Short name of the operation that failed
+    :param duration: Optional duration of the operation in seconds
+    :return: None
+    """
+    log_event(event, error, duration, level=logging.ERROR, logger=ERROR_LOGGER)
+
+
+def log_login(user):
+    """
+    Records a successful login in user_log.txt and the log database
+    :param user: String (username)
+    :return: None
+    """
+    set_log_user(user)
+    log_event('login', '{} logged in'.format(user), user=user)
+
+
+def query_log(event=None, user=None, category=None, since=None, limit=100, db_filepath=None):
+    """
+    Reads the most recent structured log records
+    :param event: Optional event name to filter by
+    :param user: Optional username to filter by
+    :param category: Optional category to filter by ('error' or 'user')
+    :param since: Optional earliest datetime (or ISO string) to include
+    :param limit: Largest number of records returned
+    :param db_filepath: Optional path to the log database (defaults to app_log.db next to this file)
+    :return: List of dictionaries (id, created, level, category, event, user, duration_ms, message), newest first
+    """
+    if db_filepath is None:
+        db_filepath = Path(AppLog.folder or Path(__file__).parent.absolute(), 'app_log').with_suffix('.db')
+    if not Path(db_filepath).exists():
+        return []
+
+    conditions, params = [], []
+    for column, value in (('event', event), ('user', user), ('category', category)):
+        if value is not None:
+            conditions.append('{} = ?'.format(column))
+            params.append(value)
+    if since is not None:
+        conditions.append('created >= ?')
+        params.append(since.isoformat(sep=' ') if isinstance(since, datetime.datetime) else str(since))
+    query = 'SELECT * FROM log {} ORDER BY id DESC LIMIT ?'.format(
+        'WHERE ' + ' AND '.join(conditions) if conditions else '')
+
+    conn = sql.connect(db_filepath)
+    conn.row_factory = sql.Row
+    try:
+        rows = [dict(row) for row in conn.execute(query, params + [limit])]
+    finally:
+        conn.close()
+    return rows
+
+
+if __name__ == '__main__':
+
+    # Usage: python applog.py [--event EVENT] [--user USER] [--category error|user] [--since DATE] [--limit N]
+    parser = argparse.ArgumentParser(description='Show recent application log records')
+    parser.add_argument('--event')
+    parser.add_argument('--user')
+    parser.add_argument('--category', choices=['error', 'user'])
+    parser.add_argument('--since', help='Earliest date and time, e.g. 2021-03-01')
+    parser.add_argument('--limit', type=int, default=50)
+    args = parser.parse_args()
+
+    for row in query_log(args.event, args.user, args.category, args.since, args.limit):
+        duration = '' if row['duration_ms'] is None else ' ({:.1f} ms)'.format(row['duration_ms'])
+        print('{created} {level:<7} {event} {user}{duration} {message}'.format(duration=duration, **row))
+    sys.exit(0)
@@ -0,0 +1,444 @@
+"""
+Austin Wong
+001355444
+2/22/2021
+"""
+
+# IMPORTS
+# Custom Packages
+from dbinter import start_conn, open_conn, close_conn, bulk_insert
+from applog import set_log_user
+from synth import fit_generator, generate_fetal_data
+from model import *
+
+# General
+import json
+import shutil
+import tempfile
+import platform
+import statistics
+import subprocess
+import sqlite3
+import sklearn
+import joblib
+
+
+# CONSTANTS
+# Sizes benchmarked by default, as multiples of fetal_health.csv (larger sizes add synthetic rows, see synth.py)
+SCALES = [1, 10]
+
+# Benchmark groups, in the order they are run
+# (inserts run last because they add rows to the benchmarked data)
+GROUPS = ['startup', 'load', 'aggregates', 'model', 'predict', 'train', 'tune', 'insert']
+
+# Modules whose import time is profiled by the startup group, each in a fresh interpreter
+# (main imports everything the application loads before the login screen appears; model.py and the plotting
+# packages are imported later, by the screens that use them)
+STARTUP_MODULES = ['main', 'model', 'server']
+
+# Number of packages listed in each import-time profile
+PROFILE_PACKAGES = 8
+
+# Timed repetitions of each operation (best time is kept)
+REPEAT = 5
+
+# Number of single-row predictions and single-row inserts timed
+SINGLE_ROWS = 200
+
+# Fraction by which an operation may be slower than the baseline before it counts as a regression
+TOLERANCE = 0.25
+
+# Differences smaller than this many seconds are timer noise, never regressions
+MIN_DIFFERENCE = 0.001
+
+
+# FUNCTIONS
+def default_filepath(name):
+    """
+    :param name: File name
+    :return: Path to the file next to this file, or in the repository's data or models folder if it is not here
+    """
+    dirname = Path(__file__).parent.absolute()
+    for folder in (dirname, Path(dirname.parent, 'data'), Path(dirname.parent, 'models')):
+        if Path(folder, name).exists():
+            return Path(folder, name)
+    return Path(dirname, name)
+
+
+def machine_info():
+    """
+    :return: Dictionary describing the machine and library versions, stored with every result
+    """
+    return {'node': platform.node(),
+            'platform': platform.platform(),
+            'processor': platform.processor() or platform.machine(),
+            'cpu_count': os.cpu_count(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'sklearn': sklearn.__version__,
+            'joblib': joblib.__version__,
+            'sqlite': sqlite3.sqlite_version}
+
+
+def best_time(func, repeat=REPEAT, setup=None):
+    """
+    :param func: Function to time (called without arguments)
+    :param repeat: Number of timed calls
+    :param setup: Optional function called before each timed call (not timed)
+    :return: Shortest time in seconds
+    """
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def profile_import(module, repeat=REPEAT):
+    """
+    Times importing a module in a fresh interpreter with python -X importtime, as happens when the application starts
+    :param module: Module name
+    :param repeat: Number of runs (the fastest is kept)
+    :return: Dictionary with seconds (total import time), rows (0) and packages (list of [package, seconds] for the
+             slowest top-level packages), or None if the module can't be imported here
+    """
+    best = None
+    for _ in range(repeat):
+        process = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                                 cwd=Path(__file__).parent.absolute(), stdout=subprocess.DEVNULL,
+                                 stderr=subprocess.PIPE, universal_newlines=True)
+        if process.returncode != 0:
+            return None
+
+        # Lines read 'import time: <self us> | <cumulative us> | <indented module name>'
+        packages = {}
+        for line in process.stderr.splitlines():
+            if not line.startswith('import time:') or 'self [us]' in line:
+                continue
+            self_us, cumulative_us, name = line[len('import time:'):].split('|')
+            package = name.strip().split('.')[0]
+            packages[package] = packages.get(package, 0.0) + int(self_us) / 1e6
+
+        seconds = sum(packages.values())
+        if best is None or seconds < best['seconds']:
+            slowest = sorted(packages.items(), key=lambda item: item[1], reverse=True)[:PROFILE_PACKAGES]
+            best = {'seconds': seconds, 'rows': 0, 'packages': [list(item) for item in slowest]}
+    return best
+
+
+def scale_data(df, scale, seed=0):
+    """
+    :param df: Pandas DataFrame of fetal health data
+    :param scale: Size of the result as a multiple of the size of df
+    :param seed: Random seed, so every run benchmarks the same data
+    :return: DataFrame with the rows of df followed by synthetic rows learned from them (see synth.py)
+    """
+    if scale <= 1:
+        return df
+    generated = generate_fetal_data(fit_generator(df), len(df) * (scale - 1), seed=seed)
+    return pd.concat([df[db_cols]] + list(generated), ignore_index=True)
+
+
+def build_database(template_filepath, folder, df):
+    """
+    Creates a copy of the database holding only the given fetal health data
+    :param template_filepath: SQLite DB file providing the schema and user logins
+    :param folder: Folder for the copy
+    :param df: Pandas DataFrame with db_cols columns
+    :return: Path to the copy
+    """
+    db_filepath = Path(folder, 'benchmark').with_suffix('.db')
+    shutil.copyfile(template_filepath, db_filepath)
+    conn = open_conn(db_filepath)
+    with conn:
+        conn.execute('DELETE FROM fetal_health')
+    bulk_insert(conn, 'fetal_health', db_cols, df[db_cols].to_numpy(dtype=np.float64).tolist())
+    close_conn(conn)
+    return db_filepath
+
+
+def reset_state():
+    """
+    Forgets loaded data, aggregates and cached predictions so every scale starts cold
+    :return: None
+    """
+    Model.last_id = 0
+    Model.row_count = None
+    Model.snapshot = None
+    Model.prediction_cache.clear()
+    Aggregates.counts = None
+    Aggregates.histograms = None
+    Aggregates.moments = None
+
+
+def run_scale(df, scale, template_filepath, model_filepath, groups, n_jobs, mode, repeat=REPEAT):
+    """
+    Benchmarks every hot path selected in groups on one size of the data
+    :param df: Pandas DataFrame of fetal health data
+    :param scale: Size of the benchmarked data as a multiple of the size of df
+    :param template_filepath: SQLite DB file providing the schema (see build_database)
+    :param model_filepath: Model .joblib file
+    :param groups: Benchmark groups to run (see GROUPS)
+    :param n_jobs: Number of processes for training (-1 uses all cores)
+    :param mode: Hyperparameter search mode for train_model
+    :param repeat: Timed repetitions of each operation
+    :return: Dictionary mapping operation names to {'seconds', 'rows'}
+    """
+    data = scale_data(df, scale)
+    rows = len(data)
+    results = {}
+    folder = tempfile.mkdtemp()
+    try:
+        reset_state()
+        conn = start_conn(build_database(template_filepath, folder, data))
+
+        if 'load' in groups or 'aggregates' in groups or 'train' in groups or 'tune' in groups:
+            # The first load writes the snapshot; later loads open it and only read new rows from the database
+            start = time.perf_counter()
+            load_fetal_data(conn)
+            results['build_snapshot'] = {'seconds': time.perf_counter() - start, 'rows': rows}
+            results['load_fetal_data'] = {'seconds': best_time(lambda: load_fetal_data(conn), repeat), 'rows': rows}
+        if 'load' in groups:
+            results['iter_fetal_data'] = {'seconds': best_time(lambda: sum(map(len, iter_fetal_data(conn))), repeat),
+                                          'rows': rows}
+            results['split_data'] = {'seconds': best_time(lambda: split_data(conn), repeat), 'rows': rows}
+        if 'aggregates' in groups:
+            results['compute_aggregates'] = {'seconds': best_time(lambda: accumulate_aggregates(iter_fetal_data(conn)),
+                                                                  repeat), 'rows': rows}
+            start = time.perf_counter()
+            load_aggregates(conn)
+            results['build_summary_tables'] = {'seconds': time.perf_counter() - start, 'rows': rows}
+            results['load_aggregates'] = {'seconds': best_time(lambda: load_aggregates(conn), repeat), 'rows': rows}
+
+            def clear_moments():
+                Aggregates.moments = None
+            results['correlation_matrix'] = {'seconds': best_time(get_correlation_matrix, repeat, clear_moments),
+                                             'rows': rows}
+
+        if 'model' in groups:
+            results['load_model'] = {'seconds': best_time(lambda: load_model(model_filepath), repeat), 'rows': 0}
+        if 'predict' in groups:
+            if Model.model is None:
+                load_model(model_filepath)
+            X = as_feature_array(data[feature_cols])
+            latencies = []
+            for i in range(min(SINGLE_ROWS, rows)):
+                start = time.perf_counter()
+                Model.engine.predict(X[i])
+                latencies.append(time.perf_counter() - start)
+            results['predict_single'] = {'seconds': statistics.median(latencies), 'rows': 1}
+            results['predict_batch'] = {'seconds': best_time(lambda: Model.engine.predict_proba(X), repeat),
+                                        'rows': rows}
+
+            def clear_cache():
+                Model.prediction_cache.clear()
+            results['predict_cached_cold'] = {'seconds': best_time(lambda: predict_cached(data[feature_cols]), repeat,
+                                                                   clear_cache), 'rows': rows}
+            results['predict_cached_warm'] = {'seconds': best_time(lambda: predict_cached(data[feature_cols]),
+                                                                   repeat), 'rows': rows}
+
+        if 'train' in groups:
+            start = time.perf_counter()
+            model, scores = train_model(n_jobs=n_jobs, mode=mode, plot=False)
+            results['train_model'] = {'seconds': time.perf_counter() - start, 'rows': Model.row_count}
+            for phase in get_training_info(model).get('phases', []):
+                results['train_model.' + phase['name']] = {'seconds': phase['seconds'], 'rows': Model.row_count}
+        if 'tune' in groups:
+            X_train, X_test, y_train, y_test = split_data()
+            start = time.perf_counter()
+            tune_hyperparameters(get_n_jobs(n_jobs)).fit(X_train, y_train)
+            results['tune_hyperparameters'] = {'seconds': time.perf_counter() - start, 'rows': len(X_train)}
+
+        if 'insert' in groups:
+            inserts = data[db_cols].iloc[:SINGLE_ROWS].to_numpy(dtype=np.float64).tolist()
+            start = time.perf_counter()
+            for placeholder in inserts:
+                insert_fetal_data(placeholder)
+            results['insert_fetal_data'] = {'seconds': (time.perf_counter() - start) / len(inserts), 'rows': 1}
+            stats = ingest_fetal_data([data], conn)
+            results['ingest_fetal_data'] = {'seconds': stats['seconds'], 'rows': stats['rows']}
+
+        close_conn(conn)
+    finally:
+        reset_state()
+        shutil.rmtree(folder, ignore_errors=True)
+
+    for result in results.values():
+        result['rows_per_second'] = result['rows'] / result['seconds'] if result['seconds'] > 0 else 0.0
+    return results
+
+
+def run_benchmarks(csv_filepath, db_filepath, model_filepath, scales=None, groups=None, train_scales=None,
+                   n_jobs=N_JOBS, mode='grid', repeat=REPEAT, progress=None):
+    """
+    Runs the benchmark suite headless on fetal_health.csv and larger synthetic data sets learned from it
+    :param csv_filepath: CSV file with the same columns as fetal_health.csv
+    :param db_filepath: SQLite DB file providing the schema (never modified; a copy is benchmarked)
+    :param model_filepath: Model .joblib file
+    :param scales: List of data sizes as multiples of the CSV file (see SCALES)
+    :param groups: Benchmark groups to run (see GROUPS)
+    :param train_scales: Scales at which the train and tune groups run (defaults to the smallest scale),
+                         since training time grows much faster than the other operations
+    :param n_jobs: Number of processes for training (-1 uses all cores)
+    :param mode: Hyperparameter search mode for train_model
+    :param repeat: Timed repetitions of each operation
+    :param progress: Optional function called with each operation name and result
+    :return: Dictionary with machine, created, settings and results (operation name with scale -> result)
+    """
+    if scales is None:
+        scales = SCALES
+    if groups is None:
+        groups = GROUPS
+    if train_scales is None:
+        train_scales = [min(scales)]
+
+    set_log_user('benchmark')
+    df = pd.read_csv(csv_filepath)
+    results = {}
+    if 'startup' in groups:
+        for module in STARTUP_MODULES:
+            result = profile_import(module, repeat)
+            if result is None:
+                continue
+            key = 'import {}'.format(module)
+            results[key] = result
+            if progress is not None:
+                progress(key, result)
+
+    for scale in scales:
+        scale_groups = [group for group in groups if group not in ('train', 'tune') or scale in train_scales]
+        for name, result in run_scale(df, scale, db_filepath, model_filepath, scale_groups, n_jobs, mode,
+                                      repeat).items():
+            key = '{} x{}'.format(name, scale)
+            results[key] = result
+            if progress is not None:
+                progress(key, result)
+
+    return {'machine': machine_info(),
+            'created': datetime.datetime.now().isoformat(timespec='seconds'),
+            'settings': {'csv': str(csv_filepath), 'model': str(model_filepath), 'scales': scales, 'groups': groups,
+                         'n_jobs': n_jobs, 'mode': mode, 'repeat': repeat},
+            'results': results}
+
+
+def compare_results(current, baseline, tolerance=TOLERANCE):
+    """
+    Compares benchmark results against a baseline run
+    :param current: Dictionary returned by run_benchmarks
+    :param baseline: Dictionary returned by run_benchmarks (e.g. loaded from the baseline file)
+    :param tolerance: Fraction by which an operation may be slower before it counts as a regression
+    :return: List of dictionaries (name, baseline, current, ratio, regression) for operations in both runs
+    """
+    comparisons = []
+    for name, result in current['results'].items():
+        if name not in baseline['results']:
+            continue
+        before = baseline['results'][name]['seconds']
+        after = result['seconds']
+        comparisons.append({'name': name,
+                            'baseline': before,
+                            'current': after,
+                            'ratio': after / before if before > 0 else float('inf'),
+                            'regression': after > before * (1 + tolerance) and after - before > MIN_DIFFERENCE})
+    return comparisons
+
+
+def print_result(name, result):
+    """
+    Prints one benchmark result, with the slowest packages of an import-time profile below it
+    :param name: Operation name
+    :param result: Result dictionary (see run_scale and profile_import)
+    :return: None
+    """
+    rate = '  ({:.0f} rows/s)'.format(result['rows_per_second']) if result['rows'] > 1 else ''
+    print('{:<32} {:>10}{}'.format(name, format_seconds(result['seconds']), rate))
+    for package, seconds in result.get('packages', []):
+        print('    {:<28} {:>10}'.format(package, format_seconds(seconds)))
+
+
+def format_seconds(seconds):
+    """
+    :param seconds: Duration
+    :return: String with a readable unit
+    """
+    if seconds < 0.001:
+        return '{:.1f} us'.format(1e6 * seconds)
+    if seconds < 1:
+        return '{:.2f} ms'.format(1000 * seconds)
+    return '{:.2f} s'.format(seconds)
+
+
+def main(argv=None):
+    """
+    Command line entry point: runs the suite, writes the results and checks them against the baseline
+    :param argv: Optional list of arguments (defaults to sys.argv)
+    :return: Exit code (1 if any operation regressed)
+    """
+    parser = argparse.ArgumentParser(description='Benchmark data loading, predictions, inserts, dashboard '
+                                                 'aggregates and training')
+    parser.add_argument('--csv', default=default_filepath('fetal_health.csv'))
+    parser.add_argument('--db', default=default_filepath('fetal_health_db.db'),
+                        help='SQLite DB providing the schema (a copy is benchmarked)')
+    parser.add_argument('--model', default=default_filepath('new_model.joblib'))
+    parser.add_argument('--scales', type=int, nargs='+', default=SCALES,
+                        help='Data sizes to benchmark, as multiples of the CSV file')
+    parser.add_argument('--groups', nargs='+', default=GROUPS, choices=GROUPS)
+    parser.add_argument('--skip', nargs='+', default=[], choices=GROUPS, help='Groups not to run')
+    parser.add_argument('--jobs', type=int, default=N_JOBS, help='Number of processes for training')
+    parser.add_argument('--mode', default='grid', choices=['grid', 'incremental', 'oob'])
+    parser.add_argument('--repeat', type=int, default=REPEAT)
+    parser.add_argument('--out', default=default_filepath('benchmark_results.json'))
+    parser.add_argument('--baseline', default=default_filepath('benchmark_baseline.json'))
+    parser.add_argument('--save-baseline', action='store_true', help='Also save the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+    args = parser.parse_args(argv)
+
+    groups = [group for group in args.groups if group not in args.skip]
+    results = run_benchmarks(args.csv, args.db, args.model, args.scales, groups, n_jobs=args.jobs, mode=args.mode,
+                             repeat=args.repeat, progress=print_result)
+
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('Results written to {}'.format(args.out))
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print('Baseline written to {}'.format(args.baseline))
+        return 0
+    if not Path(args.baseline).exists():
+        print('No baseline found; run with --save-baseline to create one')
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline['machine'] != results['machine']:
+        print('Warning: baseline was recorded on a different machine or library versions:')
+        for key, value in baseline['machine'].items():
+            if results['machine'].get(key) != value:
+                print('  {}: {} -> {}'.format(key, value, results['machine'].get(key)))
+
+    comparisons = compare_results(results, baseline, args.tolerance)
+    for comparison in comparisons:
+        print('{:<32} {:>10} -> {:>10}  {:5.2f}x{}'.format(comparison['name'],
+                                                          format_seconds(comparison['baseline']),
+                                                          format_seconds(comparison['current']),
+                                                          comparison['ratio'],
+                                                          '  REGRESSION' if comparison['regression'] else ''))
+    regressions = [comparison['name'] for comparison in comparisons if comparison['regression']]
+    if regressions:
+        print('FAILED: {} of {} operations are more than {:.0%} slower than the baseline: {}'.format(
+            len(regressions), len(comparisons), args.tolerance, ', '.join(regressions)))
+        return 1
+    print('OK: no operation is more than {:.0%} slower than the baseline'.format(args.tolerance))
+    return 0
+
+
+if __name__ == '__main__':
+
+    # Usage: python benchmark.py [--scales 1 10] [--skip train tune] [--baseline FILE] [--save-baseline]
+    sys.exit(main())
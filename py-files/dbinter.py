@@ -9,19 +9,42 @@ Austin Wong
 import sqlite3 as sql
 from sqlite3 import Error
 
+# Logging
+from applog import log_error, set_log_user
+
 # General
 from os import path
 from pathlib import Path
-import datetime
+from contextlib import contextmanager
+import threading
+import shutil
+import sys
+import tempfile
+import time
+
+
+# CONSTANTS
+# Pragmas applied to every read-write connection: write-ahead logging lets readers run alongside a writer,
+# NORMAL sync is safe with WAL, and the page cache (KiB when negative) and memory map speed up repeated reads
+CONN_PRAGMAS = {'journal_mode': 'WAL',
+                'synchronous': 'NORMAL',
+                'cache_size': -20000,
+                'mmap_size': 268435456}
+
+# Seconds a connection waits for a lock held by another connection before raising an error
+BUSY_TIMEOUT = 5.0
 
 
 # CLASSES
 class DBInter:
     """
-    Class for easy access to database connection info
+    Class for easy access to database connection info.
+    conn belongs to the main thread; other threads get their own connection from get_conn, kept in local.
     """
     conn = None
+    db_filepath = None
     current_user = None
+    local = threading.local()
 
 
 # GETTERS AND SETTERS
@@ -36,19 +59,28 @@ def set_conn(conn):
 
 def get_conn():
     """
-    Get current database connection
-    :return: Current SQLite3 Connection object
+    Get current database connection. SQLite connections can't be shared between threads, so calls from other threads
+    get a connection of their own to the same database, opened on first use (see close_thread_conn).
+    :return: Current SQLite3 Connection object for the calling thread, None if no connection was started
     """
-    return DBInter.conn
+    if DBInter.conn is None or threading.current_thread() is threading.main_thread():
+        return DBInter.conn
+
+    conn = getattr(DBInter.local, 'conn', None)
+    if conn is None:
+        conn = open_conn()
+        DBInter.local.conn = conn
+    return conn
 
 
 def set_current_user(user):
     """
-    Set current user connected to database
+    Set current user connected to database (also recorded with later log records)
     :param user: String (username)
     :return: None
     """
     DBInter.current_user = user
+    set_log_user(user)
 
 
 def get_current_user():
@@ -59,31 +91,58 @@ def get_current_user():
     return DBInter.current_user
 
 
+def get_db_filepath():
+    """
+    :return: Path to the SQLite DB file opened by start_conn (defaults to fetal_health_db.db next to this file)
+    """
+    if DBInter.db_filepath is not None:
+        return Path(DBInter.db_filepath)
+    return Path(Path(__file__).parent.absolute(), 'fetal_health_db').with_suffix('.db')
+
+
 # FUNCTIONS
-def start_conn():
+def start_conn(db_filepath=None):
+    """
+    Establishes connection to SQLite database and makes it the current connection. Logs error if unsuccessful.
+    :param db_filepath: Optional path to SQLite DB file (defaults to fetal_health_db.db next to this file)
+    :return: Connection object if successful, None if unsuccessful
+    """
+    conn = open_conn(db_filepath)
+    if conn is not None:
+        set_conn(conn)
+        DBInter.db_filepath = db_filepath
+    return conn
+
+
+def open_conn(db_filepath=None, read_only=False, pragmas=True):
     """
-    Establishes connection to SQLite database. Logs error if unsuccessful.
+    Opens an additional connection to SQLite database, e.g. for use on a worker thread. Logs error if unsuccessful.
+    :param db_filepath: Optional path to SQLite DB file (defaults to the file opened by start_conn)
+    :param read_only: Set True to open the file read-only, so the connection can never write
+    :param pragmas: Set False to keep SQLite's default journal and cache settings (see CONN_PRAGMAS)
     :return: Connection object if successful, None if unsuccessful
     """
 
-    dirname = Path(__file__).parent.absolute()
-    db_filepath = Path(dirname, 'fetal_health_db').with_suffix('.db')
-    error_filepath = Path(dirname, 'error_log').with_suffix('.txt')
+    if db_filepath is None:
+        db_filepath = get_db_filepath()
 
     if path.exists(db_filepath) is False:
-        f = open(error_filepath, 'a')
-        f.write('{} - Cannot find database file\n'.format(datetime.datetime.now()))
-        f.close()
+        log_error('Cannot find database file', 'open_conn')
         return None
 
     try:
-        conn = sql.connect(db_filepath)
-        set_conn(conn)
+        if read_only:
+            conn = sql.connect(Path(db_filepath).absolute().as_uri() + '?mode=ro', uri=True, timeout=BUSY_TIMEOUT)
+        else:
+            conn = sql.connect(db_filepath, timeout=BUSY_TIMEOUT)
+        if pragmas:
+            for name, value in CONN_PRAGMAS.items():
+                # Journal mode is stored in the file, so only a writer can change it
+                if not (read_only and name == 'journal_mode'):
+                    conn.execute('PRAGMA {} = {}'.format(name, value))
 
     except Error as e:
-        f = open(error_filepath, 'a')
-        f.write('{} - {}\n'.format(datetime.datetime.now(), e))
-        f.close()
+        log_error(e, 'open_conn')
         return None
 
     return conn
@@ -95,21 +154,239 @@ def close_conn(conn):
     :param conn: Connection object
     :return: None
     """
-    set_conn(None)
-
-    dirname = Path(__file__).parent.absolute()
-    error_filepath = Path(dirname, 'error_log').with_suffix('.txt')
+    if conn is DBInter.conn:
+        set_conn(None)
+    if conn is getattr(DBInter.local, 'conn', None):
+        DBInter.local.conn = None
 
     try:
         conn.close()
     except Error as e:
-        f = open(error_filepath, 'a')
-        f.write('{} - {}\n'.format(datetime.datetime.now(), e))
-        f.close()
+        log_error(e, 'close_conn')
     except Exception as exc:
-        f = open(error_filepath, 'a')
-        f.write('{} - {}\n'.format(datetime.datetime.now(), exc))
-        f.close()
+        log_error(exc, 'close_conn')
+
+
+def close_thread_conn():
+    """
+    Closes the connection get_conn opened for the calling thread, if any. Worker threads call this before finishing.
+    :return: None
+    """
+    conn = getattr(DBInter.local, 'conn', None)
+    if conn is not None:
+        DBInter.local.conn = None
+        close_conn(conn)
+
+
+@contextmanager
+def snapshot_conn(db_filepath=None):
+    """
+    Opens a read-only connection holding one read transaction, so every query sees the database as it was when the
+    snapshot started, while other connections keep writing (requires WAL mode)
+    :param db_filepath: Optional path to SQLite DB file (defaults to the file opened by start_conn)
+    :return: Context manager yielding the Connection object (None if unsuccessful); closed on exit
+    """
+    conn = open_conn(db_filepath, read_only=True)
+    try:
+        if conn is not None:
+            # A deferred transaction only takes its snapshot at the first read
+            conn.execute('BEGIN')
+            conn.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()
+        yield conn
+    finally:
+        if conn is not None:
+            close_conn(conn)
+
+
+def bulk_insert(conn, table, columns, rows, chunk_size=10000):
+    """
+    Inserts many rows with executemany, committing one transaction per chunk instead of one per row.
+    Logs error and rolls back the failing chunk if unsuccessful; earlier chunks stay committed.
+    :param conn: Connection object to database
+    :param table: Table name
+    :param columns: List of column names
+    :param rows: Iterable of row sequences ordered like columns
+    :param chunk_size: Number of rows per transaction
+    :return: Number of rows inserted if successful, None if unsuccessful
+    """
+    query = 'INSERT INTO {} ({}) VALUES ({})'.format(table, ', '.join(columns), ', '.join(['?'] * len(columns)))
+    rows = list(rows)
+    inserted = 0
+
+    try:
+        cur = conn.cursor()
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows[start:start + chunk_size]
+            with conn:
+                cur.executemany(query, chunk)
+            inserted += len(chunk)
+    except Error as e:
+        log_error(e, 'bulk_insert')
+        return None
+    return inserted
+
+
+def ensure_summary_tables(conn, bins):
+    """
+    Creates summary tables with per-status row counts and binned distributions of fetal_health, kept current by
+    insert, update, and delete triggers, plus an index on fetal_health. Existing tables are reused when their bins
+    match; otherwise they are rebuilt and backfilled from the table. Logs error if unsuccessful.
+    Bins include their left edge, the last bin of each column also includes its right edge (like np.histogram).
+    :param conn: Connection object to database
+    :param bins: Dictionary mapping fetal_health column names to ascending lists of bin edges
+    :return: 1 if successful, 0 if unsuccessful
+    """
+    expected = []
+    for column in sorted(bins):
+        edges = [float(edge) for edge in bins[column]]
+        for ind in range(len(edges) - 1):
+            expected.append((column, ind, edges[ind], edges[ind + 1], int(ind == len(edges) - 2)))
+
+    try:
+        cur = conn.cursor()
+        triggers = {row[0] for row in cur.execute("SELECT name FROM sqlite_master WHERE type = 'trigger'")}
+        try:
+            stored = cur.execute('SELECT column_name, bin, low, high, closed FROM fetal_health_bins '
+                                 'ORDER BY column_name, bin').fetchall()
+        except Error:
+            stored = None
+        if stored == expected and {'fetal_health_summary_insert', 'fetal_health_summary_update',
+                                   'fetal_health_summary_delete'} <= triggers:
+            return 1
+
+        with conn:
+            for trigger in ('insert', 'update', 'delete'):
+                cur.execute('DROP TRIGGER IF EXISTS fetal_health_summary_{}'.format(trigger))
+            for table in ('fetal_health_status_counts', 'fetal_health_bins', 'fetal_health_histogram'):
+                cur.execute('DROP TABLE IF EXISTS {}'.format(table))
+
+            cur.execute('CREATE INDEX IF NOT EXISTS fetal_health_status_idx ON fetal_health (fetal_health)')
+            cur.execute('CREATE TABLE fetal_health_status_counts ('
+                        'fetal_health REAL PRIMARY KEY, count INTEGER NOT NULL)')
+            cur.execute('CREATE TABLE fetal_health_bins ('
+                        'column_name TEXT, bin INTEGER, low REAL NOT NULL, high REAL NOT NULL, '
+                        'closed INTEGER NOT NULL, PRIMARY KEY (column_name, bin))')
+            cur.execute('CREATE TABLE fetal_health_histogram ('
+                        'column_name TEXT, fetal_health REAL, bin INTEGER, count INTEGER NOT NULL, '
+                        'PRIMARY KEY (column_name, fetal_health, bin))')
+            cur.executemany('INSERT INTO fetal_health_bins VALUES (?, ?, ?, ?, ?)', expected)
+
+            # Backfill from the rows already in the table
+            cur.execute('INSERT INTO fetal_health_status_counts SELECT fetal_health, COUNT(*) FROM fetal_health '
+                        'WHERE fetal_health IS NOT NULL GROUP BY fetal_health')
+            for column in sorted(bins):
+                cur.execute('INSERT INTO fetal_health_histogram '
+                            'SELECT b.column_name, f.fetal_health, b.bin, COUNT(*) '
+                            'FROM fetal_health f JOIN fetal_health_bins b ON {} '
+                            'WHERE f.fetal_health IS NOT NULL '
+                            'GROUP BY b.column_name, f.fetal_health, b.bin'.format(bin_match(column, 'f', 'b')))
+
+            # Keep the summaries current as rows change
+            cur.execute('CREATE TRIGGER fetal_health_summary_insert AFTER INSERT ON fetal_health '
+                        'WHEN NEW.fetal_health IS NOT NULL BEGIN {} END'.format(summary_statements(bins, 'NEW', 1)))
+            cur.execute('CREATE TRIGGER fetal_health_summary_delete AFTER DELETE ON fetal_health '
+                        'WHEN OLD.fetal_health IS NOT NULL BEGIN {} END'.format(summary_statements(bins, 'OLD', -1)))
+            cur.execute('CREATE TRIGGER fetal_health_summary_update AFTER UPDATE OF fetal_health, {} ON fetal_health '
+                        'BEGIN {} {} END'.format(', '.join(sorted(bins)),
+                                                 summary_statements(bins, 'OLD', -1, 'OLD.fetal_health IS NOT NULL'),
+                                                 summary_statements(bins, 'NEW', 1, 'NEW.fetal_health IS NOT NULL')))
+    except Error as e:
+        log_error(e, 'ensure_summary_tables')
+        return 0
+    return 1
+
+
+def ensure_change_counter(conn):
+    """
+    Creates fetal_health_changes, a one-row table holding a counter that update and delete triggers on fetal_health
+    increase, so copies of existing rows (see snapshot.py) can tell when they are stale. Inserts aren't counted:
+    ids only grow (AUTOINCREMENT), so new rows are found by id. Logs error if unsuccessful.
+    :param conn: Connection object to database
+    :return: 1 if successful, 0 if unsuccessful
+    """
+    try:
+        with conn:
+            cur = conn.cursor()
+            cur.execute('CREATE TABLE IF NOT EXISTS fetal_health_changes ('
+                        'id INTEGER PRIMARY KEY CHECK (id = 0), count INTEGER NOT NULL)')
+            cur.execute('INSERT OR IGNORE INTO fetal_health_changes VALUES (0, 0)')
+            for trigger in ('update', 'delete'):
+                cur.execute('CREATE TRIGGER IF NOT EXISTS fetal_health_changes_{0} AFTER {1} ON fetal_health '
+                            'BEGIN UPDATE fetal_health_changes SET count = count + 1; END'.format(trigger,
+                                                                                              trigger.upper()))
+    except Error as e:
+        log_error(e, 'ensure_change_counter')
+        return 0
+    return 1
+
+
+def read_change_counter(conn):
+    """
+    Reads the counter maintained by the triggers created by ensure_change_counter
+    :param conn: Connection object to database
+    :return: Number of rows of fetal_health updated or deleted since the counter was created,
+             or None if there is no counter
+    """
+    try:
+        row = conn.execute('SELECT count FROM fetal_health_changes WHERE id = 0').fetchone()
+    except Error:
+        return None
+    return None if row is None else row[0]
+
+
+def bin_match(column, row, bins_table):
+    """
+    Builds the SQL condition matching a row's value of a column to its bin in fetal_health_bins
+    :param column: Column name
+    :param row: Name or alias of the row (e.g. NEW)
+    :param bins_table: Name or alias of fetal_health_bins
+    :return: SQL condition (string)
+    """
+    return ("{b}.column_name = '{c}' AND {r}.{c} >= {b}.low AND "
+            "({r}.{c} < {b}.high OR ({b}.closed = 1 AND {r}.{c} = {b}.high))").format(c=column, r=row, b=bins_table)
+
+
+def summary_statements(bins, row, change, condition=None):
+    """
+    Builds the trigger statements adding (or removing) one row to the summary tables
+    :param bins: Dictionary mapping column names to bin edges
+    :param row: NEW for inserted rows, OLD for deleted rows
+    :param change: 1 to add the row, -1 to remove it
+    :param condition: Optional SQL condition the statements are limited to
+    :return: SQL statements (string), each ending with a semicolon
+    """
+    where = '' if condition is None else ' AND ' + condition
+    statements = ['INSERT OR IGNORE INTO fetal_health_status_counts SELECT {r}.fetal_health, 0 '
+                  'WHERE {r}.fetal_health IS NOT NULL{w};'.format(r=row, w=where),
+                  'UPDATE fetal_health_status_counts SET count = count + ({d}) '
+                  'WHERE fetal_health = {r}.fetal_health{w};'.format(r=row, d=change, w=where)]
+    for column in sorted(bins):
+        match = bin_match(column, row, 'fetal_health_bins')
+        statements.append('INSERT OR IGNORE INTO fetal_health_histogram '
+                          'SELECT column_name, {r}.fetal_health, bin, 0 FROM fetal_health_bins '
+                          'WHERE {m}{w};'.format(r=row, m=match, w=where))
+        statements.append("UPDATE fetal_health_histogram SET count = count + ({d}) "
+                          "WHERE column_name = '{c}' AND fetal_health = {r}.fetal_health AND "
+                          "bin = (SELECT bin FROM fetal_health_bins WHERE {m}){w};".format(c=column, r=row, d=change,
+                                                                                         m=match, w=where))
+    return ' '.join(statements)
+
+
+def read_summary_tables(conn):
+    """
+    Reads the summary tables created by ensure_summary_tables. Logs error if unsuccessful.
+    :param conn: Connection object to database
+    :return: status counts (list of (fetal_health, count)),
+             histogram counts (list of (column_name, fetal_health, bin, count)), None if unsuccessful
+    """
+    try:
+        cur = conn.cursor()
+        counts = cur.execute('SELECT fetal_health, count FROM fetal_health_status_counts').fetchall()
+        histogram = cur.execute('SELECT column_name, fetal_health, bin, count FROM fetal_health_histogram').fetchall()
+    except Error as e:
+        log_error(e, 'read_summary_tables')
+        return None
+    return counts, histogram
 
 
 def attempt_login(username, password, conn):
@@ -128,12 +405,83 @@ def attempt_login(username, password, conn):
         cur.execute(query, placeholder)
         result = cur.fetchone()[0]
     except Error as e:
-
-        dirname = Path(__file__).parent.absolute()
-        error_filepath = Path(dirname, 'error_log').with_suffix('.txt')
-
-        f = open(error_filepath, 'a')
-        f.write('{} - {}\n'.format(datetime.datetime.now(), e))
-        f.close()
+        log_error(e, 'attempt_login')
         return 0
     return result
+
+
+def load_test(db_filepath=None, readers=4, seconds=5.0, pragmas=True):
+    """
+    Measures insert latency and concurrent read throughput on a temporary copy of the database.
+    One writer thread inserts copies of existing rows (one commit each) while reader threads repeat a full-table query.
+    :param db_filepath: Optional path to SQLite DB file to copy (defaults to fetal_health_db.db next to this file)
+    :param readers: Number of reader threads
+    :param seconds: Duration of the test
+    :param pragmas: Set False to measure SQLite's default journal and cache settings instead of CONN_PRAGMAS
+    :return: Dictionary with inserts, insert latency percentiles (ms), reads and reads_per_second
+    """
+    if db_filepath is None:
+        db_filepath = Path(Path(__file__).parent.absolute(), 'fetal_health_db').with_suffix('.db')
+
+    folder = tempfile.mkdtemp()
+    try:
+        test_filepath = Path(folder, 'load_test').with_suffix('.db')
+        shutil.copyfile(db_filepath, test_filepath)
+        # Set the journal mode once up front so readers never see the switch
+        close_conn(open_conn(test_filepath, pragmas=pragmas))
+
+        stop = threading.Event()
+        latencies = []
+        reads = []
+
+        def write():
+            conn = open_conn(test_filepath, pragmas=pragmas)
+            columns = [row[1] for row in conn.execute('PRAGMA table_info(fetal_health)') if row[1] != 'id']
+            rows = conn.execute('SELECT {} FROM fetal_health'.format(', '.join(columns))).fetchall()
+            query = 'INSERT INTO fetal_health ({}) VALUES ({})'.format(', '.join(columns),
+                                                                       ', '.join(['?'] * len(columns)))
+            while not stop.is_set():
+                start = time.perf_counter()
+                with conn:
+                    conn.execute(query, rows[len(latencies) % len(rows)])
+                latencies.append(time.perf_counter() - start)
+            close_conn(conn)
+
+        def read():
+            conn = open_conn(test_filepath, read_only=True, pragmas=pragmas)
+            count = 0
+            while not stop.is_set():
+                conn.execute('SELECT fetal_health, COUNT(*), AVG(baseline_value) FROM fetal_health '
+                             'GROUP BY fetal_health').fetchall()
+                count += 1
+            reads.append(count)
+            close_conn(conn)
+
+        threads = [threading.Thread(target=write)] + [threading.Thread(target=read) for _ in range(readers)]
+        for thread in threads:
+            thread.start()
+        time.sleep(seconds)
+        stop.set()
+        for thread in threads:
+            thread.join()
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+    latencies.sort()
+    percentile = lambda p: 1000 * latencies[min(int(p * len(latencies)), len(latencies) - 1)] if latencies else 0.0
+    return {'inserts': len(latencies),
+            'insert_p50_ms': percentile(0.50),
+            'insert_p99_ms': percentile(0.99),
+            'reads': sum(reads),
+            'reads_per_second': sum(reads) / seconds}
+
+
+if __name__ == '__main__':
+
+    # Usage: python dbinter.py [fetal_health_db.db] [readers]
+    db_filepath = sys.argv[1] if len(sys.argv) > 1 else None
+    readers = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    for label, pragmas in (('Default settings', False), ('WAL and pragmas', True)):
+        results = load_test(db_filepath, readers, pragmas=pragmas)
+        print('{:<17} {inserts} inserts (p50 {insert_p50_ms:.2f} ms, p99 {insert_p99_ms:.2f} ms), '
+              '{reads} reads ({reads_per_second:.0f}/s)'.format(label, **results))
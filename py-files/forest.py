@@ -0,0 +1,340 @@
+"""
+Austin Wong
+001355444
+2/22/2021
+"""
+
+# IMPORTS
+# Data Analysis Imports
+# pandas and joblib are imported by the functions that use them, so the engine can start loading when the
+# application launches without waiting for them (see preload_engine)
+import numpy as np
+
+# General and File Management Imports
+import os
+import sys
+import time
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+
+# CONSTANTS
+# Number of rows traversed together; keeps the (rows x trees) working arrays small enough to stay in cache
+BLOCK_SIZE = 512
+
+# Fraction of (row, tree) pairs still descending below which finished pairs are dropped from the working arrays
+COMPACT_RATIO = 0.75
+
+
+# CLASSES
+class EnginePreload:
+    """
+    Engine load started when the application launches (see preload_engine), handed to model.py's load_engine
+    """
+    future = None
+    engine_filepath = None
+
+
+class CompiledForest:
+    """
+    Random forest flattened into contiguous NumPy arrays for fast inference.
+    Every node of every tree is stored in one set of arrays, so all trees are traversed together for a block of rows.
+    Leaves point to themselves with an infinite threshold, letting finished (row, tree) pairs idle until compacted.
+    """
+
+    def __init__(self, feature, threshold, children, is_internal, value, roots, classes):
+        """
+        :param feature: array with split feature of each node (0 for leaves)
+        :param threshold: float32 array with split threshold of each node (inf for leaves)
+        :param children: array (2 * n_nodes) with global index of left and right child of each node (self for leaves)
+        :param is_internal: boolean array, False for leaves
+        :param value: float64 array (n_nodes, n_classes) with normalized class distribution of each node
+        :param roots: array with global index of each tree's root node
+        :param classes: array of class labels
+        """
+        self.feature = feature
+        self.threshold = threshold
+        self.children = children
+        self.is_internal = is_internal
+        self.value = value
+        self.roots = roots
+        self.classes_ = classes
+
+    @property
+    def n_trees(self):
+        return len(self.roots)
+
+    @property
+    def n_nodes(self):
+        return len(self.feature)
+
+    def apply(self, X):
+        """
+        Finds the leaf reached in every tree for every row
+        :param X: float32 array (n_rows, n_features)
+        :return: array (n_rows, n_trees) with global leaf indices
+        """
+        n_rows, n_features = X.shape
+        X_flat = X.ravel()
+
+        nodes = np.tile(self.roots, n_rows)
+        offsets = np.repeat(np.arange(n_rows, dtype=np.intp) * n_features, self.n_trees)
+        leaves = np.empty(n_rows * self.n_trees, dtype=np.intp)
+        positions = np.arange(n_rows * self.n_trees)
+
+        # Walk every (row, tree) pair down one level per pass
+        while nodes.size > 0:
+            go_right = X_flat[offsets + self.feature[nodes]] > self.threshold[nodes]
+            nodes = self.children[(nodes << 1) + go_right]
+
+            # Drop pairs that reached a leaf once enough of them have finished
+            descending = self.is_internal[nodes]
+            if np.count_nonzero(descending) < COMPACT_RATIO * nodes.size:
+                finished = ~descending
+                leaves[positions[finished]] = nodes[finished]
+                positions = positions[descending]
+                nodes = nodes[descending]
+                offsets = offsets[descending]
+
+        return leaves.reshape(n_rows, self.n_trees)
+
+    def predict_block(self, X):
+        """
+        Predicts class probabilities for one block of rows
+        :param X: float32 array (n_rows, n_features)
+        :return: float64 array (n_rows, n_classes)
+        """
+        leaves = self.apply(X)
+
+        # Sum trees in order, like a single-threaded scikit-learn forest
+        proba = np.zeros((leaves.shape[0], len(self.classes_)))
+        for tree in range(self.n_trees):
+            proba += self.value[leaves[:, tree]]
+        return proba / self.n_trees
+
+    def predict_proba(self, X, n_jobs=None):
+        """
+        Predicts class probabilities, averaged over all trees
+        :param X: Array-like (n_rows, n_features) or a single row (n_features,)
+        :param n_jobs: Number of threads used for batches larger than one block (defaults to all cores)
+        :return: float64 array (n_rows, n_classes)
+        """
+        X = as_feature_array(X)
+        blocks = [X[start:start + BLOCK_SIZE] for start in range(0, X.shape[0], BLOCK_SIZE)]
+        if len(blocks) == 0:
+            return np.empty((0, len(self.classes_)))
+        if len(blocks) == 1:
+            return self.predict_block(blocks[0])
+
+        # NumPy releases the GIL while indexing, so blocks can be traversed on several cores
+        if n_jobs is None:
+            n_jobs = os.cpu_count() or 1
+        if n_jobs == 1:
+            return np.concatenate([self.predict_block(block) for block in blocks])
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            return np.concatenate(list(executor.map(self.predict_block, blocks)))
+
+    def predict(self, X):
+        """
+        Predicts class labels
+        :param X: Array-like (n_rows, n_features) or a single row (n_features,)
+        :return: array of class labels
+        """
+        return self.classes_[np.argmax(self.predict_proba(X), axis=1)]
+
+
+# FUNCTIONS
+def as_feature_array(X):
+    """
+    Converts input to the float32 matrix scikit-learn trees compare against thresholds
+    :param X: DataFrame, 2D array, or single row
+    :return: C-contiguous float32 array (n_rows, n_features)
+    """
+    if hasattr(X, 'to_numpy'):
+        X = X.to_numpy()
+    X = np.ascontiguousarray(X, dtype=np.float32)
+    if X.ndim == 1:
+        X = X.reshape(1, -1)
+    return X
+
+
+def float32_thresholds(threshold):
+    """
+    Rounds float64 thresholds down to the largest float32 not above them.
+    For any float32 x, x <= t64 exactly when x <= t32, so traversal can compare in float32 without changing results.
+    :param threshold: float64 array
+    :return: float32 array
+    """
+    with np.errstate(over='ignore'):
+        rounded = threshold.astype(np.float32)
+    too_high = rounded.astype(np.float64) > threshold
+    rounded[too_high] = np.nextafter(rounded[too_high], np.float32(-np.inf))
+    return rounded
+
+
+def compile_forest(model):
+    """
+    Compiles a trained RandomForestClassifier (or a fitted GridSearchCV wrapping one) into a CompiledForest
+    :param model: Estimator
+    :return: CompiledForest
+    """
+    forest = getattr(model, 'best_estimator_', model)
+
+    features, thresholds, children, is_internal, values, roots = [], [], [], [], [], []
+    offset = 0
+    for estimator in forest.estimators_:
+        tree = estimator.tree_
+        node_ids = np.arange(tree.node_count) + offset
+        is_leaf = tree.children_left == -1
+
+        # Shift child indices into the concatenated arrays; leaves loop back to themselves
+        tree_children = np.empty(2 * tree.node_count, dtype=np.intp)
+        tree_children[0::2] = np.where(is_leaf, node_ids, tree.children_left + offset)
+        tree_children[1::2] = np.where(is_leaf, node_ids, tree.children_right + offset)
+        children.append(tree_children)
+        is_internal.append(~is_leaf)
+        features.append(np.where(is_leaf, 0, tree.feature))
+        threshold = float32_thresholds(tree.threshold)
+        threshold[is_leaf] = np.inf
+        thresholds.append(threshold)
+
+        # Normalize leaf counts (or fractions) the same way DecisionTreeClassifier.predict_proba does
+        value = tree.value[:, 0, :].astype(np.float64)
+        normalizer = value.sum(axis=1, keepdims=True)
+        normalizer[normalizer == 0.0] = 1.0
+        values.append(value / normalizer)
+
+        roots.append(offset)
+        offset += tree.node_count
+
+    return CompiledForest(feature=np.concatenate(features).astype(np.intp),
+                          threshold=np.concatenate(thresholds),
+                          children=np.concatenate(children),
+                          is_internal=np.concatenate(is_internal),
+                          value=np.ascontiguousarray(np.concatenate(values)),
+                          roots=np.array(roots, dtype=np.intp),
+                          classes=np.asarray(forest.classes_))
+
+
+def get_model_filepath(filename):
+    """
+    :param filename: Name of model file without suffix
+    :return: Path to .joblib file next to this file
+    """
+    dirname = Path(__file__).parent.absolute()
+    suffix = ".joblib"
+    return Path(dirname, filename).with_suffix(suffix)
+
+
+def dump_atomic(value, filepath):
+    """
+    Saves a value with joblib to a temporary file next to filepath, then renames it over filepath, so other
+    running instances never read or memory-map a partly written file
+    :param value: Object to save
+    :param filepath: Path to .joblib file
+    :return: None
+    """
+    from joblib import dump
+    temp_filepath = Path(filepath).with_name('{}.{}.tmp'.format(Path(filepath).name, os.getpid()))
+    try:
+        dump(value, temp_filepath)
+        os.replace(temp_filepath, filepath)
+    finally:
+        if temp_filepath.exists():
+            temp_filepath.unlink()
+
+
+def load_engine_file(engine_filepath, model_filepath):
+    """
+    Loads a compiled prediction engine with its arrays memory-mapped read-only, so the file is paged in on demand
+    and its pages are shared by every running instance of the application.
+    Compiles and saves the engine first if the file is missing or older than the model file.
+    :param engine_filepath: Path to the engine's .joblib file
+    :param model_filepath: Path to the scikit-learn model's .joblib file
+    :return: CompiledForest, or None if there is no model or engine file
+    """
+    from joblib import load
+    if os.path.exists(model_filepath):
+        if not os.path.exists(engine_filepath) or os.path.getmtime(engine_filepath) < os.path.getmtime(model_filepath):
+            dump_atomic(compile_forest(load(filename=model_filepath)), engine_filepath)
+
+    if not os.path.exists(engine_filepath):
+        return None
+    return load(filename=engine_filepath, mmap_mode='r')
+
+
+def preload_engine(engine_filepath, model_filepath):
+    """
+    Starts load_engine_file on a background thread. Only NumPy and joblib are needed (scikit-learn too if the engine
+    has to be compiled), so the application calls this at launch, before pandas and model.py are imported.
+    :param engine_filepath: Path to the engine's .joblib file
+    :param model_filepath: Path to the scikit-learn model's .joblib file
+    :return: Future resolving to the CompiledForest
+    """
+    executor = ThreadPoolExecutor(max_workers=1)
+    EnginePreload.future = executor.submit(load_engine_file, engine_filepath, model_filepath)
+    EnginePreload.engine_filepath = Path(engine_filepath)
+    executor.shutdown(wait=False)
+    return EnginePreload.future
+
+
+def take_preloaded_engine(engine_filepath):
+    """
+    Hands over the load started by preload_engine, once
+    :param engine_filepath: Path to the engine's .joblib file
+    :return: Future resolving to the CompiledForest, or None if no load of this file was started
+    """
+    future = EnginePreload.future
+    if future is None or EnginePreload.engine_filepath != Path(engine_filepath):
+        return None
+    EnginePreload.future = None
+    return future
+
+
+def benchmark(model, X, repeat=5):
+    """
+    Compares the compiled engine against scikit-learn for single-row latency and batch throughput
+    :param model: Estimator
+    :param X: Pandas DataFrame of features
+    :param repeat: Number of timed repetitions (best time is kept)
+    :return: Dictionary with timings and whether outputs are identical
+    """
+    engine = compile_forest(model)
+    row = X.iloc[[0]]
+
+    def best_time(func, *args):
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func(*args)
+            times.append(time.perf_counter() - start)
+        return min(times)
+
+    results = {
+        'rows': len(X),
+        'trees': engine.n_trees,
+        'nodes': engine.n_nodes,
+        'sklearn_single_ms': 1000 * best_time(model.predict, row),
+        'compiled_single_ms': 1000 * best_time(engine.predict, row),
+        'sklearn_batch_s': best_time(model.predict_proba, X),
+        'compiled_batch_s': best_time(engine.predict_proba, X),
+        'identical_predict': bool(np.array_equal(engine.predict(X), model.predict(X))),
+        'identical_proba': bool(np.array_equal(engine.predict_proba(X), model.predict_proba(X))),
+    }
+    results['single_speedup'] = results['sklearn_single_ms'] / results['compiled_single_ms']
+    results['batch_speedup'] = results['sklearn_batch_s'] / results['compiled_batch_s']
+    return results
+
+
+if __name__ == '__main__':
+    import pandas as pd
+    from joblib import load
+
+    # Usage: python forest.py [model.joblib] [fetal_health.csv]
+    dirname = Path(__file__).parent.absolute()
+    model_filepath = sys.argv[1] if len(sys.argv) > 1 else Path(dirname, 'new_model').with_suffix('.joblib')
+    data_filepath = sys.argv[2] if len(sys.argv) > 2 else Path(dirname, 'fetal_health').with_suffix('.csv')
+
+    fetal_data = pd.read_csv(data_filepath)
+    for key, value in benchmark(load(model_filepath), fetal_data.drop(columns=['fetal_health'])).items():
+        print('{:<20} {}'.format(key, value))
@@ -10,10 +10,15 @@ import sys
 # Custom Packages
 from window import controller, create_alert
 from dbinter import start_conn, close_conn
+from forest import preload_engine, get_model_filepath
 
 
 if __name__ == '__main__':
 
+    # Start loading the prediction engine in the background as soon as the application launches. It only needs
+    # NumPy and joblib; pandas, model.py and the plotting packages are imported by the screens that use them.
+    preload_engine(get_model_filepath('new_model_engine'), get_model_filepath('new_model'))
+
     # Connect to SQLite DB
     conn = start_conn()
     if conn is None:
@@ -8,32 +8,298 @@ Austin Wong
 # Data Analysis Imports
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
 
 # Machine Learning Imports
-from sklearn.model_selection import train_test_split, GridSearchCV
-from sklearn.ensemble import RandomForestClassifier
-from sklearn.metrics import classification_report, plot_confusion_matrix
+# scikit-learn, Matplotlib and joblib are imported by the functions that use them (they take seconds to import),
+# so the application and command line tools start without waiting for them
 
 # General and File Management Imports
 import os
+import sys
+import time
+import argparse
+import copy
+import shutil
+import tempfile
+from multiprocessing import Pool, TimeoutError
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from joblib import dump, load
 import datetime
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
 
 # Database Imports
 from sqlite3 import Error
-from dbinter import get_conn
+from dbinter import get_conn, start_conn, open_conn, close_conn, bulk_insert, ensure_summary_tables, \
+    read_summary_tables, get_db_filepath, ensure_change_counter, read_change_counter
+from snapshot import open_snapshot, create_snapshot, extend_snapshot, iter_snapshot
+
+# Logging Imports
+from applog import log_event, log_error
+
+# Inference Imports
+from forest import compile_forest, as_feature_array, BLOCK_SIZE, get_model_filepath, dump_atomic, load_engine_file, \
+    take_preloaded_engine
+
+
+# CONSTANTS
+# Ordered column names for model features
+feature_cols = ['baseline_value', 'accelerations', 'fetal_movement',
+                'uterine_contractions', 'light_decelerations', 'severe_decelerations',
+                'prolongued_decelerations', 'abnormal_short_term_variability',
+                'mean_value_of_short_term_variability',
+                'percentage_of_time_with_abnormal_long_term_variability',
+                'mean_value_of_long_term_variability', 'histogram_width',
+                'histogram_min', 'histogram_max', 'histogram_number_of_peaks',
+                'histogram_number_of_zeroes', 'histogram_mode', 'histogram_mean',
+                'histogram_median', 'histogram_variance', 'histogram_tendency']
+
+# Fetal health status labels in class order
+fhs_labels = ['Normal', 'Suspect', 'Pathologic']
+
+# Fetal health status values in class order
+fhs_values = [1.0, 2.0, 3.0]
+
+# Ordered column names of the fetal_health table (without id)
+db_cols = feature_cols + ['fetal_health']
+
+# Columns of the dashboard correlation matrix
+corr_cols = db_cols
+
+# Heart rate values for input validation
+MIN_HR = 0
+MAX_HR = 500
+
+# Schema of every fetal_health column: display label, data type, and accepted range (min and max) or values
+fetal_schema = {
+    'baseline_value': {'label': 'Baseline FHR', 'dtype': int, 'min': MIN_HR, 'max': MAX_HR},
+    'accelerations': {'label': 'Accelerations', 'dtype': float, 'min': 0, 'max': 1},
+    'fetal_movement': {'label': 'Fetal Movement', 'dtype': float, 'min': 0, 'max': 1},
+    'uterine_contractions': {'label': 'Uterine Contractions', 'dtype': float, 'min': 0, 'max': 1},
+    'light_decelerations': {'label': 'Light Decelerations', 'dtype': float, 'min': 0, 'max': 1},
+    'severe_decelerations': {'label': 'Severe Decelerations', 'dtype': float, 'min': 0, 'max': 1},
+    'prolongued_decelerations': {'label': 'Prolongued Decelerations', 'dtype': float, 'min': 0, 'max': 1},
+    'abnormal_short_term_variability': {'label': 'Abnormal Short Term Variability', 'dtype': int,
+                                        'min': 0, 'max': 100},
+    'mean_value_of_short_term_variability': {'label': 'Mean Value of Short Term Variability', 'dtype': float,
+                                             'min': 0, 'max': 100},
+    'percentage_of_time_with_abnormal_long_term_variability': {
+        'label': 'Percentage of Time with Abnormal Long Term Variability', 'dtype': int, 'min': 0, 'max': 100},
+    'mean_value_of_long_term_variability': {'label': 'Mean Value of Long Term Variability', 'dtype': float,
+                                            'min': 0, 'max': 100},
+    'histogram_width': {'label': 'Histogram Width', 'dtype': int, 'min': MIN_HR, 'max': MAX_HR},
+    'histogram_min': {'label': 'Histogram Min', 'dtype': int, 'min': MIN_HR, 'max': MAX_HR},
+    'histogram_max': {'label': 'Histogram Max', 'dtype': int, 'min': MIN_HR, 'max': MAX_HR},
+    'histogram_number_of_peaks': {'label': 'Histogram Number of Peaks', 'dtype': int, 'min': 0, 'max': 50},
+    'histogram_number_of_zeroes': {'label': 'Histogram Number of Zeroes', 'dtype': int, 'min': 0, 'max': 50},
+    'histogram_mode': {'label': 'Histogram Mode', 'dtype': int, 'min': MIN_HR, 'max': MAX_HR},
+    'histogram_mean': {'label': 'Histogram Mean', 'dtype': int, 'min': MIN_HR, 'max': MAX_HR},
+    'histogram_median': {'label': 'Histogram Median', 'dtype': int, 'min': MIN_HR, 'max': MAX_HR},
+    'histogram_variance': {'label': 'Histogram Variance', 'dtype': int, 'min': MIN_HR, 'max': MAX_HR},
+    'histogram_tendency': {'label': 'Histogram Tendency', 'dtype': int, 'values': (-1, 0, 1)},
+    'fetal_health': {'label': 'Fetal Health Status', 'dtype': float, 'values': tuple(fhs_values)}
+}
+
+# Compact storage type of every fetal_health column: the smallest integer type holding its schema range, float32 for
+# rates and measurements (the precision trees compare in), and a categorical label. 54 bytes per row instead of 176.
+compact_dtypes = {
+    'baseline_value': np.int16,
+    'accelerations': np.float32,
+    'fetal_movement': np.float32,
+    'uterine_contractions': np.float32,
+    'light_decelerations': np.float32,
+    'severe_decelerations': np.float32,
+    'prolongued_decelerations': np.float32,
+    'abnormal_short_term_variability': np.int8,
+    'mean_value_of_short_term_variability': np.float32,
+    'percentage_of_time_with_abnormal_long_term_variability': np.int8,
+    'mean_value_of_long_term_variability': np.float32,
+    'histogram_width': np.int16,
+    'histogram_min': np.int16,
+    'histogram_max': np.int16,
+    'histogram_number_of_peaks': np.int8,
+    'histogram_number_of_zeroes': np.int8,
+    'histogram_mode': np.int16,
+    'histogram_mean': np.int16,
+    'histogram_median': np.int16,
+    'histogram_variance': np.int16,
+    'histogram_tendency': np.int8,
+    'fetal_health': pd.CategoricalDtype(fhs_values)
+}
+
+# Keep a columnar snapshot of fetal_health next to the database (see snapshot.py), so loading data only reads rows
+# added since the snapshot was written
+USE_SNAPSHOT = True
+
+# Rows added after the snapshot at which refresh_fetal_data appends them to it (load_fetal_data always does)
+SNAPSHOT_APPEND_ROWS = 1000
+
+# Number of snapshot rows compared against the database when a snapshot is opened
+SNAPSHOT_CHECK_ROWS = 16
+
+# Validation error codes: value is valid, not a number of the column's type, or outside the accepted range or values
+VALID = 0
+TYPE_ERROR = 1
+RANGE_ERROR = 2
+
+# Histogram bin edges for dashboard graphs
+hist_bins = {'baseline_value': np.arange(100, 180, 10),
+             'accelerations': np.arange(0, 0.0105, 0.0005),
+             'prolongued_decelerations': np.arange(0, 0.0065, 0.001)}
+
+# Default number of rows per chunk for batch operations
+CHUNK_SIZE = 10000
+
+# Hyperparameter grid for RandomForestClassifier using optimal settings from previous experimentation
+rf_grid = {"n_estimators": np.arange(460, 910, 50),
+           "max_depth": [None],
+           "min_samples_split": [2, 8, 14],
+           "min_samples_leaf": [1]}
+
+# Number of cross-validation folds used for hyperparameter tuning
+CV_FOLDS = 5
+
+# Default number of processes for training (-1 uses all cores)
+N_JOBS = -1
+
+# Number of trees added per step when growing a forest that can be cancelled
+GROWTH_STEP = 50
+
+# Seconds to wait for a search result before checking for cancellation
+POLL_INTERVAL = 0.2
+
+# Seconds between memory samples while measuring a training phase or candidate (see measure)
+MEMORY_SAMPLE_INTERVAL = 0.05
+
+# Number of slowest candidates listed in the training profile (see format_training_profile)
+PROFILE_CANDIDATES = 5
+
+# Number of oldest trees replaced by trees grown on current data when updating a model
+UPDATE_TREES = 100
+
+# Number of older training rows the new trees of an update see besides the new rows (a stratified sample, so every
+# class keeps its usual share); bounds the cost of an update however large the table grows
+UPDATE_SAMPLE_ROWS = 20000
+
+# Largest number of predictions kept in the prediction cache
+CACHE_SIZE = 100000
+
+# Seconds a cached prediction stays valid (None keeps it until evicted or the model changes)
+CACHE_TTL = 3600
 
 
 # CLASSES
+class PredictionCache:
+    """
+    Bounded least-recently-used cache of class probabilities, with optional expiry.
+    Keys combine the model version and the feature values, so predictions from an older model are never returned.
+    Safe to use from several threads.
+    """
+
+    def __init__(self, maxsize=CACHE_SIZE, ttl=CACHE_TTL):
+        """
+        :param maxsize: Largest number of entries kept; the least recently used entry is evicted first
+        :param ttl: Seconds an entry stays valid (None for no expiry)
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        """
+        :param key: Cache key (see prediction_keys)
+        :return: Cached probabilities, or None if missing or expired
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and self.ttl is not None and time.monotonic() - entry[1] > self.ttl:
+                del self.entries[key]
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, proba):
+        """
+        :param key: Cache key (see prediction_keys)
+        :param proba: Class probabilities for one row
+        :return: None
+        """
+        with self.lock:
+            self.entries[key] = (proba, time.monotonic())
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        """
+        Removes every entry (counters are kept)
+        :return: None
+        """
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        """
+        :return: Dictionary with size, maxsize, hits, misses, evictions, expirations and hit_rate
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'size': len(self.entries), 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'expirations': self.expirations,
+                    'hit_rate': self.hits / lookups if lookups > 0 else 0.0}
+
+
 class Model:
     """
-    Model class for access to Machine Learning model, underlying data, and new data to be inserted
+    Model class for access to Machine Learning model, underlying data, and new data to be inserted.
+    Fetal health data is never held in memory as a whole: last_id and row_count mark the rows that are loaded
+    (row_count is None until load_fetal_data is called), and the rows are streamed in chunks when needed,
+    from the memory-mapped snapshot up to its watermark and from the database after it.
     """
-    fetal_data = None
+    last_id = 0
+    row_count = None
+    snapshot = None
     current_patient = None
     model = None
+    engine = None
+    engine_source = None
+    engine_future = None
+    version = 0
+    prediction_cache = PredictionCache()
+
+
+class Aggregates:
+    """
+    Per-status row counts and histograms behind the dashboard graphs, read from summary tables the database keeps
+    current, so graphs never scan the data.
+    Moments hold (rows, column means, co-moment matrix) per status for the correlation matrix; they are computed once
+    from the loaded data and updated with each batch of new rows.
+    """
+    counts = None
+    histograms = None
+    moments = None
+
+
+class SharedData:
+    """
+    Training data and cross-validation folds held by each hyperparameter search process.
+    Arrays are memory-mapped from one file, so every process reads the same pages instead of receiving a copy per task.
+    """
+    X = None
+    y = None
+    folds = None
 
 
 # Getters and Setters
@@ -76,110 +342,1405 @@ def get_current_patient():
 
 def load_fetal_data(conn):
     """
-    Loads all fetal health data from fetal_health table in SQLite DB
+    Loads the watermark of fetal health data in fetal_health table in SQLite DB (highest id and number of rows).
+    Opens the snapshot of the table, bringing it up to date first, so only rows added since the last load are read
+    from the database. Rows up to the watermark are streamed in chunks when needed (see iter_fetal_data),
+    so memory use stays bounded.
+    :param conn: connection to SQLite DB
+    :return: None
+    """
+    Model.snapshot = None
+    if USE_SNAPSHOT:
+        Model.snapshot = load_snapshot(conn)
+    last_id = conn.execute("SELECT MAX(id) FROM fetal_health").fetchone()[0]
+    Model.last_id = int(last_id) if last_id is not None else 0
+    Model.row_count = count_rows(conn, Model.last_id, Model.snapshot)
+    Aggregates.moments = None
+
+
+def get_snapshot_folder():
+    """
+    :return: Path to the snapshot folder of the current database (next to the database file)
+    """
+    db_filepath = get_db_filepath()
+    return Path(db_filepath.parent, db_filepath.stem + '_snapshot')
+
+
+def load_snapshot(conn):
+    """
+    Opens the snapshot of fetal_health table and appends rows added since it was written. Writes a new snapshot if
+    there is none or it no longer matches the database (see check_snapshot). Logs error if it can't be written.
     :param conn: connection to SQLite DB
+    :return: Snapshot, or None if there is no usable snapshot (data is then read from the database)
+    """
+    # Without the change counter, edits to existing rows couldn't be detected (e.g. on a read-only connection)
+    changes = read_change_counter(conn)
+    if changes is None and ensure_change_counter(conn):
+        changes = read_change_counter(conn)
+    if changes is None:
+        return None
+
+    folder = get_snapshot_folder()
+    try:
+        snapshot = open_snapshot(folder)
+        if snapshot is not None and not check_snapshot(snapshot, conn, changes):
+            snapshot = None
+        if snapshot is None:
+            return create_snapshot(folder, iter_fetal_data(conn), compact_dtypes, changes)
+        return extend_snapshot(snapshot, iter_fetal_data(conn, after_id=snapshot.last_id))
+    except (OSError, ValueError) as error:
+        log_error(error, 'snapshot')
+        return None
+
+
+def check_snapshot(snapshot, conn, changes):
+    """
+    Validates a snapshot against the database: the change counter (any update or delete since the snapshot was
+    written makes it stale), its number of rows per fetal health status (from the trigger-maintained status counts
+    when they exist, so the check doesn't grow with the table, otherwise its total number of rows), its last row,
+    and SNAPSHOT_CHECK_ROWS rows spread over it
+    :param snapshot: Snapshot
+    :param conn: connection to SQLite DB
+    :param changes: Current value of the change counter (see read_change_counter)
+    :return: True if the snapshot matches the database
+    """
+    if snapshot.meta.get('changes') != changes:
+        return False
+    if snapshot.rows == 0:
+        return snapshot.last_id == 0
+    try:
+        counts = dict(conn.execute("SELECT fetal_health, count FROM fetal_health_status_counts").fetchall())
+        for status, count in conn.execute("SELECT fetal_health, COUNT(*) FROM fetal_health WHERE id > ? AND "
+                                          "fetal_health IS NOT NULL GROUP BY fetal_health", (snapshot.last_id,)):
+            counts[status] = counts.get(status, 0) - count
+        statuses, snapshot_counts = np.unique(snapshot.decode('fetal_health'), return_counts=True)
+        present = ~np.isnan(statuses)
+        if {status: count for status, count in counts.items() if count != 0} != \
+                dict(zip(statuses[present].tolist(), snapshot_counts[present].tolist())):
+            return False
+    except Error:
+        if count_rows(conn, snapshot.last_id) != snapshot.rows:
+            return False
+
+    positions = np.unique(np.append(np.linspace(0, snapshot.rows - 1, SNAPSHOT_CHECK_ROWS).astype(np.int64),
+                                    np.random.default_rng().integers(0, snapshot.rows, SNAPSHOT_CHECK_ROWS)))
+    ids = [int(snapshot.ids[position]) for position in positions]
+    rows = conn.execute("SELECT id, {} FROM fetal_health WHERE id IN ({}) ORDER BY id".format(
+        ', '.join(db_cols), ', '.join(['?'] * len(ids))), ids).fetchall()
+    if [row[0] for row in rows] != ids:
+        return False
+    expected = np.array([row[1:] for row in rows], dtype=np.float64)
+    actual = np.column_stack([snapshot.take(col, positions) for col in db_cols])
+    return bool(np.array_equal(expected, actual, equal_nan=True))
+
+
+def current_snapshot(conn):
+    """
+    :param conn: connection to SQLite DB
+    :return: The loaded snapshot, or None if there is none or rows have been updated or deleted since it was loaded
+             (rows are then read from the database until load_fetal_data rebuilds it)
+    """
+    snapshot = Model.snapshot
+    if snapshot is not None and read_change_counter(conn) != snapshot.meta.get('changes'):
+        snapshot = Model.snapshot = None
+    return snapshot
+
+
+def count_rows(conn, upto_id, snapshot=None):
+    """
+    Counts rows of fetal_health table up to an id, counting only the rows after the snapshot in the database
+    :param conn: connection to SQLite DB
+    :param upto_id: Highest id counted
+    :param snapshot: Optional Snapshot covering the first rows
+    :return: Number of rows
+    """
+    if snapshot is not None and snapshot.last_id <= upto_id:
+        return snapshot.rows + conn.execute("SELECT COUNT(*) FROM fetal_health WHERE id > ? AND id <= ?",
+                                            (snapshot.last_id, upto_id)).fetchone()[0]
+    return conn.execute("SELECT COUNT(*) FROM fetal_health WHERE id <= ?", (upto_id,)).fetchone()[0]
+
+
+def refresh_fetal_data(conn=None):
+    """
+    Advances the watermark past rows added to fetal_health table since the data was loaded, using the id column.
+    If correlation moments have been computed, new rows are streamed once to update them, so refreshing costs time
+    proportional to the number of new rows. Once SNAPSHOT_APPEND_ROWS rows have been added after the snapshot,
+    they are appended to it.
+    :param conn: connection to SQLite DB (defaults to current connection)
+    :return: Number of new rows
+    """
+    if conn is None:
+        conn = get_conn()
+    if Model.row_count is None:
+        load_fetal_data(conn)
+        return 0
+
+    if Aggregates.moments is None:
+        new_rows, last_id = conn.execute("SELECT COUNT(*), MAX(id) FROM fetal_health WHERE id > ?",
+                                         (Model.last_id,)).fetchone()
+        if new_rows > 0:
+            Model.last_id = int(last_id)
+            Model.row_count += new_rows
+        update_snapshot(conn)
+        return new_rows
+
+    new_rows = 0
+    for chunk in iter_fetal_data(conn, after_id=Model.last_id):
+        Model.last_id = int(chunk.index[-1])
+        Model.row_count += len(chunk)
+        new_rows += len(chunk)
+        add_to_moments(chunk)
+    update_snapshot(conn)
+    return new_rows
+
+
+def update_snapshot(conn):
+    """
+    Appends rows up to the watermark to the loaded snapshot once at least SNAPSHOT_APPEND_ROWS of them are missing
+    :param conn: connection to SQLite DB
+    :return: None
+    """
+    snapshot = current_snapshot(conn)
+    if snapshot is None or Model.row_count - snapshot.rows < SNAPSHOT_APPEND_ROWS:
+        return
+    try:
+        Model.snapshot = extend_snapshot(snapshot, iter_fetal_data(conn, after_id=snapshot.last_id,
+                                                                   upto_id=Model.last_id))
+    except (OSError, ValueError) as error:
+        log_error(error, 'snapshot')
+
+
+def get_fetal_data(conn=None, compact=True):
+    """
+    Reads all loaded fetal health data into one DataFrame. Holds the whole table in memory, so prefer
+    iter_fetal_data for anything that can work chunk by chunk.
+    :param conn: connection to SQLite DB (defaults to current connection)
+    :param compact: Set False to keep every column float64 instead of converting each chunk to compact_dtypes
+    :return: Pandas DataFrame with fetal health data up to the watermark (without id column)
+    """
+    if conn is None:
+        conn = get_conn()
+    if Model.row_count is None:
+        load_fetal_data(conn)
+    chunks = [compact_fetal_data(chunk) if compact else chunk
+              for chunk in iter_fetal_data(conn, upto_id=Model.last_id)]
+    if len(chunks) == 0:
+        empty = pd.DataFrame(columns=db_cols, dtype=np.float64)
+        return compact_fetal_data(empty) if compact else empty
+    if compact:
+        chunks = unify_compact_chunks(chunks)
+    return pd.concat(chunks, ignore_index=True)
+
+
+def compact_fetal_data(df):
+    """
+    Converts fetal health data to compact_dtypes. Feature values are unchanged as float32, so training on
+    and predicting from compact data gives the same results. Integer columns holding missing or non-integer values,
+    or values outside the type's range, and label columns holding values outside their categories, are stored as
+    float32 instead. The choice is made for this DataFrame alone, so combine chunks with unify_compact_chunks.
+    :param df: Pandas DataFrame with fetal health data
+    :return: Pandas DataFrame with the same columns and index
+    """
+    columns = {}
+    for col in df.columns:
+        dtype = compact_dtypes.get(col)
+        values = df[col]
+        if dtype is None:
+            columns[col] = values
+        elif isinstance(dtype, pd.CategoricalDtype):
+            known = values.isna() | values.isin(dtype.categories)
+            columns[col] = values.astype(dtype if known.all() else np.float32)
+        elif np.issubdtype(dtype, np.integer):
+            limits = np.iinfo(dtype)
+            array = values.to_numpy(dtype=np.float64)
+            exact = np.all((array % 1 == 0) & (array >= limits.min) & (array <= limits.max))
+            columns[col] = values.astype(dtype if exact else np.float32)
+        else:
+            columns[col] = values.astype(dtype)
+    return pd.DataFrame(columns, index=df.index)
+
+
+def common_compact_dtype(dtypes):
+    """
+    :param dtypes: Dtypes one column was given by compact_fetal_data in different chunks
+    :return: Dtype holding the column in every chunk: the shared one, or float32 if any chunk fell back to it
+    """
+    dtypes = set(dtypes)
+    return dtypes.pop() if len(dtypes) == 1 else np.dtype(np.float32)
+
+
+def unify_compact_chunks(chunks):
+    """
+    Gives every chunk converted by compact_fetal_data the same dtype per column, so concatenating them doesn't widen
+    a column that fell back to float32 in some chunks (or turn a mix of categorical and float32 into object)
+    :param chunks: List of compact Pandas DataFrames with the same columns
+    :return: List of Pandas DataFrames
+    """
+    dtypes = {col: common_compact_dtype(chunk[col].dtype for chunk in chunks) for col in chunks[0].columns}
+    return [chunk.astype({col: dtype for col, dtype in dtypes.items() if chunk[col].dtype != dtype})
+            for chunk in chunks]
+
+
+def memory_report(chunks):
+    """
+    Compares the memory needed to hold fetal health data as float64 with compact_dtypes, one chunk at a time.
+    Also checks that the features trees see (float32) are identical either way.
+    :param chunks: Iterable of float64 Pandas DataFrames (see iter_fetal_data)
+    :return: Pandas DataFrame with dtype, float64_bytes and compact_bytes per column, and
+             Dictionary with rows, float64_bytes, compact_bytes, ratio and identical_features
+    """
+    rows = 0
+    dtypes = {}
+    float64_bytes = {}
+    compact_bytes = {}
+    identical = True
+    for chunk in chunks:
+        compact = compact_fetal_data(chunk)
+        rows += len(chunk)
+        for col in chunk.columns:
+            dtypes.setdefault(col, set()).add(compact[col].dtype)
+            float64_bytes[col] = float64_bytes.get(col, 0) + int(chunk[col].memory_usage(index=False, deep=True))
+            compact_bytes[col] = compact_bytes.get(col, 0) + int(compact[col].memory_usage(index=False, deep=True))
+        features = [col for col in feature_cols if col in chunk.columns]
+        identical = identical and np.array_equal(as_feature_array(chunk[features]),
+                                                 as_feature_array(compact[features]), equal_nan=True)
+
+    # A column that fell back to float32 in some chunks is float32 in all of them once the chunks are combined
+    for col, col_dtypes in dtypes.items():
+        dtypes[col] = common_compact_dtype(col_dtypes)
+        if len(col_dtypes) > 1:
+            compact_bytes[col] = rows * dtypes[col].itemsize
+        dtypes[col] = str(dtypes[col])
+
+    columns = pd.DataFrame({'dtype': dtypes, 'float64_bytes': float64_bytes, 'compact_bytes': compact_bytes})
+    total64, total = sum(float64_bytes.values()), sum(compact_bytes.values())
+    return columns, {'rows': rows,
+                     'float64_bytes': total64,
+                     'compact_bytes': total,
+                     'ratio': total64 / total if total > 0 else 0.0,
+                     'identical_features': identical}
+
+
+def iter_fetal_data(conn=None, columns=None, chunksize=CHUNK_SIZE, after_id=0, upto_id=None):
+    """
+    Streams rows of fetal_health table in id order, one page of at most chunksize rows at a time.
+    Pages are found by id (keyset pagination), so each page costs the same however deep into the table it is.
+    Rows covered by the loaded snapshot are read from it instead of the database.
+    :param conn: connection to SQLite DB (defaults to current connection)
+    :param columns: List of columns to read (defaults to db_cols)
+    :param chunksize: Number of rows per chunk
+    :param after_id: Only rows with a higher id are read
+    :param upto_id: Optional highest id to read
+    :return: Generator of float64 Pandas DataFrames indexed by id (missing values are NaN)
+    """
+    if conn is None:
+        conn = get_conn()
+    if columns is None:
+        columns = db_cols
+
+    snapshot = current_snapshot(conn)
+    if snapshot is not None and after_id < snapshot.last_id:
+        yield from iter_snapshot(snapshot, columns, chunksize, after_id,
+                                 snapshot.last_id if upto_id is None else min(upto_id, snapshot.last_id))
+        after_id = snapshot.last_id
+        if upto_id is not None and after_id >= upto_id:
+            return
+
+    query = "SELECT id, {} FROM fetal_health WHERE id > ?{} ORDER BY id LIMIT ?".format(
+        ', '.join(columns), '' if upto_id is None else ' AND id <= ?')
+
+    while True:
+        params = (after_id,) if upto_id is None else (after_id, upto_id)
+        rows = conn.execute(query, params + (chunksize,)).fetchall()
+        if len(rows) == 0:
+            return
+        values = np.array(rows, dtype=np.float64)
+        ids = values[:, 0].astype(np.int64)
+        after_id = int(ids[-1])
+        yield pd.DataFrame(values[:, 1:], index=pd.Index(ids, name='id'), columns=columns, copy=False)
+        if len(rows) < chunksize:
+            return
+
+
+def get_aggregates():
+    """
+    Loads dashboard aggregates on first use (see load_aggregates)
+    :return: Aggregates class with counts (array of rows per status, in fhs_values order) and
+             histograms (dictionary mapping each hist_bins column to an array of shape (statuses, bins))
+    """
+    if Aggregates.counts is None:
+        load_aggregates()
+    return Aggregates
+
+
+def load_aggregates(conn=None):
+    """
+    Reads per-status counts and histograms from the summary tables maintained by the database (creating them if
+    needed), so only a handful of rows are read. Falls back to computing them from the loaded data if the summary
+    tables can't be used.
+    :param conn: connection to SQLite DB (defaults to current connection)
     :return: None
     """
-    fetal_data = pd.read_sql("SELECT * from fetal_health", conn)
-    fetal_data.drop(columns=['id'], inplace=True)
-    Model.fetal_data = fetal_data
+    if conn is None:
+        conn = get_conn()
+    summary = None
+    if conn is not None and ensure_summary_tables(conn, hist_bins) == 1:
+        summary = read_summary_tables(conn)
+
+    if summary is None:
+        refresh_fetal_data(conn)
+        Aggregates.counts, Aggregates.histograms, Aggregates.moments = accumulate_aggregates(
+            iter_fetal_data(conn, upto_id=Model.last_id))
+        return
+
+    counts = np.zeros(len(fhs_values), dtype=np.int64)
+    for status, count in summary[0]:
+        if status in fhs_values:
+            counts[fhs_values.index(status)] = count
+    histograms = {col: np.zeros((len(fhs_values), len(bins) - 1), dtype=np.int64) for col, bins in hist_bins.items()}
+    for col, status, ind, count in summary[1]:
+        if col in histograms and status in fhs_values:
+            histograms[col][fhs_values.index(status), ind] = count
+    Aggregates.counts = counts
+    Aggregates.histograms = histograms
+
+
+def get_moments():
+    """
+    Computes correlation moments from the loaded data on first use, one chunk at a time; later batches of new rows
+    are merged in
+    :return: List of (rows, means, co-moments) per status over corr_cols
+    """
+    if Aggregates.moments is None:
+        conn = get_conn()
+        if Model.row_count is None:
+            load_fetal_data(conn)
+        moments = [empty_moments(len(corr_cols)) for _ in fhs_values]
+        for chunk in iter_fetal_data(conn, corr_cols, upto_id=Model.last_id):
+            moments = [merge_moments(old, new) for old, new in zip(moments, compute_status_moments(chunk))]
+        Aggregates.moments = moments
+    return Aggregates.moments
+
+
+def add_to_moments(df):
+    """
+    Adds rows to the correlation moments
+    :param df: Pandas DataFrame with fetal health data
+    :return: None
+    """
+    Aggregates.moments = [merge_moments(old, new) for old, new in zip(Aggregates.moments, compute_status_moments(df))]
+
+
+def compute_aggregates(df):
+    """
+    Counts rows per status, bins each hist_bins column per status (one bincount per column), and
+    accumulates the moments of corr_cols per status
+    :param df: Pandas DataFrame with fetal health data
+    :return: counts (array of rows per status), histograms (dictionary of arrays of shape (statuses, bins)),
+             moments (list of (rows, means, co-moments) per status)
+    """
+    labels = df['fetal_health'].to_numpy()
+    known = np.isin(labels, fhs_values)
+    status = np.searchsorted(fhs_values, labels)
+    counts = np.bincount(status[known], minlength=len(fhs_values))
+
+    histograms = {}
+    for col, bins in hist_bins.items():
+        values = df[col].to_numpy()
+        index = bin_index(values, bins.astype(values.dtype) if values.dtype.kind == 'f' else bins)
+        valid = known & (index >= 0)
+        n_bins = len(bins) - 1
+        flat = np.bincount(status[valid] * n_bins + index[valid], minlength=len(fhs_values) * n_bins)
+        histograms[col] = flat.reshape(len(fhs_values), n_bins)
+
+    return counts, histograms, compute_status_moments(df)
+
+
+def accumulate_aggregates(chunks):
+    """
+    Computes dashboard aggregates over a stream of chunks, holding only one chunk at a time
+    :param chunks: Iterable of Pandas DataFrames with fetal health data (see iter_fetal_data)
+    :return: counts, histograms, moments (see compute_aggregates)
+    """
+    counts = np.zeros(len(fhs_values), dtype=np.int64)
+    histograms = {col: np.zeros((len(fhs_values), len(bins) - 1), dtype=np.int64) for col, bins in hist_bins.items()}
+    moments = [empty_moments(len(corr_cols)) for _ in fhs_values]
+    for chunk in chunks:
+        chunk_counts, chunk_histograms, chunk_moments = compute_aggregates(chunk)
+        counts += chunk_counts
+        for col in histograms:
+            histograms[col] += chunk_histograms[col]
+        moments = [merge_moments(old, new) for old, new in zip(moments, chunk_moments)]
+    return counts, histograms, moments
+
+
+def compute_status_moments(df):
+    """
+    Computes the moments of corr_cols for each status, leaving out rows with missing values
+    :param df: Pandas DataFrame with fetal health data
+    :return: List of (rows, means, co-moments) per status
+    """
+    labels = df['fetal_health'].to_numpy()
+    values = df[corr_cols].to_numpy(dtype=np.float64)
+    complete = ~np.isnan(values).any(axis=1)
+    return [compute_moments(values[complete & (labels == status)]) for status in fhs_values]
+
+
+def empty_moments(n_cols):
+    """
+    Creates moments for zero rows
+    :param n_cols: Number of columns
+    :return: rows (0), means (zeros), co-moments (zero matrix)
+    """
+    return 0, np.zeros(n_cols), np.zeros((n_cols, n_cols))
+
+
+def compute_moments(values):
+    """
+    Computes the moments needed for a covariance or correlation matrix
+    :param values: float64 array (rows, columns) without missing values
+    :return: rows, means (array of column means), co-moments (matrix of summed products of deviations from the means)
+    """
+    if len(values) == 0:
+        return empty_moments(values.shape[1])
+    means = values.mean(axis=0)
+    deviations = values - means
+    return len(values), means, deviations.T @ deviations
+
+
+def merge_moments(a, b):
+    """
+    Combines the moments of two sets of rows (Chan et al. parallel update), so chunks can be accumulated in any order
+    :param a: rows, means, co-moments of the first set
+    :param b: rows, means, co-moments of the second set
+    :return: rows, means, co-moments of both sets
+    """
+    n_a, means_a, comoments_a = a
+    n_b, means_b, comoments_b = b
+    if n_b == 0:
+        return a
+    if n_a == 0:
+        return b
+    n = n_a + n_b
+    delta = means_b - means_a
+    means = means_a + delta * (n_b / n)
+    comoments = comoments_a + comoments_b + np.outer(delta, delta) * (n_a * n_b / n)
+    return n, means, comoments
+
+
+def get_correlation_matrix(status=None):
+    """
+    Reads the Pearson correlation matrix from the cached moments, without scanning the data
+    :param status: Fetal health status to correlate (None for all)
+    :return: Pandas DataFrame correlation matrix over corr_cols (NaN for constant columns)
+    """
+    moments = get_moments()
+    if status is None:
+        total = empty_moments(len(corr_cols))
+        for status_moments in moments:
+            total = merge_moments(total, status_moments)
+    else:
+        total = moments[fhs_values.index(status)]
 
+    comoments = total[2]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scale = np.sqrt(np.diag(comoments))
+        corr = comoments / np.outer(scale, scale)
+    corr = np.clip(corr, -1.0, 1.0)
+    np.fill_diagonal(corr, np.where(scale > 0, 1.0, np.nan))
+    return pd.DataFrame(corr, index=corr_cols, columns=corr_cols)
 
-def get_fetal_data():
+
+def bin_index(values, bins):
     """
-    :return: Pandas DataFrame with all loaded fetal health data
+    Finds the histogram bin of each value with the same edge rules as np.histogram and DataFrame.hist
+    (bins include their left edge, the last bin also includes its right edge)
+    :param values: Array of values
+    :param bins: Array of bin edges
+    :return: Array of bin indices, -1 for values outside the bins or missing
     """
-    return Model.fetal_data
+    index = np.searchsorted(bins, values, side='right') - 1
+    index[values == bins[-1]] = len(bins) - 2
+    index[(index < 0) | (index >= len(bins) - 1)] = -1
+    return index
 
 
-def load_model():
+def load_model(filepath=None):
     """
-    Loads current machine learning model for predicting fetal health status from .joblib file
+    Loads current machine learning model for predicting fetal health status from .joblib file.
+    The prediction engine is only replaced if it was compiled from another file, so the shared memory-mapped
+    engine of new_model.joblib (see load_engine) and the cached predictions made with it are kept.
+    :param filepath: Optional path to .joblib file (defaults to new_model.joblib next to this file)
     :return: None
     """
-    filename = 'new_model'
-    dirname = Path(__file__).parent.absolute()
-    suffix = ".joblib"
-    filepath = Path(dirname, filename).with_suffix(suffix)
-    if os.path.exists(filepath):
-        Model.model = load(filename=filepath)
+    from joblib import load
+    if filepath is None:
+        filepath = get_model_filepath('new_model')
+    if not os.path.exists(filepath):
+        return
+    Model.model = load(filename=filepath)
+
+    source = Path(filepath).resolve()
+    if source == get_model_filepath('new_model').resolve():
+        get_engine()
+    if Model.engine is None or Model.engine_source != source:
+        Model.engine = compile_forest(Model.model)
+        Model.engine_source = source
+        Model.version += 1
+
+
+def load_engine():
+    """
+    Loads the compiled prediction engine from new_model_engine.joblib with its arrays memory-mapped read-only,
+    so the file is paged in on demand and its pages are shared by every running instance of the application.
+    Compiles and saves the engine first if the file is missing or older than new_model.joblib.
+    Waits for the load started at launch instead of loading again if there is one (see preload_engine in forest.py).
+    :return: CompiledForest, or None if there is no model file
+    """
+    model_filepath = get_model_filepath('new_model')
+    engine_filepath = get_model_filepath('new_model_engine')
+
+    # Use the load main.py started when the application launched, if there is one
+    future = take_preloaded_engine(engine_filepath)
+    engine = future.result() if future is not None else load_engine_file(engine_filepath, model_filepath)
+    if engine is None:
+        return None
+
+    Model.engine = engine
+    Model.engine_source = model_filepath.resolve()
+    Model.version += 1
+    return engine
+
+
+def load_model_async():
+    """
+    Starts loading the prediction engine on a background thread so screens can be shown while it loads
+    :return: Future resolving to the CompiledForest
+    """
+    executor = ThreadPoolExecutor(max_workers=1)
+    Model.engine_future = executor.submit(load_engine)
+    executor.shutdown(wait=False)
+    return Model.engine_future
+
+
+def engine_ready():
+    """
+    :return: True if predictions can be made without waiting for the engine to load
+    """
+    return Model.engine is not None or Model.engine_future is None or Model.engine_future.done()
 
 
 def get_model():
     """
+    Loads the full scikit-learn model on first use (predictions only need the compiled engine)
     :return: Current machine learning model used for predicting fetal health status
     """
+    if Model.model is None:
+        load_model()
     return Model.model
 
 
+def get_engine():
+    """
+    Waits for background loading to finish if it is still in progress. Logs error if loading failed.
+    :return: Compiled flat-array version of the current model (see forest.py), used for fast predictions
+    """
+    if Model.engine is None:
+        if Model.engine_future is None:
+            load_model_async()
+        try:
+            Model.engine_future.result()
+        except Exception as exc:
+            log_error(exc, 'load_model')
+    return Model.engine
+
+
+def prediction_keys(X):
+    """
+    Builds prediction cache keys from feature values. Trees compare features as float32, so rows are keyed by their
+    float32 bytes (with -0.0 folded into 0.0): rows that round to the same values always get the same prediction.
+    :param X: float32 array (n_rows, n_features)
+    :return: List of (model version, bytes) keys
+    """
+    X = X + np.float32(0.0)
+    return [(Model.version, row.tobytes()) for row in X]
+
+
+def predict_proba_cached(X):
+    """
+    Predicts class probabilities with the current model, answering repeated rows from the prediction cache.
+    Rows not in the cache are predicted together in one call (duplicates within X only once).
+    :param X: DataFrame, 2D array, or single row of features in feature_cols order
+    :return: float64 array (n_rows, n_classes), or None if no model could be loaded
+    """
+    engine = get_engine()
+    if engine is None:
+        return None
+
+    X = as_feature_array(X)
+    keys = prediction_keys(X)
+    proba = np.empty((len(X), len(engine.classes_)))
+    missing = {}
+    for ind, key in enumerate(keys):
+        cached = Model.prediction_cache.get(key)
+        if cached is None:
+            missing.setdefault(key, []).append(ind)
+        else:
+            proba[ind] = cached
+
+    if len(missing) > 0:
+        rows = [positions[0] for positions in missing.values()]
+
+        # The compiled engine is fastest for a few rows, scikit-learn for large batches if it is already loaded
+        predictor = Model.model if Model.model is not None and len(rows) > BLOCK_SIZE else engine
+        predicted = predictor.predict_proba(X[rows])
+        for (key, positions), row_proba in zip(missing.items(), predicted):
+            proba[positions] = row_proba
+            # Copy, so the cache doesn't keep the whole predicted batch alive
+            Model.prediction_cache.put(key, row_proba.copy())
+    return proba
+
+
+def predict_cached(X):
+    """
+    Predicts fetal health status with the current model, answering repeated rows from the prediction cache
+    :param X: DataFrame, 2D array, or single row of features in feature_cols order
+    :return: Array of predicted statuses, or None if no model could be loaded
+    """
+    proba = predict_proba_cached(X)
+    if proba is None:
+        return None
+    return get_engine().classes_[np.argmax(proba, axis=1)]
+
+
+def get_cache_stats():
+    """
+    :return: Dictionary with prediction cache size, hits, misses, evictions, expirations and hit_rate
+    """
+    return Model.prediction_cache.stats()
+
+
 # Functions
-def split_data():
+def split_data(conn=None, chunksize=CHUNK_SIZE):
     """
-    Prepares pre-loaded data for training and evaluating models
+    Prepares loaded data for training and evaluating models, streaming it from the database in chunks.
+    Rows are written straight to their place in one preallocated float32 array (the precision trees are grown on)
+    with the training rows first, so the splits are views of it and the table is never held as a DataFrame.
+    The split is the same as train_test_split on the whole table.
+    :param conn: connection to SQLite DB (defaults to current connection)
+    :param chunksize: Number of rows read at a time
     :return: X_train, X_test, y_train, y_test
-    Lists of datasets split into features (X) and labels (y) with 80% train data and 20% test data.
+    Arrays of features (X) and labels (y) with 80% train data and 20% test data.
+    :raises ConnectionError: If no connection is given and none was started
     """
-    df = get_fetal_data()
-    X = df.drop("fetal_health", axis=1)
-    y = df["fetal_health"]
-    random_state = 42
+    if conn is None:
+        conn = get_conn()
+    if conn is None:
+        raise ConnectionError('No database connection to read fetal health data from')
+    if Model.row_count is None:
+        load_fetal_data(conn)
     np.random.seed(42)
 
-    return train_test_split(X,
-                            y,
-                            test_size=0.2,
-                            random_state=random_state)
+    # Count and read in one transaction, so rows inserted meanwhile can't change the split
+    own_transaction = not conn.in_transaction
+    if own_transaction:
+        conn.execute('BEGIN')
+    try:
+        n_rows = count_rows(conn, Model.last_id, current_snapshot(conn))
+        train_index, test_index = split_positions(n_rows)
+        position = np.empty(n_rows, dtype=np.intp)
+        position[np.concatenate([train_index, test_index])] = np.arange(n_rows)
+
+        X = np.empty((n_rows, len(feature_cols)), dtype=np.float32)
+        y = np.empty(n_rows, dtype=np.float64)
+        start = 0
+        for chunk in iter_fetal_data(conn, chunksize=chunksize, upto_id=Model.last_id):
+            rows = position[start:start + len(chunk)]
+            X[rows] = chunk[feature_cols].to_numpy()
+            y[rows] = chunk['fetal_health'].to_numpy()
+            start += len(chunk)
+    finally:
+        if own_transaction:
+            conn.execute('COMMIT')
 
+    n_train = len(train_index)
+    return X[:n_train], X[n_train:], y[:n_train], y[n_train:]
 
-def tune_hyperparameters():
+
+def split_positions(n_rows):
+    """
+    :param n_rows: Number of loaded rows
+    :return: train_index, test_index: positions (in id order) of the rows split_data puts in the training and test
+             splits, in the order it returns them
+    """
+    from sklearn.model_selection import train_test_split
+    return train_test_split(np.arange(n_rows), test_size=0.2, random_state=42)
+
+
+def tune_hyperparameters(n_jobs=None):
     """
     Sets up a hyperparameter grid search for RandomForestClassifier using optimal settings from previous experimentation
+    :param n_jobs: Number of processes for GridSearchCV (None runs serially)
     :return: GridSearchCV estimators
     """
-
-    rf_grid = {"n_estimators": np.arange(460, 910, 50),
-               "max_depth": [None],
-               "min_samples_split": [2, 8, 14],
-               "min_samples_leaf": [1]}
+    from sklearn.model_selection import GridSearchCV
+    from sklearn.ensemble import RandomForestClassifier
 
     gs_rf = GridSearchCV(RandomForestClassifier(),
                          param_grid=rf_grid,
-                         cv=5,
+                         cv=CV_FOLDS,
                          scoring='f1_macro',
+                         n_jobs=n_jobs,
                          verbose=True)
 
     return gs_rf
 
 
-def train_model():
+def get_n_jobs(n_jobs):
+    """
+    :param n_jobs: Number of processes, or -1 for all cores
+    :return: Positive number of processes
+    """
+    if n_jobs is None or n_jobs < 0:
+        return os.cpu_count() or 1
+    return max(1, n_jobs)
+
+
+def current_memory():
+    """
+    :return: Resident memory of this process in bytes, or None if it can't be read on this system
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return psutil.Process().memory_info().rss
+
+
+@contextmanager
+def measure(measurements, name):
+    """
+    Measures wall time, CPU time (of every thread in this process) and peak resident memory of a block of code.
+    Memory is sampled every MEMORY_SAMPLE_INTERVAL seconds on a background thread.
+    :param measurements: List the measurement is appended to when the block ends
+    :param name: Name of the measured phase or candidate
+    :return: Context manager yielding the measurement dictionary (name, seconds, cpu_seconds, start_memory and
+             peak_memory in bytes: resident memory when the block starts and its peak increase over that during the
+             block, or None if memory can't be read), filled in when the block ends
+    """
+    measurement = {'name': name}
+    start_memory = current_memory()
+    peak = [start_memory]
+    stop_event = threading.Event()
+
+    def sample():
+        while not stop_event.wait(MEMORY_SAMPLE_INTERVAL):
+            memory = current_memory()
+            if memory is not None and (peak[0] is None or memory > peak[0]):
+                peak[0] = memory
+
+    sampler = None
+    if peak[0] is not None:
+        sampler = threading.Thread(target=sample, daemon=True)
+        sampler.start()
+    start, cpu_start = time.perf_counter(), time.process_time()
+    try:
+        yield measurement
+    finally:
+        measurement['seconds'] = time.perf_counter() - start
+        measurement['cpu_seconds'] = time.process_time() - cpu_start
+        stop_event.set()
+        if sampler is not None:
+            sampler.join()
+            memory = current_memory()
+            peak[0] = max(peak[0], memory) if memory is not None else peak[0]
+        measurement['start_memory'] = start_memory
+        measurement['peak_memory'] = None if start_memory is None else max(0, peak[0] - start_memory)
+        measurements.append(measurement)
+
+
+def share_training_data(X, y, folder):
+    """
+    Writes training data to a file that search processes memory-map (see SharedData)
+    :param X: Features (DataFrame or array)
+    :param y: Labels (Series or array)
+    :param folder: Directory to write the file to
+    :return: Path to file
+    """
+    from joblib import dump
+    # Trees are grown on float32 features, so converting once here saves a copy in every fit
+    filepath = Path(folder, 'training_data').with_suffix('.joblib')
+    dump((np.ascontiguousarray(X, dtype=np.float32), np.asarray(y)), filepath)
+    return filepath
+
+
+def init_search_worker(filepath, cv=CV_FOLDS):
+    """
+    Loads shared training data and splits it into the same stratified folds GridSearchCV uses
+    :param filepath: Path written by share_training_data
+    :param cv: Number of cross-validation folds
+    :return: None
+    """
+    from joblib import load
+    from sklearn.model_selection import StratifiedKFold
+    SharedData.X, SharedData.y = load(filename=filepath, mmap_mode='r')
+    SharedData.folds = list(StratifiedKFold(n_splits=cv).split(SharedData.X, SharedData.y))
+
+
+def fit_candidate(task):
+    """
+    Fits one hyperparameter candidate on one cross-validation fold of the shared training data
+    :param task: Tuple of (candidate index, parameter dictionary, fold index)
+    :return: Dictionary with scores (list of (candidate, fold, macro avg F1-score)), trees built, seconds and
+             costs (list of measurements named by candidate index, see measure)
+    """
+    from sklearn.ensemble import RandomForestClassifier
+    from sklearn.metrics import f1_score
+    candidate, params, fold = task
+    train_index, test_index = SharedData.folds[fold]
+
+    costs = []
+    with measure(costs, candidate):
+        rf = RandomForestClassifier(**params)
+        rf.fit(SharedData.X[train_index], SharedData.y[train_index])
+        y_preds = rf.predict(SharedData.X[test_index])
+        score = f1_score(SharedData.y[test_index], y_preds, average='macro')
+
+    return {'scores': [(candidate, fold, score)],
+            'trees': len(rf.estimators_),
+            'seconds': costs[0]['seconds'],
+            'costs': costs}
+
+
+def grow_candidates(task):
+    """
+    Grows one forest with warm_start through every n_estimators checkpoint, scoring it at each checkpoint.
+    Each checkpoint only adds the trees missing since the previous one instead of refitting from scratch.
+    :param task: Tuple of (candidate indices, parameter dictionary without n_estimators, fold index, checkpoints).
+                 A fold index of None grows on all shared data and scores with out-of-bag estimates instead.
+    :return: Dictionary with scores (list of (candidate, fold, macro avg F1-score)), trees built, seconds and
+             costs (list of measurements named by candidate index, see measure; each checkpoint only costs
+             the trees it adds)
+    """
+    from sklearn.ensemble import RandomForestClassifier
+    from sklearn.metrics import f1_score
+    candidates, params, fold, checkpoints = task
+
+    if fold is None:
+        X_fit, y_fit = SharedData.X, SharedData.y
+    else:
+        train_index, test_index = SharedData.folds[fold]
+        X_fit, y_fit = SharedData.X[train_index], SharedData.y[train_index]
+        X_val, y_val = SharedData.X[test_index], SharedData.y[test_index]
+
+    start = time.perf_counter()
+    rf = RandomForestClassifier(warm_start=True, oob_score=fold is None, **params)
+    scores = []
+    costs = []
+    for candidate, n_estimators in zip(candidates, checkpoints):
+        with measure(costs, candidate):
+            rf.set_params(n_estimators=n_estimators)
+            rf.fit(X_fit, y_fit)
+            if fold is None:
+                y_preds = rf.classes_[np.argmax(rf.oob_decision_function_, axis=1)]
+                scores.append((candidate, 0, f1_score(y_fit, y_preds, average='macro')))
+            else:
+                y_preds = rf.predict(X_val)
+                scores.append((candidate, fold, f1_score(y_val, y_preds, average='macro')))
+
+    return {'scores': scores,
+            'trees': len(rf.estimators_),
+            'seconds': time.perf_counter() - start,
+            'costs': costs}
+
+
+def search_tasks(candidates, mode, cv):
+    """
+    Splits a hyperparameter search into independent tasks for the process pool
+    :param candidates: List of candidate dictionaries (see search_hyperparameters)
+    :param mode: 'grid' fits every (candidate, fold) from scratch,
+                 'incremental' grows one forest per (other parameters, fold) through the n_estimators values,
+                 'oob' grows one forest per other parameters on all data and scores it out-of-bag
+    :param cv: Number of cross-validation folds
+    :return: Worker function and list of tasks
+    """
+    if mode == 'grid':
+        return fit_candidate, [(index, candidate['params'], fold)
+                               for index, candidate in enumerate(candidates) for fold in range(cv)]
+
+    # Group candidates that only differ by n_estimators, ordered by n_estimators
+    groups = {}
+    for index, candidate in enumerate(candidates):
+        params = {key: value for key, value in candidate['params'].items() if key != 'n_estimators'}
+        group = groups.setdefault(repr(sorted(params.items())), {'params': params, 'candidates': []})
+        group['candidates'].append((candidate['params']['n_estimators'], index))
+
+    tasks = []
+    folds = [None] if mode == 'oob' else range(cv)
+    for group in groups.values():
+        group['candidates'].sort()
+        checkpoints = [n_estimators for n_estimators, index in group['candidates']]
+        indices = [index for n_estimators, index in group['candidates']]
+        for fold in folds:
+            tasks.append((indices, group['params'], fold, checkpoints))
+    return grow_candidates, tasks
+
+
+def search_hyperparameters(X, y, param_grid=None, cv=CV_FOLDS, n_jobs=N_JOBS, mode='grid', progress=None,
+                           cancel_event=None):
+    """
+    Cross-validates every candidate in the hyperparameter grid, spreading the fits over a process pool.
+    Scores candidates by macro avg F1-score like tune_hyperparameters, without refitting the best one.
+    :param X: Training features
+    :param y: Training labels
+    :param param_grid: Dictionary of parameter lists (defaults to rf_grid)
+    :param cv: Number of cross-validation folds
+    :param n_jobs: Number of processes (-1 uses all cores, 1 runs in this process unless cancel_event is given)
+    :param mode: 'grid', 'incremental' or 'oob' (see search_tasks)
+    :param progress: Optional function called with a dictionary of fraction, folds_done, folds_total,
+                     candidates_done, candidates_total, best_score and eta (seconds) after each task
+    :param cancel_event: Optional threading.Event; setting it stops the search and terminates the pool
+    :return: Dictionary with best_params, best_score, candidates (params, mean_score, fold_scores, and the
+             seconds, cpu_seconds and peak_memory summed or maxed over their fits), trees (total trees built),
+             seconds, worker_cpu_seconds (CPU time of the pool processes), n_jobs and mode, or None if cancelled
+    """
+    from sklearn.model_selection import ParameterGrid
+    if param_grid is None:
+        param_grid = rf_grid
+    n_jobs = get_n_jobs(n_jobs)
+
+    n_scores = 1 if mode == 'oob' else cv
+    candidates = [{'params': {key: (value.item() if hasattr(value, 'item') else value)
+                              for key, value in params.items()},
+                   'fold_scores': [None] * n_scores, 'seconds': 0.0, 'cpu_seconds': 0.0, 'peak_memory': None}
+                  for params in ParameterGrid(param_grid)]
+    worker, tasks = search_tasks(candidates, mode, cv)
+
+    start = time.perf_counter()
+    trees = 0
+    worker_cpu_seconds = 0.0
+    folds_done = 0
+    best_score = None
+    pool = None
+    folder = tempfile.mkdtemp()
+    try:
+        filepath = share_training_data(X, y, folder)
+
+        # A pool can be terminated mid-fit, so use one whenever the search may be cancelled
+        if n_jobs == 1 and cancel_event is None:
+            init_search_worker(filepath, cv)
+            results = map(worker, tasks)
+        else:
+            pool = Pool(processes=min(n_jobs, len(tasks)), initializer=init_search_worker, initargs=(filepath, cv))
+            results = pool.imap_unordered(worker, tasks)
+
+        for tasks_done in range(1, len(tasks) + 1):
+            result = None
+            while result is None:
+                if cancel_event is not None and cancel_event.is_set():
+                    return None
+                try:
+                    result = results.next(timeout=POLL_INTERVAL) if pool is not None else next(results)
+                except TimeoutError:
+                    pass
+
+            trees += result['trees']
+            for cost in result['costs']:
+                candidate = candidates[cost['name']]
+                candidate['seconds'] += cost['seconds']
+                candidate['cpu_seconds'] += cost['cpu_seconds']
+                if cost['peak_memory'] is not None:
+                    candidate['peak_memory'] = max(candidate['peak_memory'] or 0, cost['peak_memory'])
+                if pool is not None:
+                    worker_cpu_seconds += cost['cpu_seconds']
+            for candidate, fold, score in result['scores']:
+                candidates[candidate]['fold_scores'][fold] = score
+                folds_done += 1
+                if None not in candidates[candidate]['fold_scores']:
+                    mean_score = float(np.mean(candidates[candidate]['fold_scores']))
+                    best_score = mean_score if best_score is None else max(best_score, mean_score)
+
+            if progress is not None:
+                elapsed = time.perf_counter() - start
+                progress({'fraction': tasks_done / len(tasks),
+                          'folds_done': folds_done,
+                          'folds_total': len(candidates) * n_scores,
+                          'candidates_done': sum(None not in candidate['fold_scores'] for candidate in candidates),
+                          'candidates_total': len(candidates),
+                          'best_score': best_score,
+                          'eta': elapsed / tasks_done * (len(tasks) - tasks_done)})
+    finally:
+        if pool is not None:
+            pool.terminate()
+        SharedData.X = SharedData.y = SharedData.folds = None
+        shutil.rmtree(folder, ignore_errors=True)
+
+    # Ties go to the first candidate in grid order, as in GridSearchCV
+    for candidate in candidates:
+        candidate['mean_score'] = float(np.mean(candidate['fold_scores']))
+    best = max(candidates, key=lambda candidate: candidate['mean_score'])
+
+    return {'best_params': best['params'],
+            'best_score': best['mean_score'],
+            'candidates': candidates,
+            'trees': trees,
+            'seconds': time.perf_counter() - start,
+            'worker_cpu_seconds': worker_cpu_seconds,
+            'n_jobs': n_jobs,
+            'mode': mode}
+
+
+def train_model(n_jobs=N_JOBS, mode='grid', progress=None, cancel_event=None, plot=True):
     """
     Trains two RandomForest models and compares their macro avg F1-scores to determine the model with best performance
-    :return: estimator with highest macro avg F1-score
+    :param n_jobs: Number of processes used for hyperparameter search and tree building (-1 uses all cores)
+    :param mode: Hyperparameter search mode: 'grid', 'incremental' or 'oob' (see search_tasks)
+    :param progress: Optional function called with a dictionary describing progress; always has phase and
+                     fraction (of the whole training), plus the search_hyperparameters keys while tuning
+    :param cancel_event: Optional threading.Event; setting it stops training as soon as possible
+    :param plot: Set False to skip plotting the confusion matrix (e.g. when training off the GUI thread, which plots
+                 the matrix saved with the model; see plot_model_confusion_matrix)
+    :return: estimator with highest macro avg F1-score and its report, or None, None if cancelled
     """
 
+    def report(phase, fraction, details=None):
+        if progress is not None:
+            info = dict(details or {})
+            info.update({'phase': phase, 'fraction': fraction})
+            progress(info)
+
+    # Wall time, CPU time and peak memory of each phase, saved with the model (see set_training_info)
+    phases = []
+
     # Split Data
-    X_train, X_test, y_train, y_test = split_data()
+    report('Splitting data', 0.0)
+    with measure(phases, 'split_data'):
+        X_train, X_test, y_train, y_test = split_data()
 
-    # Train and Evaluate tuned model
-    gs_rf = tune_hyperparameters()
-    gs_rf.fit(X_train, y_train)
-    hyper_scores = evaluate_model(gs_rf, X_test, y_test)
+    # Tune hyperparameters (80% of the work), then train and evaluate tuned model on all training data
+    with measure(phases, 'search_hyperparameters'):
+        search = search_hyperparameters(X_train, y_train, n_jobs=n_jobs, mode=mode, cancel_event=cancel_event,
+                                        progress=lambda details: report('Tuning hyperparameters',
+                                                                        0.8 * details['fraction'], details))
+    if search is None:
+        return None, None
+    phases[-1]['cpu_seconds'] += search['worker_cpu_seconds']
+
+    report('Training tuned model', 0.8)
+    with measure(phases, 'fit_tuned_model'):
+        tuned_rf = fit_forest(X_train, y_train, search['best_params'], n_jobs, cancel_event)
+    if tuned_rf is None:
+        return None, None
+    with measure(phases, 'evaluate_tuned_model'):
+        hyper_scores = evaluate_model(tuned_rf, X_test, y_test)
 
     # Evaluate base model
-    rf = RandomForestClassifier()
-    rf.fit(X_train, y_train)
-    base_scores = evaluate_model(rf, X_test, y_test)
+    report('Training base model', 0.9)
+    with measure(phases, 'fit_base_model'):
+        rf = fit_forest(X_train, y_train, {}, n_jobs, cancel_event)
+    if rf is None:
+        return None, None
+    with measure(phases, 'evaluate_base_model'):
+        base_scores = evaluate_model(rf, X_test, y_test)
+    report('Complete', 1.0)
+
+    # Compare base model to tuned model, then return best model with report
+    if base_scores['macro avg']['f1-score'] >= hyper_scores['macro avg']['f1-score']:
+        model, scores = rf, base_scores
+    else:
+        model, scores = tuned_rf, hyper_scores
+
+    # Count predictions on the test split for the confusion matrix, then prepare it for display
+    with measure(phases, 'confusion_matrix'):
+        matrix = get_confusion_matrix(model, X_test, y_test)
+    if plot:
+        with measure(phases, 'plot_confusion_matrix'):
+            plot_model_confusion_matrix(model, matrix)
+
+    candidates = [{key: candidate[key] for key in ('params', 'mean_score', 'seconds', 'cpu_seconds', 'peak_memory')}
+                  for candidate in search['candidates']]
+    set_training_info(model, 'train', {'phases': phases, 'candidates': candidates, 'search_mode': mode,
+                                       'n_jobs': search['n_jobs'], 'confusion_matrix': matrix})
+    return model, scores
+
+
+def plot_model_confusion_matrix(model, matrix=None):
+    """
+    Prepares a confusion matrix of the model's predictions on test data for display with plt.show()
+    :param model: Estimator
+    :param matrix: Confusion matrix from get_confusion_matrix (defaults to the one saved with the model by
+                   train_model or update_model, or else one computed on the test split of the loaded data)
+    :return: None
+    """
+    import matplotlib.pyplot as plt
+    from sklearn.metrics import ConfusionMatrixDisplay
+    if matrix is None:
+        matrix = get_training_info(model).get('confusion_matrix')
+    if matrix is None:
+        X_train, X_test, y_train, y_test = split_data()
+        matrix = get_confusion_matrix(model, X_test, y_test)
 
     # Prevent previous graphs and figures from displaying before displaying confusion matrix
     plt.close('all')
+    ConfusionMatrixDisplay(np.array(matrix), display_labels=['Normal', 'Suspect', 'Pathologic']).plot()
 
-    # Compare base model to tuned model, then prepare confusion matrix for display and return best model with report
-    if base_scores['macro avg']['f1-score'] >= hyper_scores['macro avg']['f1-score']:
-        plot_confusion_matrix(rf, X_test, y_test, display_labels=['Normal', 'Suspect', 'Pathologic'])
-        return rf, base_scores
+
+def fit_forest(X, y, params, n_jobs=N_JOBS, cancel_event=None):
+    """
+    Fits a RandomForestClassifier, building trees on several threads.
+    If cancel_event is given, the forest is grown GROWTH_STEP trees at a time so it can stop between steps.
+    :param X: Training features
+    :param y: Training labels
+    :param params: Dictionary of RandomForestClassifier parameters
+    :param n_jobs: Number of threads (-1 uses all cores)
+    :param cancel_event: Optional threading.Event; setting it stops fitting
+    :return: Fitted estimator (set back to single-threaded prediction), or None if cancelled
+    """
+    from sklearn.ensemble import RandomForestClassifier
+    rf = RandomForestClassifier(**params, n_jobs=n_jobs)
+    if cancel_event is None:
+        rf.fit(X, y)
     else:
-        plot_confusion_matrix(gs_rf, X_test, y_test, display_labels=['Normal', 'Suspect', 'Pathologic'])
-        return gs_rf, hyper_scores
+        n_estimators = rf.n_estimators
+        rf.set_params(warm_start=True)
+        for step in range(GROWTH_STEP, n_estimators + GROWTH_STEP, GROWTH_STEP):
+            if cancel_event.is_set():
+                return None
+            rf.set_params(n_estimators=min(step, n_estimators))
+            rf.fit(X, y)
+        rf.set_params(warm_start=False)
+    rf.set_params(n_jobs=None)
+    return rf
+
+
+def set_training_info(model, method, profile=None):
+    """
+    Records which rows of the fetal_health table a model has been trained on; saved with the model by joblib
+    :param model: Estimator
+    :param method: 'train' or 'update'
+    :param profile: Optional dictionary of training measurements (phases, candidates, ...; see train_model)
+    :return: None
+    """
+    model.training_info_ = {'last_id': Model.last_id,
+                            'rows': Model.row_count,
+                            'method': method,
+                            'trained_at': datetime.datetime.now().isoformat(timespec='seconds')}
+    if profile is not None:
+        model.training_info_.update(profile)
+
+
+def get_training_info(model):
+    """
+    :param model: Estimator
+    :return: Dictionary recorded by set_training_info (empty for models saved before it existed)
+    """
+    return getattr(model, 'training_info_', {})
+
+
+def format_training_profile(info):
+    """
+    Describes where training time and memory went, for display next to the model's report
+    :param info: Dictionary recorded by set_training_info
+    :return: String with one line per phase and the slowest candidates, or '' if the model has no profile
+    """
+    if 'phases' not in info:
+        return ''
+
+    def format_memory(memory):
+        return 'n/a' if memory is None else '+{:.0f} MB'.format(memory / 1e6)
+
+    lines = ['{:<24}{:>10}{:>10}{:>12}'.format('Phase', 'Wall', 'CPU', 'Peak memory')]
+    for phase in info['phases']:
+        lines.append('{:<24}{:>9.2f}s{:>9.2f}s{:>12}'.format(phase['name'], phase['seconds'], phase['cpu_seconds'],
+                                                             format_memory(phase['peak_memory'])))
+    lines.append('{:<24}{:>9.2f}s{:>9.2f}s'.format('Total', sum(phase['seconds'] for phase in info['phases']),
+                                                  sum(phase['cpu_seconds'] for phase in info['phases'])))
+
+    candidates = sorted(info.get('candidates', []), key=lambda candidate: candidate['seconds'], reverse=True)
+    if candidates:
+        # Label candidates by the parameters that differ between them
+        varied = [key for key in candidates[0]['params']
+                  if len({repr(candidate['params'][key]) for candidate in candidates}) > 1]
+        lines.append('')
+        lines.append('Slowest of {} candidates ({} search, summed over folds)'.format(
+            len(candidates), info.get('search_mode', 'grid')))
+        for candidate in candidates[:PROFILE_CANDIDATES]:
+            lines.append('  ' + ', '.join('{}={}'.format(key, candidate['params'][key]) for key in varied))
+            lines.append('{:<24}{:>9.2f}s{:>9.2f}s{:>12}'.format('  F1 {:.3f}'.format(candidate['mean_score']),
+                                                                 candidate['seconds'], candidate['cpu_seconds'],
+                                                                 format_memory(candidate['peak_memory'])))
+    return '\n'.join(lines)
+
+
+def count_new_rows(model, conn):
+    """
+    Counts rows inserted into the fetal_health table since the model was trained
+    :param model: Estimator
+    :param conn: Connection to SQLite DB
+    :return: Number of rows
+    """
+    cursor = conn.cursor()
+    cursor.execute("SELECT COUNT(*) FROM fetal_health WHERE id > ?", (get_training_info(model).get('last_id', 0),))
+    return cursor.fetchone()[0]
+
+
+def select_update_rows(model, y_train, n_rows, conn, sample_rows=UPDATE_SAMPLE_ROWS, random_state=42):
+    """
+    Picks the training rows the new trees of an update are grown on: every training row inserted since the model was
+    trained, plus a sample of older training rows drawn from each class in proportion to its size
+    :param model: Estimator being updated
+    :param y_train: Training labels from split_data
+    :param n_rows: Number of loaded rows (training and test)
+    :param conn: Connection to SQLite DB
+    :param sample_rows: Number of older training rows to sample
+    :param random_state: Seed of the sample
+    :return: Sorted array of indices into the training split
+    """
+    cursor = conn.cursor()
+    cursor.execute("SELECT COUNT(*) FROM fetal_health WHERE id > ? AND id <= ?",
+                   (get_training_info(model).get('last_id', 0), Model.last_id))
+
+    # Rows are split in id order, so rows inserted since training are the last positions
+    train_index, test_index = split_positions(n_rows)
+    new = train_index >= n_rows - cursor.fetchone()[0]
+    old = np.flatnonzero(~new)
+
+    rng = np.random.default_rng(random_state)
+    picked = [np.flatnonzero(new)]
+    for label in np.unique(y_train[old]):
+        rows = old[y_train[old] == label]
+        count = max(1, int(round(min(sample_rows, len(old)) * len(rows) / len(old))))
+        picked.append(rng.choice(rows, min(count, len(rows)), replace=False))
+    return np.sort(np.concatenate(picked))
+
+
+def refresh_forest(model, X, y, n_trees=UPDATE_TREES, n_jobs=N_JOBS, cancel_event=None):
+    """
+    Replaces the oldest trees of a forest with trees grown on the given data, keeping the forest the same size.
+    Trees are appended in fit order, so repeated refreshes gradually turn over the whole forest.
+    New trees are grown GROWTH_STEP at a time, so setting cancel_event stops between steps.
+    :param model: RandomForestClassifier (or GridSearchCV wrapping one); left unchanged
+    :param X: Training features
+    :param y: Training labels
+    :param n_trees: Number of trees to replace
+    :param n_jobs: Number of threads (-1 uses all cores)
+    :param cancel_event: Optional threading.Event; setting it stops the refresh
+    :return: Updated copy of the RandomForestClassifier, or None if cancelled
+    """
+    forest = copy.deepcopy(getattr(model, 'best_estimator_', model))
+    n_estimators = len(forest.estimators_)
+    n_trees = min(n_trees, n_estimators)
+
+    forest.set_params(warm_start=True, n_jobs=n_jobs)
+    for step in range(GROWTH_STEP, n_trees + GROWTH_STEP, GROWTH_STEP):
+        if cancel_event is not None and cancel_event.is_set():
+            return None
+        forest.set_params(n_estimators=n_estimators + min(step, n_trees))
+        forest.fit(X, y)
+    forest.estimators_ = forest.estimators_[n_trees:]
+    forest.set_params(warm_start=False, n_estimators=n_estimators, n_jobs=None)
+    return forest
+
+
+def update_model(n_trees=UPDATE_TREES, n_jobs=N_JOBS, conn=None, cancel_event=None):
+    """
+    Refreshes the current model with rows inserted since it was trained, without a hyperparameter search.
+    Reloads the data and replaces n_trees of the oldest trees with trees grown on the new training rows plus a sample
+    of older ones (see select_update_rows), so the cost of fitting doesn't grow with the table.
+    Evaluates on the test split of all current data, like train_model.
+    :param n_trees: Number of trees to replace
+    :param n_jobs: Number of threads (-1 uses all cores)
+    :param conn: Connection to SQLite DB (defaults to current connection)
+    :param cancel_event: Optional threading.Event; setting it stops the update as soon as possible
+    :return: Updated estimator and its report, or None, None if there is no model, no new rows or it was cancelled
+    """
+    model = get_model()
+    if conn is None:
+        conn = get_conn()
+    if model is None or count_new_rows(model, conn) == 0:
+        return None, None
+
+    phases = []
+    with measure(phases, 'refresh_fetal_data'):
+        refresh_fetal_data(conn)
+    with measure(phases, 'split_data'):
+        X_train, X_test, y_train, y_test = split_data(conn)
+    with measure(phases, 'select_update_rows'):
+        rows = select_update_rows(model, y_train, len(y_train) + len(y_test), conn)
+    with measure(phases, 'refresh_forest'):
+        updated = refresh_forest(model, X_train[rows], y_train[rows], n_trees, n_jobs, cancel_event)
+    if updated is None:
+        return None, None
+    with measure(phases, 'evaluate_model'):
+        scores = evaluate_model(updated, X_test, y_test)
+    with measure(phases, 'confusion_matrix'):
+        matrix = get_confusion_matrix(updated, X_test, y_test)
+    set_training_info(updated, 'update', {'phases': phases, 'confusion_matrix': matrix, 'update_rows': len(rows)})
+    return updated, scores
+
+
+def compare_update_to_retrain(n_trees=UPDATE_TREES, n_jobs=N_JOBS):
+    """
+    Checks an update of the current model against refitting a forest with the same hyperparameters from scratch on
+    the training split of the loaded data (a full train_model also repeats the hyperparameter search). The update
+    grows its trees on the rows update_model would use (see select_update_rows).
+    :param n_trees: Number of trees to replace
+    :param n_jobs: Number of threads (-1 uses all cores)
+    :return: Dictionary with update_seconds, retrain_seconds, speedup, update_f1, retrain_f1 and f1_difference
+    """
+    model = getattr(get_model(), 'best_estimator_', get_model())
+    X_train, X_test, y_train, y_test = split_data()
+    params = {key: value for key, value in model.get_params().items()
+              if key in ('n_estimators', 'max_depth', 'min_samples_split', 'min_samples_leaf')}
+
+    start = time.perf_counter()
+    rows = select_update_rows(get_model(), y_train, len(y_train) + len(y_test), get_conn())
+    updated = refresh_forest(model, X_train[rows], y_train[rows], n_trees, n_jobs)
+    update_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    retrained = fit_forest(X_train, y_train, params, n_jobs)
+    retrain_seconds = time.perf_counter() - start
+
+    update_f1 = evaluate_model(updated, X_test, y_test)['macro avg']['f1-score']
+    retrain_f1 = evaluate_model(retrained, X_test, y_test)['macro avg']['f1-score']
+    return {'update_seconds': update_seconds,
+            'retrain_seconds': retrain_seconds,
+            'speedup': retrain_seconds / update_seconds,
+            'update_f1': update_f1,
+            'retrain_f1': retrain_f1,
+            'f1_difference': update_f1 - retrain_f1}
+
+
+def compare_search_speedup(n_jobs=N_JOBS, mode='grid', conn=None):
+    """
+    Times the serial GridSearchCV baseline against search_hyperparameters on the same grid and loaded data
+    :param n_jobs: Number of processes for search_hyperparameters (-1 uses all cores)
+    :param mode: Search mode for search_hyperparameters (see search_tasks)
+    :param conn: Connection to SQLite DB the data is read from (defaults to current connection)
+    :return: Dictionary with serial_seconds, parallel_seconds, speedup, n_jobs, mode, trees (built by the search)
+             and serial_trees (built by GridSearchCV)
+    """
+    X_train, X_test, y_train, y_test = split_data(conn)
+
+    start = time.perf_counter()
+    tune_hyperparameters().fit(X_train, y_train)
+    serial_seconds = time.perf_counter() - start
+
+    search = search_hyperparameters(X_train, y_train, n_jobs=n_jobs, mode=mode)
+
+    return {'serial_seconds': serial_seconds,
+            'parallel_seconds': search['seconds'],
+            'speedup': serial_seconds / search['seconds'],
+            'n_jobs': search['n_jobs'],
+            'mode': mode,
+            'trees': search['trees'],
+            'serial_trees': CV_FOLDS * sum(candidate['params']['n_estimators'] for candidate in search['candidates'])}
 
 
 def evaluate_model(model, X_test, y_test):
@@ -190,28 +1751,51 @@ def evaluate_model(model, X_test, y_test):
     :param y_test: List of labels to use for evaluation
     :return: Dictionary with classification report full of various metrics
     """
+    from sklearn.metrics import classification_report
     y_preds = model.predict(X_test)
     return classification_report(y_test, y_preds, target_names=['Normal', 'Suspect', 'Pathologic'], output_dict=True)
 
 
+def get_confusion_matrix(model, X_test, y_test):
+    """
+    Counts the model's predictions on test data for each combination of true and predicted label
+    :param model: Estimator
+    :param X_test: List of features to use for evaluation
+    :param y_test: List of labels to use for evaluation
+    :return: Nested list with one row per true label and one column per predicted label, in the order of model.classes_
+    """
+    from sklearn.metrics import confusion_matrix
+    return confusion_matrix(y_test, model.predict(X_test), labels=model.classes_).tolist()
+
+
 def save_model(model):
     """
     Saves machine learning model to file, overwriting previous file
     :param model: Estimator
     :return: None
     """
+    # Create filepaths
+    filepath = get_model_filepath('new_model')
+    engine_filepath = get_model_filepath('new_model_engine')
 
-    # Create filepath
-    dirname = Path(__file__).parent.absolute()
-    filename = "new_model"
-    suffix = ".joblib"
-    filepath = Path(dirname, filename).with_suffix(suffix)
-
-    # Save model to disk
-    dump(model, filepath)
+    # Save model and its compiled engine to disk (engine is left uncompressed so it can be memory-mapped)
+    engine = compile_forest(model)
+    dump_atomic(model, filepath)
+    try:
+        dump_atomic(engine, engine_filepath)
+    except OSError as error:
+        # E.g. the old engine file is still mapped on Windows; it is older than the model, so it is recompiled later
+        log_error(error, 'save_model')
 
     # Update reference to model in Model object
     Model.model = model
+    Model.engine = engine
+    Model.engine_source = filepath.resolve()
+    Model.engine_future = None
+
+    # Cached predictions belong to the previous model
+    Model.version += 1
+    Model.prediction_cache.clear()
 
 
 def insert_fetal_data(placeholder):
@@ -220,6 +1804,7 @@ def insert_fetal_data(placeholder):
     :param placeholder: List with ordered values for fetal health attributes and fetal health status
     :return: 1 if successful, 0 if unsuccessful
     """
+    start = time.perf_counter()
     try:
         conn = get_conn()
         cursor = conn.cursor()
@@ -234,12 +1819,364 @@ def insert_fetal_data(placeholder):
 
         cursor.execute(insert_query, placeholder)
         conn.commit()
-        return 1
     except Error as error:
+        log_error(error, 'insert', time.perf_counter() - start)
+        return 0
+    log_event('insert', 'fetal_health = {}'.format(placeholder[-1]), time.perf_counter() - start)
+
+    # Keep loaded data current without re-reading the whole table. The row is already saved, so a failure here
+    # is only logged (the next load reads the row) and must not make the user enter it again
+    if Model.row_count is not None:
+        try:
+            refresh_fetal_data(conn)
+        except Exception as error:
+            log_error(error, 'refresh_fetal_data')
+    return 1
+
+
+def validate_fetal_data(data, columns=None):
+    """
+    Validates fetal health data against fetal_schema, checking every row of a column at once
+    :param data: Pandas DataFrame (or dictionary for a single row) containing (at least) every column in columns
+    :param columns: List of columns to validate (defaults to db_cols)
+    :return: values (DataFrame of numeric values in columns order, NaN where not a number),
+             errors (DataFrame of int8 error codes for each row and column: VALID, TYPE_ERROR, or RANGE_ERROR)
+    """
+    if columns is None:
+        columns = db_cols
+    if isinstance(data, dict):
+        data = pd.DataFrame([data])
+    missing = [col for col in columns if col not in data.columns]
+    if len(missing) > 0:
+        raise ValueError('Missing columns: {}'.format(', '.join(missing)))
+
+    values = data[columns].apply(pd.to_numeric, errors='coerce')
+    errors = {}
+    for col in columns:
+        schema = fetal_schema[col]
+        column = values[col].to_numpy(dtype=np.float64)
+        with np.errstate(invalid='ignore'):
+            type_error = ~np.isfinite(column)
+            if schema['dtype'] is int:
+                type_error |= column % 1 != 0
+            if 'values' in schema:
+                range_error = ~np.isin(column, schema['values'])
+            else:
+                range_error = (column < schema['min']) | (column > schema['max'])
+        errors[col] = np.where(type_error, TYPE_ERROR, np.where(range_error, RANGE_ERROR, VALID)).astype(np.int8)
+    return values, pd.DataFrame(errors, index=values.index, columns=columns)
+
+
+def error_message(col, code, named=False):
+    """
+    Describes a validation error for one column
+    :param col: Column name
+    :param code: TYPE_ERROR or RANGE_ERROR
+    :param named: Set True to name the column in type errors instead of referring to the highlighted fields of the
+                  FHS screen (e.g. for the prediction server)
+    :return: String
+    """
+    schema = fetal_schema[col]
+    if code == TYPE_ERROR and named:
+        return '{} must be {}'.format(schema['label'], 'an integer' if schema['dtype'] is int else 'a number')
+    if code == TYPE_ERROR:
+        return 'Highlighted input must be integers' if schema['dtype'] is int else 'Highlighted input must be numeric.'
+    if 'values' in schema:
+        allowed = [str(value) for value in schema['values']]
+        return '{} must be {}, or {}'.format(schema['label'], ', '.join(allowed[:-1]), allowed[-1])
+    return '{} must be between {} and {}'.format(schema['label'], schema['min'], schema['max'])
+
+
+def ingest_fetal_data(chunks, conn=None, chunk_size=CHUNK_SIZE, progress=None):
+    """
+    Bulk inserts a stream of fetal health data into the database, skipping rows that fail validation
+    :param chunks: Iterable of Pandas DataFrames with db_cols columns (see iter_csv_chunks)
+    :param conn: Connection to SQLite DB (defaults to current connection)
+    :param chunk_size: Number of rows per transaction
+    :param progress: Optional function called with the running stats dictionary after each chunk
+    :return: Dictionary with rows, inserted, rejected, seconds, rows_per_second and
+             failed (True if a database error stopped the import; see error_log.txt)
+    """
+    if conn is None:
+        conn = get_conn()
+
+    stats = {'rows': 0, 'inserted': 0, 'rejected': 0, 'seconds': 0.0, 'rows_per_second': 0.0, 'failed': False}
+    start = time.perf_counter()
+
+    for chunk in chunks:
+        data, errors = validate_fetal_data(chunk)
+        valid = (errors == VALID).all(axis=1).to_numpy()
+        inserted = bulk_insert(conn, 'fetal_health', db_cols, data[valid].to_numpy(dtype=np.float64).tolist(),
+                               chunk_size)
+
+        stats['rows'] += len(chunk)
+        stats['rejected'] += int((~valid).sum())
+        stats['seconds'] = time.perf_counter() - start
+        stats['rows_per_second'] = stats['rows'] / stats['seconds'] if stats['seconds'] > 0 else 0.0
+        if inserted is None:
+            stats['failed'] = True
+            break
+        stats['inserted'] += inserted
+        if progress is not None:
+            progress(stats)
+
+    # Keep loaded data current without re-reading the whole table
+    if Model.row_count is not None:
+        refresh_fetal_data(conn)
+    log_event('ingest', '{inserted} of {rows} rows inserted, {rejected} rejected'.format(**stats), stats['seconds'])
+    return stats
+
+
+# Batch Scoring
+def iter_csv_chunks(filepath, chunksize=CHUNK_SIZE):
+    """
+    Streams fetal health data from a CSV file (same layout as fetal_health.csv) in chunks
+    :param filepath: Path to CSV file
+    :param chunksize: Number of rows per chunk
+    :return: Generator of Pandas DataFrames
+    """
+    for chunk in pd.read_csv(filepath, chunksize=chunksize):
+        yield chunk
+
+
+def iter_sql_chunks(conn, query="SELECT * from fetal_health", chunksize=CHUNK_SIZE):
+    """
+    Streams fetal health data from the SQLite DB in chunks
+    :param conn: Connection to SQLite DB
+    :param query: SQL query returning the feature columns
+    :param chunksize: Number of rows per chunk
+    :return: Generator of Pandas DataFrames
+    """
+    for chunk in pd.read_sql(query, conn, chunksize=chunksize):
+        yield chunk
+
+
+def prepare_chunk(chunk):
+    """
+    Validates a chunk of fetal health data for prediction (same rules as the FHS screen, see fetal_schema)
+    :param chunk: Pandas DataFrame containing (at least) every column in feature_cols
+    :return: X (DataFrame of numeric features in feature_cols order),
+             valid (boolean array, True for rows that can be scored)
+    """
+    X, errors = validate_fetal_data(chunk, feature_cols)
+    valid = (errors == VALID).all(axis=1).to_numpy()
+    return X, valid
+
+
+def score_chunk(model, chunk):
+    """
+    Predicts fetal health status for every valid row of a chunk with one vectorized call
+    :param model: Estimator, or None to use the current model (not through the prediction cache: batch rows are
+                  rarely repeated, so it would only add per-row overhead and evict interactive predictions)
+    :param chunk: Pandas DataFrame with fetal health attributes
+    :return: Copy of chunk with predicted_fetal_health and one probability column per status added,
+             number of rejected rows
+    """
+    X, valid = prepare_chunk(chunk)
+    scored = chunk.copy()
+    scored['predicted_fetal_health'] = np.nan
+    prob_cols = ['prob_' + label.lower() for label in fhs_labels]
+    for col in prob_cols:
+        scored[col] = np.nan
 
-        dirname = Path(__file__).parent.absolute()
-        error_filepath = Path(dirname, 'error_log').with_suffix('.txt')
-        f = open(error_filepath, 'a')
-        f.write('{} - {}\n'.format(datetime.datetime.now(), error))
-        f.close()
+    if valid.any():
+        if model is None:
+            # The compiled engine is fastest for a few rows, scikit-learn for large batches if it is already loaded
+            model = Model.model if Model.model is not None and valid.sum() > BLOCK_SIZE else get_engine()
+            if model is None:
+                raise FileNotFoundError('No model to score with')
+        probs = model.predict_proba(X[valid])
+        classes = model.classes_
+        scored.loc[valid, 'predicted_fetal_health'] = classes[probs.argmax(axis=1)]
+        scored.loc[valid, prob_cols] = probs
+
+    return scored, int((~valid).sum())
+
+
+def score_batch(chunks, output_path=None, output_table=None, conn=None, model=None, progress=None):
+    """
+    Scores a stream of fetal health data chunks and writes predictions to a CSV file and/or SQLite table
+    :param chunks: Iterable of Pandas DataFrames (see iter_csv_chunks and iter_sql_chunks)
+    :param output_path: Optional path to output CSV file (overwritten)
+    :param output_table: Optional name of SQLite table to append predictions to (requires conn)
+    :param conn: Connection to SQLite DB used for output_table
+    :param model: Estimator (defaults to the current model)
+    :param progress: Optional function called with the running stats dictionary after each chunk
+    :return: Dictionary with rows, rejected, seconds and rows_per_second
+    """
+    stats = {'rows': 0, 'rejected': 0, 'seconds': 0.0, 'rows_per_second': 0.0}
+    start = time.perf_counter()
+    header = True
+
+    for chunk in chunks:
+        scored, rejected = score_chunk(model, chunk)
+
+        # Write chunk out before reading the next one so memory stays bounded by chunk size
+        if output_path is not None:
+            scored.to_csv(output_path, mode='w' if header else 'a', header=header, index=False)
+        if output_table is not None:
+            scored.to_sql(output_table, conn, if_exists='append', index=False)
+        header = False
+
+        stats['rows'] += len(scored)
+        stats['rejected'] += rejected
+        stats['seconds'] = time.perf_counter() - start
+        stats['rows_per_second'] = stats['rows'] / stats['seconds'] if stats['seconds'] > 0 else 0.0
+        if progress is not None:
+            progress(stats)
+
+    return stats
+
+
+# Command Line Interface
+def print_stats(stats):
+    """
+    Prints running stats of a batch operation to the console
+    :param stats: Dictionary with rows, rejected, seconds and rows_per_second
+    :return: None
+    """
+    print('{rows} rows ({rejected} rejected) in {seconds:.2f}s - {rows_per_second:.0f} rows/s'.format(**stats))
+
+
+def main(argv=None):
+    """
+    Command line entry point for headless batch operations
+    :param argv: List of command line arguments (defaults to sys.argv)
+    :return: 0 if successful, 1 otherwise
+    """
+    parser = argparse.ArgumentParser(description='Fetal health predictor batch tools')
+    subparsers = parser.add_subparsers(dest='command')
+
+    score_parser = subparsers.add_parser('score', help='Predict fetal health status for a CSV file or DB query')
+    score_parser.add_argument('--csv', help='Input CSV file with the same columns as fetal_health.csv')
+    score_parser.add_argument('--db', help='SQLite DB for input and --table (defaults to fetal_health_db.db)')
+    score_parser.add_argument('--query', default='SELECT * from fetal_health', help='Query used when reading the DB')
+    score_parser.add_argument('--out', help='Output CSV file')
+    score_parser.add_argument('--table', help='SQLite table to append predictions to')
+    score_parser.add_argument('--model', help='Model .joblib file (defaults to new_model.joblib)')
+    score_parser.add_argument('--chunksize', type=int, default=CHUNK_SIZE)
+
+    speedup_parser = subparsers.add_parser('tune-speedup',
+                                           help='Time serial GridSearchCV against the parallel hyperparameter search')
+    speedup_parser.add_argument('--db', help='SQLite DB with fetal_health table (defaults to fetal_health_db.db)')
+    speedup_parser.add_argument('--jobs', type=int, default=N_JOBS, help='Number of processes (-1 uses all cores)')
+    speedup_parser.add_argument('--mode', default='grid', choices=['grid', 'incremental', 'oob'],
+                                help='Search mode compared against the serial GridSearchCV')
+
+    ingest_parser = subparsers.add_parser('ingest', help='Bulk import fetal health data from a CSV file')
+    ingest_parser.add_argument('csv', help='CSV file with the same columns as fetal_health.csv')
+    ingest_parser.add_argument('--db', help='SQLite DB with fetal_health table (defaults to fetal_health_db.db)')
+    ingest_parser.add_argument('--chunksize', type=int, default=CHUNK_SIZE, help='Rows per transaction')
+
+    memory_parser = subparsers.add_parser('memory', help='Report memory saved by holding data in compact types')
+    memory_parser.add_argument('--db', help='SQLite DB with fetal_health table (defaults to fetal_health_db.db)')
+
+    update_parser = subparsers.add_parser('update', help='Refresh the saved model with rows added since training')
+    update_parser.add_argument('--db', help='SQLite DB with fetal_health table (defaults to fetal_health_db.db)')
+    update_parser.add_argument('--trees', type=int, default=UPDATE_TREES, help='Number of oldest trees to replace')
+    update_parser.add_argument('--check', action='store_true',
+                               help='Only compare an update against retraining from scratch; nothing is saved')
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'score':
+        if args.out is None and args.table is None:
+            print('Specify --out and/or --table')
+            return 1
+
+        load_model(args.model)
+        if get_model() is None:
+            print('Could not find model file')
+            return 1
+
+        conn = None
+        if args.csv is None or args.table is not None:
+            conn = start_conn(args.db)
+            if conn is None:
+                print('Could not connect to database')
+                return 1
+
+        if args.csv is not None:
+            chunks = iter_csv_chunks(args.csv, args.chunksize)
+        else:
+            chunks = iter_sql_chunks(conn, args.query, args.chunksize)
+
+        stats = score_batch(chunks, output_path=args.out, output_table=args.table, conn=conn, progress=print_stats)
+        if conn is not None:
+            close_conn(conn)
+        print('Done: ', end='')
+        print_stats(stats)
+        return 0
+
+    if args.command == 'tune-speedup':
+        conn = start_conn(args.db)
+        if conn is None:
+            print('Could not connect to database')
+            return 1
+        load_fetal_data(conn)
+        results = compare_search_speedup(args.jobs, args.mode, conn)
+        close_conn(conn)
+        print('Serial GridSearchCV: {serial_seconds:.1f}s ({serial_trees} trees), '
+              '{mode} search on {n_jobs} processes: {parallel_seconds:.1f}s ({trees} trees), '
+              'speedup {speedup:.2f}x'.format(**results))
+        return 0
+
+    if args.command == 'ingest':
+        conn = start_conn(args.db)
+        if conn is None:
+            print('Could not connect to database')
+            return 1
+        stats = ingest_fetal_data(iter_csv_chunks(args.csv, args.chunksize), conn, args.chunksize,
+                                  progress=print_stats)
+        close_conn(conn)
+        if stats['failed']:
+            print('Import stopped by a database error (see error_log.txt) after {} rows'.format(stats['inserted']))
+            return 1
+        print('Done: {} rows inserted, '.format(stats['inserted']), end='')
+        print_stats(stats)
+        return 0
+
+    if args.command == 'memory':
+        conn = open_conn(args.db, read_only=True)
+        if conn is None:
+            print('Could not connect to database')
+            return 1
+        columns, totals = memory_report(iter_fetal_data(conn))
+        close_conn(conn)
+        print(columns.to_string())
+        print('{rows} rows: {float64_bytes} bytes as float64, {compact_bytes} bytes compact ({ratio:.2f}x smaller), '
+              'features identical: {identical_features}'.format(**totals))
         return 0
+
+    if args.command == 'update':
+        conn = start_conn(args.db)
+        if conn is None:
+            print('Could not connect to database')
+            return 1
+        load_fetal_data(conn)
+        if get_model() is None:
+            print('Could not find model file')
+            close_conn(conn)
+            return 1
+
+        if args.check:
+            results = compare_update_to_retrain(args.trees)
+            print('Update: {update_seconds:.1f}s (macro F1 {update_f1:.4f}), '
+                  'retrain: {retrain_seconds:.1f}s (macro F1 {retrain_f1:.4f}), '
+                  'speedup {speedup:.1f}x, F1 difference {f1_difference:+.4f}'.format(**results))
+        else:
+            model, report = update_model(args.trees)
+            if model is None:
+                print('Model is already up to date')
+            else:
+                save_model(model)
+                print('Model updated, macro avg F1-score {:.4f}'.format(report['macro avg']['f1-score']))
+        close_conn(conn)
+        return 0
+
+    parser.print_help()
+    return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,380 @@
+"""
+Austin Wong
+001355444
+2/22/2021
+"""
+
+# IMPORTS
+# Data Analysis Imports
+import numpy as np
+import pandas as pd
+
+# General and File Management Imports
+import sys
+import json
+import time
+import asyncio
+import argparse
+
+# Custom Packages
+from model import feature_cols, fhs_labels, load_model, get_engine, predict_proba_cached, get_cache_stats, \
+    validate_fetal_data, error_message, VALID
+
+
+# CONSTANTS
+# Default address the prediction server listens on (local machine only)
+HOST = '127.0.0.1'
+PORT = 8765
+
+# Default longest time (milliseconds) a request waits for others to join its batch while the server is busy
+MAX_WAIT_MS = 2.0
+
+# Default largest number of rows predicted together
+MAX_BATCH = 256
+
+# Largest accepted request body (bytes)
+MAX_BODY = 65536
+
+# HTTP reason phrases for the status codes the server sends
+reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 413: 'Payload Too Large',
+           500: 'Internal Server Error'}
+
+
+# CLASSES
+class MicroBatcher:
+    """
+    Collects rows from concurrent requests into batches so each batch needs only one vectorized prediction.
+    Rows that arrive while a batch is being predicted form the next batch. When the previous batch held more than
+    one row, the batcher also waits up to max_wait for more rows; a lone request on an idle server is not delayed.
+    """
+
+    def __init__(self, predict_proba, max_wait=MAX_WAIT_MS / 1000, max_batch=MAX_BATCH):
+        """
+        :param predict_proba: Function predicting class probabilities for a float32 array (e.g. predict_proba_cached)
+        :param max_wait: Longest time (seconds) to wait for more rows while the server is busy
+        :param max_batch: Largest number of rows per prediction
+        """
+        self.predict_proba = predict_proba
+        self.max_wait = max_wait
+        self.max_batch = max_batch
+        self.queue = asyncio.Queue()
+        self.batches = 0
+        self.rows = 0
+        self.last_batch_size = 0
+
+    async def predict(self, row):
+        """
+        Queues one row and waits for its batch to be predicted
+        :param row: float32 array (n_features,)
+        :return: float64 array of class probabilities
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((row, future))
+        return await future
+
+    async def run(self):
+        """
+        Predicts queued rows batch by batch until cancelled
+        :return: None
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+
+            # Take everything that is already waiting, then wait a little longer for more if the server is busy
+            deadline = loop.time() + (self.max_wait if self.last_batch_size > 1 else 0.0)
+            while len(batch) < self.max_batch:
+                if not self.queue.empty():
+                    batch.append(self.queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            # Predict off the event loop so requests keep being read while the batch runs
+            X = np.stack([row for row, _ in batch])
+            try:
+                proba = await loop.run_in_executor(None, self.predict_proba, X)
+            except Exception as exc:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(exc)
+                continue
+
+            for (_, future), row_proba in zip(batch, proba):
+                if not future.done():
+                    future.set_result(row_proba)
+            self.batches += 1
+            self.rows += len(batch)
+            self.last_batch_size = len(batch)
+
+
+# FUNCTIONS
+def parse_features(body):
+    """
+    Reads one feature vector from a JSON request body and validates it against the schema in model.py,
+    with the same rules as the FHS screen and bulk import (see validate_fetal_data)
+    :param body: bytes with a JSON list of numbers in feature_cols order, or an object with a "features" list
+    :return: float32 array (n_features,)
+    """
+    data = json.loads(body)
+    if isinstance(data, dict):
+        data = data.get('features')
+    if not isinstance(data, list) or len(data) != len(feature_cols):
+        raise ValueError('Expected a list of {} numbers in this order: {}'.format(len(feature_cols),
+                                                                                 ', '.join(feature_cols)))
+
+    values, errors = validate_fetal_data(dict(zip(feature_cols, data)), feature_cols)
+    errors = errors.iloc[0]
+    invalid = [col for col in feature_cols if errors[col] != VALID]
+    if len(invalid) > 0:
+        raise ValueError('; '.join(error_message(col, errors[col], named=True) for col in invalid))
+    return values.iloc[0].to_numpy(dtype=np.float32)
+
+
+def format_prediction(classes, proba):
+    """
+    :param classes: Array of class labels
+    :param proba: Array of class probabilities for one row
+    :return: Dictionary with predicted fetal_health, status label, and probability of each status
+    """
+    best = int(np.argmax(proba))
+    return {'fetal_health': float(classes[best]),
+            'status': fhs_labels[best],
+            'probabilities': {label: float(p) for label, p in zip(fhs_labels, proba)}}
+
+
+async def read_request(reader):
+    """
+    Reads one HTTP/1.1 request
+    :param reader: asyncio StreamReader
+    :return: method, path, headers (dictionary with lowercase names), body (bytes); None at end of connection
+    """
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    method, path, _ = request_line.decode('latin-1').split(' ', 2)
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    length = int(headers.get('content-length', 0))
+    if length > MAX_BODY:
+        raise OverflowError('Request body too large')
+    body = await reader.readexactly(length) if length > 0 else b''
+    return method, path, headers, body
+
+
+def write_response(writer, status, payload, keep_alive=True):
+    """
+    Writes one JSON HTTP response
+    :param writer: asyncio StreamWriter
+    :param status: HTTP status code
+    :param payload: JSON-serializable response
+    :param keep_alive: Set False to close the connection after the response
+    :return: None
+    """
+    body = json.dumps(payload).encode()
+    head = 'HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\nConnection: {}\r\n\r\n'.format(
+        status, reasons[status], len(body), 'keep-alive' if keep_alive else 'close')
+    writer.write(head.encode('latin-1') + body)
+
+
+def make_handler(batcher, engine):
+    """
+    Creates the connection handler serving:
+        POST /predict  - JSON feature vector in, predicted status and probabilities out
+        GET /health    - model size
+        GET /stats     - number of batches and rows predicted so far, and prediction cache counters
+    :param batcher: MicroBatcher
+    :param engine: Current model, for class labels and size
+    :return: Coroutine function for asyncio.start_server
+    """
+
+    async def handle(reader, writer):
+        try:
+            while True:
+                try:
+                    request = await read_request(reader)
+                except OverflowError as exc:
+                    write_response(writer, 413, {'error': str(exc)}, keep_alive=False)
+                    break
+                except (ValueError, asyncio.IncompleteReadError):
+                    break
+                if request is None:
+                    break
+                method, path, headers, body = request
+                keep_alive = headers.get('connection', '').lower() != 'close'
+
+                if path == '/predict':
+                    if method != 'POST':
+                        status, payload = 405, {'error': 'Use POST'}
+                    else:
+                        try:
+                            proba = await batcher.predict(parse_features(body))
+                            status, payload = 200, format_prediction(engine.classes_, proba)
+                        except ValueError as exc:
+                            status, payload = 400, {'error': str(exc)}
+                        except Exception as exc:
+                            status, payload = 500, {'error': str(exc)}
+                elif path == '/health':
+                    status, payload = 200, {'status': 'ok', 'trees': int(engine.n_trees)}
+                elif path == '/stats':
+                    status, payload = 200, {'batches': batcher.batches, 'rows': batcher.rows,
+                                            'mean_batch': batcher.rows / batcher.batches if batcher.batches else 0.0,
+                                            'cache': get_cache_stats()}
+                else:
+                    status, payload = 404, {'error': 'Not found'}
+
+                write_response(writer, status, payload, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    return handle
+
+
+async def serve(engine, host=HOST, port=PORT, max_wait=MAX_WAIT_MS / 1000, max_batch=MAX_BATCH, ready=None):
+    """
+    Runs the prediction server until cancelled. Repeated feature vectors are answered from the prediction cache.
+    :param engine: Current model (see get_engine)
+    :param host: Address to listen on
+    :param port: Port to listen on
+    :param max_wait: Longest time (seconds) a request waits for others to join its batch
+    :param max_batch: Largest number of rows per prediction
+    :param ready: Optional function called once the server is listening
+    :return: None
+    """
+    batcher = MicroBatcher(predict_proba_cached, max_wait, max_batch)
+    batch_task = asyncio.ensure_future(batcher.run())
+    server = await asyncio.start_server(make_handler(batcher, engine), host, port)
+    if ready is not None:
+        ready()
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        batch_task.cancel()
+
+
+async def load_test(host=HOST, port=PORT, clients=32, requests=200, rows=None):
+    """
+    Measures latency and throughput of a running server with concurrent keep-alive clients
+    :param host: Server address
+    :param port: Server port
+    :param clients: Number of concurrent connections
+    :param requests: Number of requests sent by each client, one at a time
+    :param rows: Optional list of feature vectors to send (defaults to a typical normal patient)
+    :return: Dictionary with requests, errors, seconds, requests_per_second, p50_ms, p99_ms
+    """
+    if rows is None:
+        rows = [[132.0, 0.006, 0.0, 0.006, 0.003, 0.0, 0.0, 17.0, 2.1, 0.0, 10.4,
+                 130.0, 68.0, 198.0, 6.0, 1.0, 141.0, 136.0, 140.0, 12.0, 0.0]]
+    bodies = [json.dumps({'features': row}).encode() for row in rows]
+    latencies = []
+    errors = []
+
+    async def client(index):
+        reader, writer = await asyncio.open_connection(host, port)
+        for number in range(requests):
+            body = bodies[(index + number) % len(bodies)]
+            start = time.perf_counter()
+            writer.write('POST /predict HTTP/1.1\r\nHost: {}\r\nContent-Type: application/json\r\n'
+                         'Content-Length: {}\r\n\r\n'.format(host, len(body)).encode('latin-1') + body)
+            status_line = await reader.readline()
+            length = 0
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                if name.strip().lower() == 'content-length':
+                    length = int(value)
+            await reader.readexactly(length)
+            latencies.append(time.perf_counter() - start)
+            if b' 200 ' not in status_line:
+                errors.append(status_line)
+        writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client(index) for index in range(clients)])
+    seconds = time.perf_counter() - start
+
+    latencies.sort()
+    return {'requests': len(latencies),
+            'errors': len(errors),
+            'seconds': seconds,
+            'requests_per_second': len(latencies) / seconds,
+            'p50_ms': 1000 * latencies[int(0.50 * (len(latencies) - 1))],
+            'p99_ms': 1000 * latencies[int(0.99 * (len(latencies) - 1))]}
+
+
+def main(argv=None):
+    """
+    Command line entry point for the prediction server and its load test
+    :param argv: List of command line arguments (defaults to sys.argv)
+    :return: 0 if successful, 1 otherwise
+    """
+    parser = argparse.ArgumentParser(description='Local fetal health prediction server')
+    subparsers = parser.add_subparsers(dest='command')
+
+    serve_parser = subparsers.add_parser('serve', help='Serve predictions over HTTP')
+    serve_parser.add_argument('--host', default=HOST)
+    serve_parser.add_argument('--port', type=int, default=PORT)
+    serve_parser.add_argument('--model', help='Model .joblib file (defaults to new_model.joblib)')
+    serve_parser.add_argument('--max-wait-ms', type=float, default=MAX_WAIT_MS,
+                              help='Longest time a request waits for others to join its batch')
+    serve_parser.add_argument('--max-batch', type=int, default=MAX_BATCH, help='Largest number of rows per batch')
+
+    test_parser = subparsers.add_parser('loadtest', help='Measure latency and throughput of a running server')
+    test_parser.add_argument('--host', default=HOST)
+    test_parser.add_argument('--port', type=int, default=PORT)
+    test_parser.add_argument('--clients', type=int, default=32, help='Number of concurrent connections')
+    test_parser.add_argument('--requests', type=int, default=200, help='Requests sent by each client')
+    test_parser.add_argument('--csv', help='Optional CSV file (same columns as fetal_health.csv) to take rows from')
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'serve':
+        if args.model is not None:
+            load_model(args.model)
+        engine = get_engine()
+        if engine is None:
+            print('Could not find model file')
+            return 1
+        try:
+            asyncio.run(serve(engine, args.host, args.port, args.max_wait_ms / 1000, args.max_batch,
+                              ready=lambda: print('Serving predictions on http://{}:{}/predict'.format(args.host,
+                                                                                                   args.port))))
+        except KeyboardInterrupt:
+            pass
+        return 0
+
+    if args.command == 'loadtest':
+        rows = None
+        if args.csv is not None:
+            rows = pd.read_csv(args.csv)[feature_cols].to_numpy(dtype=float).tolist()
+        results = asyncio.run(load_test(args.host, args.port, args.clients, args.requests, rows))
+        print('{requests} requests ({errors} errors) in {seconds:.2f}s - {requests_per_second:.0f} requests/s, '
+              'p50 {p50_ms:.2f} ms, p99 {p99_ms:.2f} ms'.format(**results))
+        return 0
+
+    parser.print_help()
+    return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,334 @@
+"""
+Austin Wong
+001355444
+2/22/2021
+"""
+
+# IMPORTS
+# Data Analysis Imports
+import numpy as np
+import pandas as pd
+
+# General and File Management Imports
+import os
+import json
+import time
+import datetime
+from pathlib import Path
+from contextlib import contextmanager
+
+
+# CONSTANTS
+# Version of the snapshot layout; snapshots written with another version are rebuilt
+SNAPSHOT_VERSION = 1
+
+# Seconds after which a lock left behind by a crashed writer is ignored
+LOCK_TIMEOUT = 600
+
+
+# CLASSES
+class Snapshot:
+    """
+    Columnar copy of a table on disk: one raw binary file per column (plus the row ids) and a meta.json file.
+    Columns are memory-mapped read-only, so opening a snapshot reads only meta.json and its pages are shared by every
+    running instance of the application. Rows are only ever appended (in id order); meta.json is replaced atomically
+    after the column files are written, so readers never see a partly written row.
+    """
+
+    def __init__(self, folder, meta):
+        """
+        :param folder: Folder holding the snapshot files
+        :param meta: Dictionary read from meta.json
+        """
+        self.folder = Path(folder)
+        self.meta = meta
+        self.ids = map_column(self.folder, meta['ids'], meta['rows'])
+        self.columns = {col: map_column(self.folder, spec, meta['rows']) for col, spec in meta['columns'].items()}
+
+    @property
+    def rows(self):
+        return self.meta['rows']
+
+    @property
+    def last_id(self):
+        return self.meta['last_id']
+
+    def decode(self, col, start=0, stop=None):
+        """
+        :param col: Column name
+        :param start: First row position
+        :param stop: Row position after the last row (defaults to all rows)
+        :return: float64 array of the column's values (missing values are NaN)
+        """
+        return decode_column(self.columns[col][start:stop], self.meta['columns'][col])
+
+    def take(self, col, positions):
+        """
+        :param col: Column name
+        :param positions: Array of row positions
+        :return: float64 array of the column's values at positions (missing values are NaN)
+        """
+        return decode_column(np.asarray(self.columns[col][positions]), self.meta['columns'][col])
+
+    def position(self, row_id):
+        """
+        :param row_id: Row id
+        :return: Number of rows with an id up to row_id
+        """
+        return int(np.searchsorted(self.ids, row_id, side='right'))
+
+
+# FUNCTIONS
+def map_column(folder, spec, rows):
+    """
+    :param folder: Snapshot folder
+    :param spec: Column dictionary from meta.json (file, dtype and optional categories)
+    :param rows: Number of rows to map (bytes after them are ignored)
+    :return: Read-only memory-mapped array
+    """
+    dtype = np.dtype(spec['dtype'])
+    if rows == 0:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(Path(folder, spec['file']), dtype=dtype, mode='r', shape=(rows,))
+
+
+def column_spec(col, dtype, generation):
+    """
+    Chooses how a column is stored. Integer columns keep their smallest type and store missing values as the type's
+    lowest value; categorical columns store int8 codes (-1 for missing); everything else is stored as float64,
+    so decoded values are always exactly the values in the database.
+    :param col: Column name
+    :param dtype: Compact dtype of the column (numpy type or Pandas CategoricalDtype)
+    :param generation: Snapshot generation (part of the file name)
+    :return: Column dictionary for meta.json
+    """
+    if isinstance(dtype, pd.CategoricalDtype):
+        spec = {'dtype': 'int8', 'categories': [float(category) for category in dtype.categories]}
+    elif np.issubdtype(dtype, np.integer):
+        spec = {'dtype': np.dtype(dtype).name}
+    else:
+        spec = {'dtype': 'float64'}
+    spec['file'] = '{}.{}.{}.bin'.format(col, generation, spec['dtype'])
+    return spec
+
+
+def encode_column(values, spec):
+    """
+    :param values: float64 array
+    :param spec: Column dictionary from meta.json
+    :return: Array in the column's storage type, or None if a value can't be stored exactly in that type
+    """
+    dtype = np.dtype(spec['dtype'])
+    missing = np.isnan(values)
+    if 'categories' in spec:
+        categories = np.array(spec['categories'])
+        codes = np.searchsorted(categories, values)
+        known = (codes < len(categories)) & (categories[np.minimum(codes, len(categories) - 1)] == values)
+        if not np.all(known | missing):
+            return None
+        return np.where(missing, -1, codes).astype(dtype)
+    if dtype.kind == 'i':
+        limits = np.iinfo(dtype)
+        present = values[~missing]
+        if not np.all((present % 1 == 0) & (present > limits.min) & (present <= limits.max)):
+            return None
+        return np.where(missing, limits.min, values).astype(dtype)
+    return values.astype(dtype)
+
+
+def decode_column(array, spec):
+    """
+    :param array: Stored values of a column
+    :param spec: Column dictionary from meta.json
+    :return: float64 array (missing values are NaN)
+    """
+    if 'categories' in spec:
+        categories = np.append(np.array(spec['categories']), np.nan)
+        return categories[np.where(array < 0, len(categories) - 1, array)]
+    values = array.astype(np.float64)
+    if array.dtype.kind == 'i':
+        values[array == np.iinfo(array.dtype).min] = np.nan
+    return values
+
+
+def open_snapshot(folder):
+    """
+    :param folder: Snapshot folder
+    :return: Snapshot, or None if there is no usable snapshot in folder
+    """
+    try:
+        with open(Path(folder, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta.get('version') != SNAPSHOT_VERSION:
+            return None
+        return Snapshot(folder, meta)
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def write_meta(folder, meta):
+    """
+    Replaces meta.json atomically
+    :param folder: Snapshot folder
+    :param meta: Dictionary
+    :return: None
+    """
+    meta['updated'] = datetime.datetime.now().isoformat(timespec='seconds')
+    temp_filepath = Path(folder, 'meta.json.tmp')
+    with open(temp_filepath, 'w') as f:
+        json.dump(meta, f, indent=2)
+    os.replace(temp_filepath, Path(folder, 'meta.json'))
+
+
+@contextmanager
+def snapshot_lock(folder):
+    """
+    Lets one writer (thread or running instance of the application) change a snapshot at a time
+    :param folder: Snapshot folder
+    :return: Context manager yielding True if the lock was acquired, False if another writer holds it
+    """
+    lock_filepath = Path(folder, 'lock')
+    try:
+        if lock_filepath.exists() and time.time() - lock_filepath.stat().st_mtime > LOCK_TIMEOUT:
+            lock_filepath.unlink()
+        os.close(os.open(lock_filepath, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except OSError:
+        yield False
+        return
+    try:
+        yield True
+    finally:
+        try:
+            lock_filepath.unlink()
+        except OSError:
+            pass
+
+
+def append_rows(folder, meta, chunks):
+    """
+    Appends chunks to the snapshot files and updates meta (meta.json is not written).
+    A column holding a value its type can't store is rewritten as float64 first.
+    :param folder: Snapshot folder
+    :param meta: Dictionary from meta.json
+    :param chunks: Iterable of float64 Pandas DataFrames indexed by id, in id order, with every snapshot column
+    :return: None
+    """
+    # Drop anything a crashed writer appended after the last complete row
+    for spec in [meta['ids']] + list(meta['columns'].values()):
+        filepath = Path(folder, spec['file'])
+        size = meta['rows'] * np.dtype(spec['dtype']).itemsize
+        if not filepath.exists() or filepath.stat().st_size > size:
+            with open(filepath, 'ab') as f:
+                f.truncate(size)
+
+    for chunk in chunks:
+        if len(chunk) == 0:
+            continue
+        arrays = {}
+        for col, spec in meta['columns'].items():
+            values = chunk[col].to_numpy(dtype=np.float64)
+            arrays[col] = encode_column(values, spec)
+            if arrays[col] is None:
+                widen_column(folder, meta, col)
+                arrays[col] = encode_column(values, meta['columns'][col])
+
+        with open(Path(folder, meta['ids']['file']), 'ab') as f:
+            f.write(chunk.index.to_numpy(dtype=np.int64).tobytes())
+        for col, array in arrays.items():
+            with open(Path(folder, meta['columns'][col]['file']), 'ab') as f:
+                f.write(array.tobytes())
+        meta['rows'] += len(chunk)
+        meta['last_id'] = int(chunk.index[-1])
+
+
+def widen_column(folder, meta, col):
+    """
+    Rewrites a column as float64 (e.g. when a missing or fractional value arrives in an integer column)
+    :param folder: Snapshot folder
+    :param meta: Dictionary from meta.json; updated to point at the new file
+    :param col: Column name
+    :return: None
+    """
+    old_spec = meta['columns'][col]
+    new_spec = {'dtype': 'float64', 'file': '{}.{}.float64.bin'.format(col, meta['generation'])}
+    values = decode_column(map_column(folder, old_spec, meta['rows']), old_spec)
+    with open(Path(folder, new_spec['file']), 'wb') as f:
+        f.write(values.tobytes())
+    meta['columns'][col] = new_spec
+
+
+def create_snapshot(folder, chunks, dtypes, changes=None):
+    """
+    Writes a new snapshot generation from a stream of chunks. Files of older generations are left for readers that
+    still have them open and removed the next time a snapshot is created.
+    :param folder: Snapshot folder (created if needed)
+    :param chunks: Iterable of float64 Pandas DataFrames indexed by id, in id order
+    :param dtypes: Dictionary mapping each column to its compact dtype (see column_spec)
+    :param changes: Optional change count of the source table when reading started, stored in meta.json so readers
+                    can tell when existing rows have been edited since
+    :return: Snapshot, or None if another writer holds the lock
+    """
+    Path(folder).mkdir(parents=True, exist_ok=True)
+    with snapshot_lock(folder) as locked:
+        if not locked:
+            return None
+        old = open_snapshot(folder)
+        generation = old.meta['generation'] + 1 if old is not None else 1
+        for filepath in Path(folder).glob('*.bin'):
+            try:
+                filepath.unlink()
+            except OSError:
+                pass
+
+        meta = {'version': SNAPSHOT_VERSION,
+                'generation': generation,
+                'rows': 0,
+                'last_id': 0,
+                'changes': changes,
+                'created': datetime.datetime.now().isoformat(timespec='seconds'),
+                'ids': {'dtype': 'int64', 'file': 'id.{}.int64.bin'.format(generation)},
+                'columns': {col: column_spec(col, dtype, generation) for col, dtype in dtypes.items()}}
+        append_rows(folder, meta, chunks)
+        write_meta(folder, meta)
+    return open_snapshot(folder)
+
+
+def extend_snapshot(snapshot, chunks):
+    """
+    Appends rows added after the snapshot was written
+    :param snapshot: Snapshot
+    :param chunks: Iterable of float64 Pandas DataFrames indexed by id with ids above snapshot.last_id, in id order
+    :return: Extended Snapshot, or the given one if another writer holds the lock or it has changed meanwhile
+    """
+    with snapshot_lock(snapshot.folder) as locked:
+        if not locked:
+            return snapshot
+        current = open_snapshot(snapshot.folder)
+        if current is None or current.meta['generation'] != snapshot.meta['generation'] or \
+                current.last_id != snapshot.last_id:
+            return snapshot
+        meta = json.loads(json.dumps(current.meta))
+        append_rows(snapshot.folder, meta, chunks)
+        if meta['rows'] == snapshot.rows:
+            return snapshot
+        write_meta(snapshot.folder, meta)
+    return open_snapshot(snapshot.folder) or snapshot
+
+
+def iter_snapshot(snapshot, columns, chunksize, after_id=0, upto_id=None):
+    """
+    Streams rows of a snapshot in id order, like reading them from the database
+    :param snapshot: Snapshot
+    :param columns: List of columns to read
+    :param chunksize: Number of rows per chunk
+    :param after_id: Only rows with a higher id are read
+    :param upto_id: Optional highest id to read
+    :return: Generator of float64 Pandas DataFrames indexed by id (missing values are NaN)
+    """
+    start = snapshot.position(after_id)
+    stop = snapshot.rows if upto_id is None else snapshot.position(upto_id)
+    for chunk_start in range(start, stop, chunksize):
+        chunk_stop = min(chunk_start + chunksize, stop)
+        ids = pd.Index(np.asarray(snapshot.ids[chunk_start:chunk_stop]), name='id')
+        values = {col: snapshot.decode(col, chunk_start, chunk_stop) for col in columns}
+        yield pd.DataFrame(values, index=ids, columns=columns)
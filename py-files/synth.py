@@ -0,0 +1,272 @@
+"""
+Austin Wong
+001355444
+2/22/2021
+"""
+
+# IMPORTS
+# Custom Packages
+from dbinter import open_conn, close_conn, bulk_insert
+from model import *
+
+
+# CONSTANTS
+# Rows generated (and written) per chunk
+SYNTH_CHUNK_SIZE = 100000
+
+# Standard deviation of the noise added to resampled values, as a fraction of the column's standard deviation
+# within the row's fetal health status
+JITTER = 0.1
+
+# Most decimal places kept for any column (generated values keep the precision of the source data)
+MAX_DECIMALS = 6
+
+
+# CLASSES
+class Generator:
+    """
+    Learned distribution of fetal health data: every generated row starts as a copy of a random source row, so the
+    features keep their joint distribution within each fetal health status and the statuses keep their proportions.
+    Values are then jittered, clipped to the range seen in the source data and rounded to its precision.
+    """
+
+    def __init__(self, values, status_index, scales, low, high, low_nonzero, decimals):
+        """
+        :param values: float64 array (n_rows, len(db_cols)) of source data
+        :param status_index: array with position of each source row's status in fhs_values
+        :param scales: float64 array (len(fhs_values), len(db_cols)) with the noise scale of each column per status
+                       (0 for columns that are never jittered)
+        :param low: float64 array with lowest value of each column
+        :param high: float64 array with highest value of each column
+        :param low_nonzero: float64 array with lowest nonzero value of each column (lower bound for jittered values)
+        :param decimals: int array with decimal places of each column
+        """
+        self.values = values
+        self.status_index = status_index
+        self.scales = scales
+        self.low = low
+        self.high = high
+        self.low_nonzero = low_nonzero
+        self.decimals = decimals
+
+
+# FUNCTIONS
+def count_decimals(values):
+    """
+    :param values: float64 array
+    :return: Smallest number of decimal places (up to MAX_DECIMALS) that represents every value
+    """
+    for decimals in range(MAX_DECIMALS):
+        if np.allclose(np.round(values, decimals), values, rtol=0, atol=1e-9):
+            return decimals
+    return MAX_DECIMALS
+
+
+def fit_generator(df, jitter=JITTER):
+    """
+    Learns the distribution of fetal health data
+    :param df: Pandas DataFrame with db_cols columns (e.g. from the fetal_health table); invalid rows are dropped
+    :param jitter: Noise standard deviation as a fraction of each column's standard deviation within each status
+    :return: Generator
+    """
+    data, errors = validate_fetal_data(df)
+    values = data[(errors == VALID).all(axis=1).to_numpy()].to_numpy(dtype=np.float64)
+    if len(values) == 0:
+        raise ValueError('No valid fetal health data to learn from')
+
+    status_index = np.searchsorted(fhs_values, values[:, -1])
+    scales = np.zeros((len(fhs_values), len(db_cols)))
+    for status in range(len(fhs_values)):
+        rows = values[status_index == status]
+        if len(rows) > 1:
+            scales[status] = jitter * rows.std(axis=0)
+
+    # Columns restricted to a set of values (tendency and status) are copied unchanged
+    for col_index, col in enumerate(db_cols):
+        if 'values' in fetal_schema[col]:
+            scales[:, col_index] = 0.0
+
+    decimals = np.array([0 if fetal_schema[col]['dtype'] is int else count_decimals(values[:, col_index])
+                         for col_index, col in enumerate(db_cols)])
+    nonzero = np.where(values != 0.0, values, np.inf).min(axis=0)
+    low_nonzero = np.where(np.isinf(nonzero), values.min(axis=0), nonzero)
+    return Generator(values, status_index, scales, values.min(axis=0), values.max(axis=0), low_nonzero, decimals)
+
+
+def generate_chunk(generator, n_rows, rng):
+    """
+    Generates rows by resampling source rows with jitter, all columns at once
+    :param generator: Generator (see fit_generator)
+    :param n_rows: Number of rows
+    :param rng: numpy.random.Generator
+    :return: Pandas DataFrame with db_cols columns
+    """
+    index = rng.integers(0, len(generator.values), n_rows)
+    values = generator.values[index]
+
+    # Zeros stay zeros and other values stay nonzero: most deceleration and movement counts are exactly zero
+    noise = rng.standard_normal(values.shape) * generator.scales[generator.status_index[index]]
+    is_zero = values == 0.0
+    noise[is_zero] = 0.0
+    values += noise
+    np.clip(values, np.where(is_zero, generator.low, generator.low_nonzero), generator.high, out=values)
+
+    # Keep histogram columns consistent: width spans min to max, and mode, mean and median lie within them
+    col = {name: i for i, name in enumerate(db_cols)}
+    hist_min, hist_max = values[:, col['histogram_min']], values[:, col['histogram_max']]
+    np.maximum(hist_max, hist_min, out=hist_max)
+    for name in ('histogram_mode', 'histogram_mean', 'histogram_median'):
+        np.clip(values[:, col[name]], hist_min, hist_max, out=values[:, col[name]])
+
+    for decimals in np.unique(generator.decimals):
+        columns = generator.decimals == decimals
+        values[:, columns] = np.round(values[:, columns], decimals)
+    values[:, col['histogram_width']] = values[:, col['histogram_max']] - values[:, col['histogram_min']]
+
+    return pd.DataFrame(values, columns=db_cols)
+
+
+def generate_fetal_data(generator, n_rows, chunk_size=SYNTH_CHUNK_SIZE, seed=None):
+    """
+    Streams generated fetal health data, so any number of rows can be produced in constant memory
+    :param generator: Generator (see fit_generator)
+    :param n_rows: Total number of rows
+    :param chunk_size: Number of rows per chunk
+    :param seed: Optional random seed for reproducible data
+    :return: Generator of Pandas DataFrames with db_cols columns
+    """
+    rng = np.random.default_rng(seed)
+    for start in range(0, n_rows, chunk_size):
+        yield generate_chunk(generator, min(chunk_size, n_rows - start), rng)
+
+
+def format_column(values, decimals):
+    """
+    Formats a column for CSV output. Generated columns hold few distinct values, so each distinct value is formatted
+    once and the strings are gathered, which is much faster than formatting every value.
+    :param values: float64 array
+    :param decimals: Number of decimal places
+    :return: Array of strings without trailing zeros (e.g. '120', '0.5')
+    """
+    unique, inverse = np.unique(values, return_inverse=True)
+    strings = ['{:.{}f}'.format(value, decimals) for value in unique]
+    if decimals > 0:
+        strings = [string.rstrip('0').rstrip('.') for string in strings]
+    return np.array(strings, dtype=object)[inverse.ravel()]
+
+
+def write_csv(chunks, filepath, decimals, progress=None):
+    """
+    Writes chunks to a CSV file with the same layout as fetal_health.csv
+    :param chunks: Iterable of Pandas DataFrames with db_cols columns
+    :param filepath: Path to CSV file (overwritten)
+    :param decimals: Decimal places of each column (see Generator)
+    :param progress: Optional function called with the number of rows written after each chunk
+    :return: Number of rows written
+    """
+    rows = 0
+    with open(filepath, 'w', newline='') as f:
+        f.write(','.join(db_cols) + '\n')
+        for chunk in chunks:
+            values = chunk[db_cols].to_numpy()
+            columns = [format_column(values[:, col_index], decimals[col_index]) for col_index in range(len(db_cols))]
+            f.write('\n'.join(map(','.join, zip(*columns))) + '\n')
+            rows += len(chunk)
+            if progress is not None:
+                progress(rows)
+    return rows
+
+
+def write_sqlite(chunks, db_filepath, template_filepath=None, progress=None):
+    """
+    Appends chunks to the fetal_health table of a SQLite DB, creating the file and table if needed.
+    A new table copies the fetal_health definition of the template DB but not its triggers, so bulk inserts stay fast;
+    the dashboard summary tables are built the first time the dashboard is opened.
+    :param chunks: Iterable of Pandas DataFrames with db_cols columns
+    :param db_filepath: Path to SQLite DB file
+    :param template_filepath: SQLite DB defining the fetal_health table (defaults to fetal_health_db.db)
+    :param progress: Optional function called with the number of rows written after each chunk
+    :return: Number of rows written, or None if the DB could not be written (see error_log.txt)
+    """
+    if template_filepath is None:
+        template_filepath = Path(Path(__file__).parent.absolute(), 'fetal_health_db').with_suffix('.db')
+    if not Path(db_filepath).exists():
+        Path(db_filepath).touch()
+    conn = open_conn(db_filepath)
+    if conn is None:
+        return None
+
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'fetal_health'").fetchone() is None:
+        template = open_conn(template_filepath, read_only=True)
+        if template is None:
+            close_conn(conn)
+            return None
+        create_table = template.execute("SELECT sql FROM sqlite_master "
+                                        "WHERE type = 'table' AND name = 'fetal_health'").fetchone()[0]
+        close_conn(template)
+        with conn:
+            conn.execute(create_table)
+
+    rows = 0
+    for chunk in chunks:
+        inserted = bulk_insert(conn, 'fetal_health', db_cols, chunk.to_numpy().tolist(), len(chunk))
+        if inserted is None:
+            rows = None
+            break
+        rows += inserted
+        if progress is not None:
+            progress(rows)
+    close_conn(conn)
+    return rows
+
+
+def main(argv=None):
+    """
+    Command line entry point: learns from existing fetal health data and writes generated rows to a CSV or SQLite file
+    :param argv: Optional list of arguments (defaults to sys.argv)
+    :return: Exit code
+    """
+    parser = argparse.ArgumentParser(description='Generate synthetic fetal health data for load and scaling tests')
+    parser.add_argument('out', help='Output .csv file, or .db file whose fetal_health table is appended to')
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--db', help='SQLite DB to learn from (defaults to fetal_health_db.db)')
+    parser.add_argument('--csv', help='CSV file to learn from instead of the DB')
+    parser.add_argument('--jitter', type=float, default=JITTER,
+                        help='Noise as a fraction of each column\'s standard deviation within each status')
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--chunksize', type=int, default=SYNTH_CHUNK_SIZE)
+    args = parser.parse_args(argv)
+
+    if args.csv is not None:
+        source = pd.read_csv(args.csv)
+    else:
+        conn = open_conn(args.db, read_only=True)
+        if conn is None:
+            print('Could not connect to database')
+            return 1
+        source = pd.read_sql("SELECT * from fetal_health", conn)
+        close_conn(conn)
+
+    generator = fit_generator(source, args.jitter)
+    chunks = generate_fetal_data(generator, args.rows, args.chunksize, args.seed)
+    start = time.perf_counter()
+
+    def progress(rows):
+        seconds = time.perf_counter() - start
+        print('{} rows in {:.1f}s ({:.0f} rows/s)'.format(rows, seconds, rows / seconds if seconds > 0 else 0.0))
+
+    if Path(args.out).suffix.lower() == '.csv':
+        rows = write_csv(chunks, args.out, generator.decimals, progress)
+    else:
+        rows = write_sqlite(chunks, args.out, args.db, progress)
+    if rows is None:
+        print('Could not write to database (see error_log.txt)')
+        return 1
+    print('Done: {} rows written to {}'.format(rows, args.out))
+    return 0
+
+
+if __name__ == '__main__':
+
+    # Usage: python synth.py OUT.csv|OUT.db [--rows N] [--db fetal_health_db.db | --csv fetal_health.csv] [--seed N]
+    sys.exit(main())
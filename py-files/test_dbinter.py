@@ -0,0 +1,119 @@
+"""
+Austin Wong
+001355444
+2/22/2021
+"""
+
+# IMPORTS
+# Testing
+import unittest
+
+# Custom Packages
+from dbinter import *
+from model import Model, Aggregates, db_cols, hist_bins, fetal_schema, load_aggregates, compute_aggregates, \
+    ingest_fetal_data
+
+# Data Analysis
+import numpy as np
+import pandas as pd
+
+
+# FUNCTIONS
+def make_rows(count, seed):
+    """
+    :param count: Number of rows
+    :param seed: Random seed
+    :return: List of rows ordered like db_cols, with binned values on and outside the bin edges
+    """
+    rng = np.random.default_rng(seed)
+    rows = np.empty((count, len(db_cols)))
+    for ind, col in enumerate(db_cols):
+        schema = fetal_schema[col]
+        if 'values' in schema:
+            rows[:, ind] = rng.choice(schema['values'], count)
+        elif schema['dtype'] is int:
+            rows[:, ind] = rng.integers(schema['min'], schema['max'] + 1, count)
+        else:
+            rows[:, ind] = rng.uniform(schema['min'], schema['max'], count).round(3)
+    rows[:, db_cols.index('baseline_value')] = rng.integers(95, 185, count)
+    rows[:, db_cols.index('accelerations')] = rng.integers(0, 23, count) * 0.0005
+    rows[:, db_cols.index('prolongued_decelerations')] = rng.integers(0, 8, count) * 0.001
+    return rows.tolist()
+
+
+# CLASSES
+class SummaryTablesTest(unittest.TestCase):
+    """
+    Per-status counts and histograms kept by the summary triggers match a full recompute from the table
+    """
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        db_filepath = Path(self.folder, 'test').with_suffix('.db')
+        conn = sql.connect(db_filepath)
+        conn.execute('CREATE TABLE fetal_health (id INTEGER PRIMARY KEY AUTOINCREMENT, {})'.format(
+            ', '.join('{} REAL'.format(col) for col in db_cols)))
+        conn.close()
+        self.conn = start_conn(db_filepath)
+        bulk_insert(self.conn, 'fetal_health', db_cols, make_rows(300, 0))
+        self.assertEqual(ensure_summary_tables(self.conn, hist_bins), 1)
+        self.assertEqual(ensure_change_counter(self.conn), 1)
+
+    def tearDown(self):
+        Aggregates.counts = None
+        Aggregates.histograms = None
+        Model.row_count = None
+        Model.last_id = 0
+        Model.snapshot = None
+        close_conn(self.conn)
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def assert_summaries_current(self):
+        load_aggregates(self.conn)
+        df = pd.read_sql_query('SELECT {} FROM fetal_health'.format(', '.join(db_cols)), self.conn)
+        counts, histograms, moments = compute_aggregates(df)
+        np.testing.assert_array_equal(Aggregates.counts, counts)
+        for col in hist_bins:
+            np.testing.assert_array_equal(Aggregates.histograms[col], histograms[col], err_msg=col)
+
+    def test_backfill(self):
+        self.assert_summaries_current()
+        self.assertEqual(Aggregates.counts.sum(), 300)
+
+    def test_insert(self):
+        bulk_insert(self.conn, 'fetal_health', db_cols, make_rows(50, 1))
+        self.assert_summaries_current()
+
+    def test_update(self):
+        with self.conn:
+            self.conn.execute('UPDATE fetal_health SET fetal_health = 3.0, baseline_value = 179 WHERE id <= 20')
+            self.conn.execute('UPDATE fetal_health SET accelerations = 0.01 WHERE id BETWEEN 21 AND 40')
+            self.conn.execute('UPDATE fetal_health SET prolongued_decelerations = 0.5 WHERE id BETWEEN 41 AND 60')
+        self.assert_summaries_current()
+        self.assertEqual(read_change_counter(self.conn), 60)
+
+    def test_delete(self):
+        with self.conn:
+            self.conn.execute('DELETE FROM fetal_health WHERE id % 3 = 0')
+        self.assert_summaries_current()
+        self.assertEqual(Aggregates.counts.sum(), 200)
+        self.assertEqual(read_change_counter(self.conn), 100)
+
+    def test_rebuild_on_new_bins(self):
+        bins = dict(hist_bins, baseline_value=np.arange(90, 200, 20))
+        self.assertEqual(ensure_summary_tables(self.conn, bins), 1)
+        histogram = read_summary_tables(self.conn)[1]
+        baseline = [count for col, status, ind, count in histogram if col == 'baseline_value']
+        self.assertEqual(sum(baseline), 300)
+
+    def test_ingest(self):
+        rows = pd.DataFrame(make_rows(40, 2), columns=db_cols)
+        rows.loc[:9, 'baseline_value'] = 120.5
+        stats = ingest_fetal_data([rows.iloc[:20], rows.iloc[20:]], self.conn, chunk_size=7)
+        self.assertEqual((stats['rows'], stats['inserted'], stats['rejected'], stats['failed']), (40, 30, 10, False))
+        self.assertEqual(self.conn.execute('SELECT COUNT(*) FROM fetal_health').fetchone()[0], 330)
+        self.assert_summaries_current()
+
+
+if __name__ == '__main__':
+    unittest.main()
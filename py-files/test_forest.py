@@ -0,0 +1,137 @@
+"""
+Austin Wong
+001355444
+2/22/2021
+"""
+
+# IMPORTS
+# Testing
+import unittest
+
+# Custom Packages
+from forest import *
+
+# Machine Learning
+from joblib import dump
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.model_selection import GridSearchCV
+
+# General
+import shutil
+import tempfile
+
+
+# FUNCTIONS
+def make_data(rows=600, features=6, seed=0):
+    """
+    :param rows: Number of rows
+    :param features: Number of features
+    :param seed: Random seed
+    :return: float64 features (with repeated and float32-boundary values, like rounded measurements) and 3 labels
+    """
+    rng = np.random.default_rng(seed)
+    X = rng.normal(size=(rows, features)).round(2)
+    X[:, 0] = rng.integers(100, 180, rows)
+    X[:, 1] = rng.choice([0.0, 0.001, 0.002, 0.0035], rows)
+    y = np.where(X[:, 0] + 20 * X[:, 2] > 150, 3.0, np.where(X[:, 3] > 0.3, 2.0, 1.0))
+    return X, y
+
+
+# CLASSES
+class CompiledForestTest(unittest.TestCase):
+    """
+    The compiled engine gives exactly the probabilities and predictions of the scikit-learn forest it was compiled from
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.X, cls.y = make_data()
+        cls.model = RandomForestClassifier(n_estimators=25, random_state=0).fit(cls.X, cls.y)
+        cls.engine = compile_forest(cls.model)
+
+    def test_batch_parity(self):
+        X_test, _ = make_data(2000, seed=1)
+        np.testing.assert_array_equal(self.engine.predict_proba(X_test), self.model.predict_proba(X_test))
+        np.testing.assert_array_equal(self.engine.predict(X_test), self.model.predict(X_test))
+
+    def test_single_row(self):
+        row = self.X[7]
+        np.testing.assert_array_equal(self.engine.predict_proba(row), self.model.predict_proba(row.reshape(1, -1)))
+
+    def test_training_rows_and_thresholds(self):
+        # Rows exactly on split thresholds take the same branch as in scikit-learn
+        np.testing.assert_array_equal(self.engine.predict_proba(self.X), self.model.predict_proba(self.X))
+
+    def test_dataframe_input(self):
+        import pandas as pd
+        df = pd.DataFrame(self.X[:50], columns=['f{}'.format(ind) for ind in range(self.X.shape[1])])
+        np.testing.assert_array_equal(self.engine.predict_proba(df), self.model.predict_proba(self.X[:50]))
+
+    def test_grid_search(self):
+        search = GridSearchCV(RandomForestClassifier(random_state=0), {'n_estimators': [5, 10]}, cv=2)
+        search.fit(self.X, self.y)
+        engine = compile_forest(search)
+        np.testing.assert_array_equal(engine.predict_proba(self.X), search.predict_proba(self.X))
+        np.testing.assert_array_equal(engine.classes_, search.classes_)
+
+    def test_float32_thresholds(self):
+        threshold = np.array([0.1, 1 / 3, 150.5, np.inf])
+        rounded = float32_thresholds(threshold)
+        self.assertEqual(rounded.dtype, np.float32)
+        self.assertTrue(np.all(rounded.astype(np.float64) <= threshold))
+
+        # No float32 lies between the rounded and the exact threshold
+        above = np.nextafter(rounded, np.float32(np.inf))
+        self.assertTrue(np.all(above[:-1].astype(np.float64) > threshold[:-1]))
+
+
+class EngineFileTest(unittest.TestCase):
+    """
+    Compiling, saving, memory-mapping and preloading the engine file
+    """
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.model_filepath = Path(self.folder, 'new_model').with_suffix('.joblib')
+        self.engine_filepath = Path(self.folder, 'new_model_engine').with_suffix('.joblib')
+        X, y = make_data(200)
+        self.X = X
+        self.model = RandomForestClassifier(n_estimators=5, random_state=0).fit(X, y)
+        dump(self.model, self.model_filepath)
+
+    def tearDown(self):
+        EnginePreload.future = None
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def test_compiles_missing_engine(self):
+        engine = load_engine_file(self.engine_filepath, self.model_filepath)
+        self.assertTrue(self.engine_filepath.exists())
+        self.assertIsInstance(engine.threshold, np.memmap)
+        np.testing.assert_array_equal(engine.predict_proba(self.X), self.model.predict_proba(self.X))
+
+    def test_recompiles_outdated_engine(self):
+        load_engine_file(self.engine_filepath, self.model_filepath)
+        retrained = RandomForestClassifier(n_estimators=3, random_state=1).fit(self.X, self.model.predict(self.X))
+        dump(retrained, self.model_filepath)
+        os.utime(self.engine_filepath, (time.time() - 60,) * 2)
+        self.assertEqual(load_engine_file(self.engine_filepath, self.model_filepath).n_trees, 3)
+
+    def test_no_files(self):
+        self.assertIsNone(load_engine_file(Path(self.folder, 'missing_engine.joblib'),
+                                           Path(self.folder, 'missing.joblib')))
+
+    def test_atomic_dump_leaves_no_temp_file(self):
+        dump_atomic([1, 2, 3], Path(self.folder, 'list.joblib'))
+        self.assertEqual(sorted(path.name for path in Path(self.folder).iterdir()),
+                         ['list.joblib', 'new_model.joblib'])
+
+    def test_preload_handed_over_once(self):
+        future = preload_engine(self.engine_filepath, self.model_filepath)
+        self.assertIsNone(take_preloaded_engine(Path(self.folder, 'other_engine.joblib')))
+        self.assertIs(take_preloaded_engine(self.engine_filepath), future)
+        self.assertIsNone(take_preloaded_engine(self.engine_filepath))
+        self.assertEqual(future.result().n_trees, 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
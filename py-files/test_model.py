@@ -0,0 +1,186 @@
+"""
+Austin Wong
+001355444
+2/22/2021
+"""
+
+# IMPORTS
+# Testing
+import unittest
+
+# Custom Packages
+from model import *
+from server import parse_features
+
+# General
+import json
+
+
+# FUNCTIONS
+def valid_row():
+    """
+    :return: Dictionary with a value inside the schema's range for every fetal_health column
+    """
+    return {col: schema['values'][0] if 'values' in schema else schema['min'] for col, schema in fetal_schema.items()}
+
+
+# CLASSES
+class ValidationTest(unittest.TestCase):
+    """
+    One schema validates single GUI rows, batches and server requests, with the same error codes and messages
+    """
+
+    def test_valid_row(self):
+        values, errors = validate_fetal_data(valid_row())
+        self.assertTrue((errors == VALID).all(axis=None))
+        self.assertEqual(list(values.columns), db_cols)
+
+    def test_gui_strings(self):
+        row = {col: str(value) for col, value in valid_row().items()}
+        row['baseline_value'] = '132'
+        values, errors = validate_fetal_data(row, feature_cols)
+        self.assertTrue((errors == VALID).all(axis=None))
+        self.assertEqual(values.loc[0, 'baseline_value'], 132.0)
+
+    def test_error_masks(self):
+        # Columns of mixed values, like a CSV file read without dtypes
+        rows = pd.DataFrame([valid_row() for _ in range(5)], dtype=object)
+        rows.loc[0, 'baseline_value'] = 120.5
+        rows.loc[1, 'accelerations'] = 'fast'
+        rows.loc[2, 'histogram_tendency'] = 2
+        rows.loc[3, 'mean_value_of_long_term_variability'] = 100.5
+        rows.loc[4, 'fetal_health'] = np.nan
+        errors = validate_fetal_data(rows)[1]
+        expected = pd.DataFrame(VALID, index=rows.index, columns=db_cols, dtype=np.int8)
+        expected.loc[0, 'baseline_value'] = TYPE_ERROR
+        expected.loc[1, 'accelerations'] = TYPE_ERROR
+        expected.loc[2, 'histogram_tendency'] = RANGE_ERROR
+        expected.loc[3, 'mean_value_of_long_term_variability'] = RANGE_ERROR
+        expected.loc[4, 'fetal_health'] = TYPE_ERROR
+        pd.testing.assert_frame_equal(errors, expected)
+
+    def test_range_edges(self):
+        rows = pd.DataFrame([valid_row(), valid_row()])
+        rows.loc[0, 'baseline_value'] = MAX_HR
+        rows.loc[1, 'baseline_value'] = MAX_HR + 1
+        self.assertEqual(validate_fetal_data(rows)[1]['baseline_value'].tolist(), [VALID, RANGE_ERROR])
+
+    def test_missing_columns(self):
+        with self.assertRaises(ValueError):
+            validate_fetal_data({'baseline_value': 120})
+
+    def test_messages(self):
+        self.assertEqual(error_message('baseline_value', TYPE_ERROR), 'Highlighted input must be integers')
+        self.assertEqual(error_message('accelerations', TYPE_ERROR), 'Highlighted input must be numeric.')
+        self.assertEqual(error_message('baseline_value', TYPE_ERROR, named=True), 'Baseline FHR must be an integer')
+        self.assertEqual(error_message('accelerations', TYPE_ERROR, named=True), 'Accelerations must be a number')
+        self.assertEqual(error_message('baseline_value', RANGE_ERROR),
+                         'Baseline FHR must be between {} and {}'.format(MIN_HR, MAX_HR))
+        self.assertEqual(error_message('histogram_tendency', RANGE_ERROR), 'Histogram Tendency must be -1, 0, or 1')
+
+    def test_server_uses_schema(self):
+        row = [valid_row()[col] for col in feature_cols]
+        np.testing.assert_array_equal(parse_features(json.dumps(row)), np.array(row, dtype=np.float32))
+
+        row[feature_cols.index('baseline_value')] = 120.5
+        row[feature_cols.index('histogram_tendency')] = 2
+        with self.assertRaises(ValueError) as context:
+            parse_features(json.dumps({'features': row}))
+        self.assertEqual(str(context.exception), 'Baseline FHR must be an integer; '
+                                                 'Histogram Tendency must be -1, 0, or 1')
+
+
+class PredictionCacheTest(unittest.TestCase):
+    """
+    Least-recently-used eviction, expiry and statistics of the prediction cache
+    """
+
+    def test_eviction(self):
+        cache = PredictionCache(maxsize=2, ttl=None)
+        cache.put('a', np.array([1.0]))
+        cache.put('b', np.array([2.0]))
+        self.assertIsNotNone(cache.get('a'))
+        cache.put('c', np.array([3.0]))
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('a'))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_expiry(self):
+        cache = PredictionCache(maxsize=2, ttl=0)
+        cache.put('a', np.array([1.0]))
+        time.sleep(0.01)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual((cache.stats()['expirations'], cache.stats()['size']), (1, 0))
+
+    def test_keys(self):
+        # Keys compare features as float32, with -0.0 folded into 0.0
+        X = np.array([[0.1, -0.0], [np.float32(0.1), 0.0], [0.1000001, 0.0]])
+        keys = prediction_keys(as_feature_array(X))
+        self.assertEqual(keys[0], keys[1])
+        self.assertNotEqual(keys[0], keys[2])
+
+    def test_cached_rows_are_copies(self):
+        Model.prediction_cache.clear()
+        Model.engine = compile_forest(fit_forest(np.arange(40, dtype=np.float64).reshape(20, 2),
+                                                 np.repeat([1.0, 2.0], 10), {'n_estimators': 3, 'random_state': 0}))
+        try:
+            X = np.array([[1.0, 2.0], [30.0, 31.0]])
+            proba = predict_proba_cached(X)
+            proba[:] = -1
+            np.testing.assert_array_equal(predict_proba_cached(X), Model.engine.predict_proba(X))
+            self.assertGreaterEqual(get_cache_stats()['hits'], 2)
+        finally:
+            Model.engine = None
+            Model.prediction_cache.clear()
+
+
+class MomentsTest(unittest.TestCase):
+    """
+    Aggregates accumulated chunk by chunk match a recompute over all rows at once
+    """
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.df = pd.DataFrame({col: rng.uniform(0, 1, 500) for col in db_cols})
+        self.df['baseline_value'] = rng.integers(90, 190, 500).astype(np.float64)
+        self.df['fetal_health'] = rng.choice(fhs_values, 500)
+        self.df.loc[[3, 40], 'accelerations'] = np.nan
+
+    def test_merge_matches_recompute(self):
+        values = self.df[corr_cols].dropna().to_numpy()
+        merged = empty_moments(len(corr_cols))
+        for start in range(0, len(values), 70):
+            merged = merge_moments(merged, compute_moments(values[start:start + 70]))
+        full = compute_moments(values)
+        self.assertEqual(merged[0], full[0])
+        np.testing.assert_allclose(merged[1], full[1])
+        np.testing.assert_allclose(merged[2], full[2], atol=1e-9)
+
+    def test_chunked_aggregates(self):
+        chunks = [self.df.iloc[start:start + 64] for start in range(0, len(self.df), 64)]
+        counts, histograms, moments = accumulate_aggregates(chunks)
+        full_counts, full_histograms, full_moments = compute_aggregates(self.df)
+        np.testing.assert_array_equal(counts, full_counts)
+        for col in hist_bins:
+            np.testing.assert_array_equal(histograms[col], full_histograms[col])
+        for chunked, full in zip(moments, full_moments):
+            self.assertEqual(chunked[0], full[0])
+            np.testing.assert_allclose(chunked[2], full[2], atol=1e-9)
+
+    def test_histogram_matches_numpy(self):
+        counts, histograms, moments = compute_aggregates(self.df)
+        for col, bins in hist_bins.items():
+            expected = np.histogram(self.df[col], bins=bins)[0]
+            np.testing.assert_array_equal(histograms[col].sum(axis=0), expected)
+
+    def test_correlation_matches_pandas(self):
+        Aggregates.moments = compute_status_moments(self.df)
+        try:
+            expected = self.df[corr_cols].dropna().corr()
+            np.testing.assert_allclose(get_correlation_matrix().to_numpy(), expected.to_numpy(), atol=1e-12)
+        finally:
+            Aggregates.moments = None
+
+
+if __name__ == '__main__':
+    unittest.main()
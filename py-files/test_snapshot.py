@@ -0,0 +1,194 @@
+"""
+Austin Wong
+001355444
+2/22/2021
+"""
+
+# IMPORTS
+# Testing
+import unittest
+
+# Custom Packages
+from snapshot import *
+from dbinter import start_conn, close_conn, bulk_insert
+import model
+from model import Model, db_cols, load_fetal_data, iter_fetal_data, split_data
+
+# General
+import shutil
+import sqlite3
+import tempfile
+
+
+# CONSTANTS
+# Column types of a small test table (see column_spec)
+test_dtypes = {'count': np.int16, 'rate': np.float32, 'status': pd.CategoricalDtype([1.0, 2.0, 3.0])}
+
+
+# FUNCTIONS
+def make_chunk(first_id, count, rate, status):
+    """
+    :param first_id: Id of the first row
+    :param count: List of count values (the number of rows)
+    :param rate: List of rate values
+    :param status: List of status values
+    :return: float64 Pandas DataFrame indexed by id, like iter_fetal_data
+    """
+    ids = pd.Index(np.arange(first_id, first_id + len(count), dtype=np.int64), name='id')
+    return pd.DataFrame({'count': count, 'rate': rate, 'status': status}, index=ids, dtype=np.float64)
+
+
+def read_all(snapshot, chunksize=2):
+    """
+    :param snapshot: Snapshot
+    :param chunksize: Number of rows per chunk
+    :return: Every row of the snapshot as one DataFrame
+    """
+    return pd.concat(iter_snapshot(snapshot, list(test_dtypes), chunksize))
+
+
+# CLASSES
+class SnapshotFormatTest(unittest.TestCase):
+    """
+    Writing, appending to, widening and rebuilding snapshots, and the writer lock
+    """
+
+    def setUp(self):
+        self.folder = Path(tempfile.mkdtemp(), 'snapshot')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder.parent, ignore_errors=True)
+
+    def test_round_trip(self):
+        chunk = make_chunk(1, [120, np.nan, -3], [0.1, 0.25, np.nan], [1.0, np.nan, 3.0])
+        snapshot = create_snapshot(self.folder, [chunk], test_dtypes, changes=7)
+        self.assertEqual((snapshot.rows, snapshot.last_id, snapshot.meta['changes']), (3, 3, 7))
+        self.assertEqual(snapshot.meta['columns']['count']['dtype'], 'int16')
+        self.assertEqual(snapshot.meta['columns']['status']['dtype'], 'int8')
+        pd.testing.assert_frame_equal(read_all(snapshot), chunk)
+
+    def test_append(self):
+        snapshot = create_snapshot(self.folder, [make_chunk(1, [1, 2], [0.5, 0.5], [1.0, 2.0])], test_dtypes)
+        extended = extend_snapshot(snapshot, [make_chunk(5, [3], [0.75], [3.0])])
+        self.assertEqual((extended.rows, extended.last_id), (3, 5))
+        self.assertEqual(read_all(extended, 1).index.tolist(), [1, 2, 5])
+        self.assertEqual(read_all(extended).loc[5, 'count'], 3.0)
+        self.assertEqual(iter_snapshot(extended, ['count'], 10, after_id=1, upto_id=2).__next__().index.tolist(), [2])
+
+        # Appending to an outdated copy changes nothing
+        self.assertIs(extend_snapshot(snapshot, [make_chunk(9, [4], [1.0], [1.0])]), snapshot)
+        self.assertEqual(open_snapshot(self.folder).rows, 3)
+
+    def test_widen(self):
+        snapshot = create_snapshot(self.folder, [make_chunk(1, [1, 2], [0.5, 0.5], [1.0, 2.0])], test_dtypes)
+        extended = extend_snapshot(snapshot, [make_chunk(3, [2.5, 70000], [0.5, 0.5], [4.0, 1.0])])
+        self.assertEqual(extended.meta['columns']['count']['dtype'], 'float64')
+        self.assertEqual(extended.meta['columns']['status']['dtype'], 'float64')
+        self.assertEqual(read_all(extended)['count'].tolist(), [1.0, 2.0, 2.5, 70000.0])
+        self.assertEqual(read_all(extended)['status'].tolist(), [1.0, 2.0, 4.0, 1.0])
+
+    def test_truncates_partial_rows(self):
+        snapshot = create_snapshot(self.folder, [make_chunk(1, [1, 2], [0.5, 0.5], [1.0, 2.0])], test_dtypes)
+
+        # A crashed writer left bytes after the last complete row
+        with open(Path(self.folder, snapshot.meta['columns']['count']['file']), 'ab') as f:
+            f.write(b'\x01\x02\x03')
+        extended = extend_snapshot(snapshot, [make_chunk(3, [3], [0.5], [3.0])])
+        self.assertEqual(read_all(extended)['count'].tolist(), [1.0, 2.0, 3.0])
+
+    def test_rebuild(self):
+        first = create_snapshot(self.folder, [make_chunk(1, [1, 2], [0.5, 0.5], [1.0, 2.0])], test_dtypes)
+        second = create_snapshot(self.folder, [make_chunk(1, [5], [0.5], [3.0])], test_dtypes)
+        self.assertEqual(second.meta['generation'], first.meta['generation'] + 1)
+        self.assertEqual(second.rows, 1)
+        self.assertEqual(sorted(path.name.split('.')[1] for path in self.folder.glob('*.bin')), ['2'] * 4)
+
+    def test_lock(self):
+        snapshot = create_snapshot(self.folder, [make_chunk(1, [1], [0.5], [1.0])], test_dtypes)
+        with snapshot_lock(self.folder) as locked:
+            self.assertTrue(locked)
+            with snapshot_lock(self.folder) as locked_again:
+                self.assertFalse(locked_again)
+            self.assertIsNone(create_snapshot(self.folder, [], test_dtypes))
+            self.assertIs(extend_snapshot(snapshot, [make_chunk(2, [2], [0.5], [1.0])]), snapshot)
+        self.assertEqual(open_snapshot(self.folder).rows, 1)
+
+        # A lock left behind by a crashed writer expires
+        lock_filepath = Path(self.folder, 'lock')
+        lock_filepath.touch()
+        os.utime(lock_filepath, (time.time() - LOCK_TIMEOUT - 1,) * 2)
+        self.assertEqual(extend_snapshot(snapshot, [make_chunk(2, [2], [0.5], [1.0])]).rows, 2)
+        self.assertFalse(lock_filepath.exists())
+
+    def test_bad_meta(self):
+        self.folder.mkdir()
+        self.assertIsNone(open_snapshot(self.folder))
+        Path(self.folder, 'meta.json').write_text('{"version": 0}')
+        self.assertIsNone(open_snapshot(self.folder))
+
+
+class SnapshotDatabaseTest(unittest.TestCase):
+    """
+    Loading fetal health data through the snapshot sees every insert, update and delete
+    """
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        db_filepath = Path(self.folder, 'test').with_suffix('.db')
+        conn = sqlite3.connect(db_filepath)
+        conn.execute('CREATE TABLE fetal_health (id INTEGER PRIMARY KEY AUTOINCREMENT, {})'.format(
+            ', '.join('{} REAL'.format(col) for col in db_cols)))
+        conn.close()
+        self.conn = start_conn(db_filepath)
+        rng = np.random.default_rng(0)
+        rows = np.column_stack([rng.integers(0, 100, (50, len(db_cols) - 1)), rng.integers(1, 4, 50)])
+        bulk_insert(self.conn, 'fetal_health', db_cols, rows.astype(np.float64).tolist())
+        Model.snapshot = None
+        load_fetal_data(self.conn)
+
+    def tearDown(self):
+        Model.snapshot = None
+        Model.last_id = 0
+        Model.row_count = None
+        close_conn(self.conn)
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def test_snapshot_written(self):
+        self.assertIsNotNone(Model.snapshot)
+        self.assertEqual(Model.snapshot.rows, 50)
+
+    def test_update(self):
+        with self.conn:
+            self.conn.execute('UPDATE fetal_health SET baseline_value = 155 WHERE id = 20')
+
+        # Already loaded data is read from the database until the snapshot is rebuilt
+        self.assertEqual(pd.concat(iter_fetal_data(self.conn)).loc[20, 'baseline_value'], 155.0)
+        load_fetal_data(self.conn)
+        self.assertIsNotNone(Model.snapshot)
+        self.assertEqual(Model.snapshot.decode('baseline_value', 19, 20)[0], 155.0)
+        self.assertEqual(pd.concat(iter_fetal_data(self.conn)).loc[20, 'baseline_value'], 155.0)
+
+    def test_delete_and_insert(self):
+        with self.conn:
+            self.conn.execute('DELETE FROM fetal_health WHERE id = 10')
+        bulk_insert(self.conn, 'fetal_health', db_cols, [[1.0] * len(db_cols)])
+        load_fetal_data(self.conn)
+        data = pd.concat(iter_fetal_data(self.conn))
+        self.assertEqual((Model.row_count, Model.snapshot.rows), (50, 50))
+        self.assertNotIn(10, data.index)
+        self.assertEqual(data.index[-1], 51)
+
+    def test_split_matches_database(self):
+        with_snapshot = split_data(self.conn)
+        model.USE_SNAPSHOT = False
+        try:
+            load_fetal_data(self.conn)
+            without_snapshot = split_data(self.conn)
+        finally:
+            model.USE_SNAPSHOT = True
+        for a, b in zip(with_snapshot, without_snapshot):
+            np.testing.assert_array_equal(a, b)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,22 +7,22 @@ Austin Wong
 # IMPORTS
 
 # Custom packages
-from dbinter import attempt_login, set_current_user
-from model import *
+# model.py (with pandas and NumPy) is imported on first use by import_model, so the login screen
+# is drawn without waiting for it
+from dbinter import attempt_login, set_current_user, snapshot_conn, close_thread_conn
+from applog import log_login, log_event, log_error
+
+# General
+import time
+import queue
+import threading
 
 # GUI
-import seaborn as sns
+# Matplotlib and seaborn are imported on first use by import_plotting
 import PySimpleGUI as sg
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-import matplotlib
-matplotlib.use("TkAgg")
 
 
 # CONSTANTS
-# Heart rate values for input validation
-MIN_HR = 0
-MAX_HR = 500
-
 # Fetal Health Status dictionary
 fhs_dict = {
     1.0: 'Normal',
@@ -40,16 +40,15 @@ fhs_color = {
     3.0: 'firebrick'
 }
 
-# Ordered column names for database features
-cols = ['baseline_value', 'accelerations', 'fetal_movement',
-        'uterine_contractions', 'light_decelerations', 'severe_decelerations',
-        'prolongued_decelerations', 'abnormal_short_term_variability',
-        'mean_value_of_short_term_variability',
-        'percentage_of_time_with_abnormal_long_term_variability',
-        'mean_value_of_long_term_variability', 'histogram_width',
-        'histogram_min', 'histogram_max', 'histogram_number_of_peaks',
-        'histogram_number_of_zeroes', 'histogram_mode', 'histogram_mean',
-        'histogram_median', 'histogram_variance', 'histogram_tendency']
+# Hyperparameter search modes offered on the training screen (see search_tasks in model.py)
+search_modes = {
+    'Full grid': 'grid',
+    'Incremental': 'incremental',
+    'Out-of-bag': 'oob'
+}
+
+# Milliseconds between checks for events from the training worker while it runs
+WORKER_POLL_MS = 100
 
 
 def controller(conn):
@@ -85,6 +84,89 @@ def controller(conn):
             break
 
 
+# LAZY IMPORT FUNCTIONS
+def import_model():
+    """
+    Imports model.py into this module (like from model import *) the first time a screen needs it
+    :return: None
+    """
+    import model
+    for name, value in vars(model).items():
+        if not name.startswith('_'):
+            globals().setdefault(name, value)
+
+
+def import_plotting():
+    """
+    Imports Matplotlib with the Tk backend and seaborn into this module the first time a screen draws graphs
+    :return: None
+    """
+    import matplotlib
+    matplotlib.use("TkAgg")
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+    from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+    globals().update(plt=plt, sns=sns, FigureCanvasTkAgg=FigureCanvasTkAgg)
+
+
+# CLASSES
+class GraphCell:
+    """
+    One cell of the dashboard grid, holding a persistent figure and canvas.
+    New graphs update the existing bars, colors, and labels in place,
+    and the canvas is only redrawn when something changed.
+    """
+
+    def __init__(self, tk_canvas):
+        """
+        :param tk_canvas: Tk canvas of the grid cell
+        """
+        self.fig, self.ax = plt.subplots()
+        self.canvas = draw_figure(tk_canvas, self.fig)
+        self.bars = None
+        self.graph = None
+
+    def show(self, graph):
+        """
+        Displays a graph, reusing the current bars when only heights, colors, or the title differ
+        :param graph: Graph dictionary (see bar_graph)
+        :return: True if the canvas was redrawn
+        """
+        if graph == self.graph:
+            return False
+
+        # Rebuild the axes only when the bar layout or axis labels change
+        layout = ('x', 'widths', 'align', 'xticks', 'xlabel', 'ylabel', 'grid')
+        if self.graph is None or any(graph[key] != self.graph[key] for key in layout):
+            self.ax.clear()
+            self.bars = self.ax.bar(graph['x'], graph['heights'], width=graph['widths'], align=graph['align'],
+                                    color=graph['colors'])
+            if graph['xticks'] is not None:
+                self.ax.set_xticks(graph['x'])
+                self.ax.set_xticklabels(graph['xticks'])
+            self.ax.grid(graph['grid'])
+            self.ax.set_xlabel(graph['xlabel'])
+            self.ax.set_ylabel(graph['ylabel'])
+        else:
+            for bar, height, color in zip(self.bars, graph['heights'], graph['colors']):
+                bar.set_height(height)
+                bar.set_color(color)
+            self.ax.relim()
+            self.ax.autoscale_view()
+
+        self.ax.set_title(graph['title'])
+        self.graph = graph
+        self.canvas.draw_idle()
+        return True
+
+    def close(self):
+        """
+        Releases the figure
+        :return: None
+        """
+        plt.close(self.fig)
+
+
 # HELPER WINDOW FUNCTIONS
 def draw_figure(canvas, figure):
     """
@@ -238,88 +320,31 @@ def create_confirmation(fetal_data):
 
 def check_inputs(window, values):
     """
-    Validate fetal health data input
+    Validate fetal health data input against the schema in model.py, highlighting fields that aren't numbers
     :param window: Window object
     :param values: Dictionary with GUI element key-value pairs
-    :return: 0 if there are no input errors, 1 if input errors were found
-    """
-
-    # Split fields into data types
-    int_values = ['baseline_value', 'abnormal_short_term_variability',
-                  'percentage_of_time_with_abnormal_long_term_variability',
-                  'histogram_width', 'histogram_min', 'histogram_max',
-                  'histogram_number_of_peaks', 'histogram_number_of_zeroes',
-                  'histogram_mode', 'histogram_median', 'histogram_variance',
-                  'histogram_mean', 'histogram_tendency'
-                  ]
-    float_values = ['accelerations', 'fetal_movement', 'uterine_contractions',
-                    'light_decelerations', 'severe_decelerations', 'prolongued_decelerations',
-                    'mean_value_of_short_term_variability', 'mean_value_of_long_term_variability',
-                    ]
-
-    # Check if inputs are correct data type
-    try:
-        for value in int_values:
-            values[value] = int(values[value])
-            window[value].update(background_color='White')
-    except ValueError:
-        for value in int_values:
-            window[value].update(background_color='Orange')
-        return 1, 'Highlighted input must be integers'
-    try:
-        for value in float_values:
-            values[value] = float(values[value])
-            window[value].update(background_color='White')
-    except ValueError:
-        for value in float_values:
-            window[value].update(background_color='Orange')
-        return 1, 'Highlighted input must be numeric.'
+    :return: 0 if there are no input errors, 1 if input errors were found,
+             message describing the first error,
+             dictionary with the input converted to numbers (None if there were errors)
+    """
+    data, errors = validate_fetal_data({col: values[col] for col in feature_cols}, feature_cols)
+    errors = errors.iloc[0]
+
+    # Highlight fields with the wrong data type
+    for col in feature_cols:
+        window[col].update(background_color='Orange' if errors[col] == TYPE_ERROR else 'White')
+    for dtype in (int, float):
+        for col in feature_cols:
+            if errors[col] == TYPE_ERROR and fetal_schema[col]['dtype'] is dtype:
+                return 1, error_message(col, TYPE_ERROR), None
 
     # Check if input is within acceptable range for each attribute
-    if not (MIN_HR <= values['baseline_value'] <= MAX_HR):
-        return 1, 'Baseline FHR must be between {} and {}'.format(MIN_HR, MAX_HR)
-    elif not (0 <= values['accelerations'] <= 1):
-        return 1, 'Accelerations must be between 0 and 1'
-    elif not (0 <= values['fetal_movement'] <= 1):
-        return 1, 'Fetal Movement must be between 0 and 1'
-    elif not (0 <= values['uterine_contractions'] <= 1):
-        return 1, 'Uterine Contractions must be between 0 and 1'
-    elif not (0 <= values['light_decelerations'] <= 1):
-        return 1, 'Light Decelerations must be between 0 and 1'
-    elif not (0 <= values['severe_decelerations'] <= 1):
-        return 1, 'Severe Decelerations must be between 0 and 1'
-    elif not (0 <= values['prolongued_decelerations'] <= 1):
-        return 1, 'Prolongued Decelerations must be between 0 and 1'
-    elif not (0 <= values['abnormal_short_term_variability'] <= 100):
-        return 1, 'Abnormal Short Term Variability must be between 0 and 100'
-    elif not (0 <= values['mean_value_of_short_term_variability'] <= 100):
-        return 1, 'Mean Value of Short Term Variability must be between 0 and 100'
-    elif not (0 <= values['percentage_of_time_with_abnormal_long_term_variability'] <= 100):
-        return 1, 'Percentage of Time with Abnormal Long Term Variability must be between 0 and 100'
-    elif not (0 <= values['mean_value_of_long_term_variability'] <= 100):
-        return 1, 'Mean Value of Long Term Variability must be between 0 and 100'
-    elif not (MIN_HR <= values['histogram_width'] <= MAX_HR):
-        return 1, 'Histogram Width must be between {} and {}'.format(MIN_HR, MAX_HR)
-    elif not (MIN_HR <= values['histogram_min'] <= MAX_HR):
-        return 1, 'Histogram Min must be between {} and {}'.format(MIN_HR, MAX_HR)
-    elif not (MIN_HR <= values['histogram_max'] <= MAX_HR):
-        return 1, 'Histogram Max must be between {} and {}'.format(MIN_HR, MAX_HR)
-    elif not (0 <= values['histogram_number_of_peaks'] <= 50):
-        return 1, 'Histogram Number of Peaks must be between 0 and 50'
-    elif not (0 <= values['histogram_number_of_zeroes'] <= 50):
-        return 1, 'Histogram Number of Zeroes must be between 0 and 50'
-    elif not (MIN_HR <= values['histogram_mode'] <= MAX_HR):
-        return 1, 'Histogram Mode must be between {} and {}'.format(MIN_HR, MAX_HR)
-    elif not (MIN_HR <= values['histogram_mean'] <= MAX_HR):
-        return 1, 'Histogram Mean must be between {} and {}'.format(MIN_HR, MAX_HR)
-    elif not (MIN_HR <= values['histogram_median'] <= MAX_HR):
-        return 1, 'Histogram Median must be between {} and {}'.format(MIN_HR, MAX_HR)
-    elif not (MIN_HR <= values['histogram_variance'] <= MAX_HR):
-        return 1, 'Histogram Variance must be between {} and {}'.format(MIN_HR, MAX_HR)
-    elif not (values['histogram_tendency'] in (-1, 0, 1)):
-        return 1, 'Histogram Tendency must be -1, 0, or 1'
-
-    return 0, 'Success'
+    for col in feature_cols:
+        if errors[col] == RANGE_ERROR:
+            return 1, error_message(col, RANGE_ERROR), None
+
+    row = {col: fetal_schema[col]['dtype'](data[col].iloc[0]) for col in feature_cols}
+    return 0, 'Success', row
 
 
 # MAIN SCREENS
@@ -351,17 +376,13 @@ def create_login(conn):
             # Successful login
             if attempt_login(values['-ID-'], values['-Password-'], conn) == 1:
 
-                # Load our data
+                # Load our data (the model is loaded when the FHS screen opens, see create_fhs)
+                import_model()
                 load_fetal_data(conn)
-                load_model()
 
                 # Update current_user, and log event to User Log
                 set_current_user(values['-ID-'])
-                dirname = Path(__file__).parent.absolute()
-                user_filepath = Path(dirname, 'user_log').with_suffix('.txt')
-                f = open(user_filepath, 'a')
-                f.write('{} logged in at {}\n'.format(values['-ID-'], datetime.datetime.now()))
-                f.close()
+                log_login(values['-ID-'])
 
                 values['-Password-'] = None
                 window.close()
@@ -416,6 +437,11 @@ def create_fhs():
     :return: event (string for what happened on the screen),
              values (dictionary with GUI element values at time of event)
     """
+    import_model()
+
+    # Pick up the prediction engine main.py started loading at launch, without waiting while the screen is drawn
+    if Model.engine is None and Model.engine_future is None:
+        load_model_async()
 
     column1 = [[sg.Text('Baseline FHR')],
                [sg.Text('Accelerations')],
@@ -498,22 +524,26 @@ def create_fhs():
         elif event == '-Calculate-':
 
             # Validate input
-            error, error_msg = check_inputs(window, values)
+            error, error_msg, new_data = check_inputs(window, values)
 
             # Input is Valid
             if error == 0:
 
                 # Put data into correct format
-                new_df = pd.DataFrame(columns=cols)
-                new_data = {}
-                for col in cols:
-                    new_data[col] = values[col]
                 set_current_patient(new_data)
-                new_df = new_df.append(new_data, ignore_index=True)
-
-                # Make Prediction
-                y_preds = get_model().predict(new_df)
+                new_df = pd.DataFrame([new_data], columns=feature_cols)
+
+                # Make Prediction, waiting for the model if it is still loading
+                if not engine_ready():
+                    window['-Error Msg-'].update(value='Loading model...', visible=True, text_color='Black')
+                    window.refresh()
+                start = time.perf_counter()
+                y_preds = predict_cached(new_df)
+                if y_preds is None:
+                    create_alert('Could not load model. Contact administrator.', 'Error', 'red')
+                    continue
                 fhs = y_preds[0]
+                log_event('predict', fhs_dict[fhs], time.perf_counter() - start)
 
                 # Display Prediction to user
                 msg = 'Predicted Fetal Health Status is ' + str(fhs_dict[fhs]).upper()
@@ -536,17 +566,13 @@ def create_fhs():
         elif event == '-Save DB-':
 
             # Validate input
-            error, error_msg = check_inputs(window, values)
+            error, error_msg, new_data = check_inputs(window, values)
 
             # Confirm user wants to save
             if error == 0:
 
                 # Save data to current_patient variable
-                new_data = {}
-                new_data_list = []
-                for col in cols:
-                    new_data[col] = values[col]
-                    new_data_list.append(values[col])
+                new_data_list = [new_data[col] for col in feature_cols]
                 set_current_patient(new_data)
 
                 # Saved Successfully to database (errors handled in create_confirmation())
@@ -566,7 +592,11 @@ def create_dashboard():
              values (dictionary with GUI element values at time of event)
     """
 
-    df = Model.fetal_data
+    import_model()
+    import_plotting()
+
+    # Read current counts and histograms from the summary tables the database maintains
+    load_aggregates()
 
     # Organize Layout into a 2x2 grid (4 total graphs)
     column1 = [[sg.Canvas(key="-CANVAS (0, 0)-")],
@@ -595,71 +625,75 @@ def create_dashboard():
     # Maximize the window for optimal viewing
     window.maximize()
 
-    # Plot initial overview graphs
-    canvases = plot_all_graphs(window, df)
+    # Create one persistent figure per grid cell and plot initial overview graphs
+    cells = [GraphCell(window[key].TKCanvas)
+             for key in ("-CANVAS (0, 0)-", "-CANVAS (0, 1)-", "-CANVAS (1, 0)-", "-CANVAS (1, 1)-")]
+    plot_all_graphs(cells)
 
     # Respond to user interaction
     while True:
         event, values = window.read()
 
         if event in ('-Cancel-', sg.WIN_CLOSED):
+            for cell in cells:
+                cell.close()
             window.close()
             return event, values
 
         # User chose new graph from ComboBox
         elif event == '-GRAPH_COMBO-':
 
-            # Clear the canvases
-            for canvas in canvases:
-                canvas.get_tk_widget().forget()
-                plt.close('all')
-
             # Display Overview Graphs
             if values['-GRAPH_COMBO-'] == 'Overview':
-                canvases = plot_all_graphs(window, df)
+                plot_all_graphs(cells)
 
             # Display Normal FHS Graphs
             elif values['-GRAPH_COMBO-'] == 'Normal Status':
-                normal_df = df[df["fetal_health"] == 1.0]
-                canvases = plot_all_graphs(window, normal_df)
+                plot_all_graphs(cells, 1.0)
 
             # Display Suspect FHS Graphs
             elif values['-GRAPH_COMBO-'] == 'Suspect Status':
-                suspect_df = df[df["fetal_health"] == 2.0]
-                canvases = plot_all_graphs(window, suspect_df)
+                plot_all_graphs(cells, 2.0)
 
             # Display Pathologic FHS Graphs
             elif values['-GRAPH_COMBO-'] == 'Pathologic Status':
-                path_df = df[df["fetal_health"] == 3.0]
-                canvases = plot_all_graphs(window, path_df)
+                plot_all_graphs(cells, 3.0)
 
             # Display Accelerations Graphs
             elif values['-GRAPH_COMBO-'] == 'Accelerations':
-                canvases = plot_all_accelerations(window)
+                plot_all_accelerations(cells)
 
             # Display Baseline FHR Graphs
             elif values['-GRAPH_COMBO-'] == 'Baseline FHR':
-                canvases = plot_all_baseline_fhr(window)
+                plot_all_baseline_fhr(cells)
 
             # Display Prolongued Decelerations Graphs
             elif values['-GRAPH_COMBO-'] == 'Prolongued Decelerations':
-                canvases = plot_all_prolongued_decelerations(window)
+                plot_all_prolongued_decelerations(cells)
 
             # Display Correlation Matrix (new window)
             elif values['-GRAPH_COMBO-'] == 'Correlation Matrix':
-                plot_correlation_matrix(df)
+                refresh_fetal_data()
+                plot_correlation_matrix()
 
 
 def create_train():
     """
-    Creates a window for retraining a machine learning model on the database data
+    Creates a window for retraining a machine learning model on the database data.
+    Training runs on a worker thread that reports progress to the window and can be stopped.
     :return: event (string for what happened on the screen),
              values (dictionary with GUI element values at time of event)
     """
-
-    column1 = [[sg.Text('Training a model may take several minutes', k='-IN PROGRESS-')],
-               [sg.Multiline('', key='-REPORT-', visible=False, size=(60, 20))],
-               [sg.B('SAVE', k='-Save Model-'), sg.B('TRAIN', k='-Train-'), sg.B('CANCEL', k='-Cancel-')]
+    import_model()
+    import_plotting()
+
+    column1 = [[sg.Text('Training a model may take several minutes', k='-IN PROGRESS-', size=(60, 1))],
+               [sg.Text('Search:'), sg.Combo(values=list(search_modes), default_value=list(search_modes)[0],
+                                             key='-MODE-', readonly=True)],
+               [sg.ProgressBar(100, orientation='h', size=(40, 20), k='-PROGRESS-', visible=False)],
+               [sg.Multiline('', key='-REPORT-', visible=False, size=(70, 30), font=('Courier', 10))],
+               [sg.B('SAVE', k='-Save Model-'), sg.B('TRAIN', k='-Train-'), sg.B('UPDATE', k='-Update-'),
+                sg.B('STOP', k='-Stop-', visible=False), sg.B('CANCEL', k='-Cancel-')]
                ]
     columns = [sg.Column(column1,
                          vertical_alignment='center',
@@ -669,24 +703,84 @@ def create_train():
                ]
     layout, window = create_window(columns, 'TRAIN MODEL')
 
+    # Train on rows saved since the data was loaded
+    refresh_fetal_data()
+
     model = None
+    worker = None
+    worker_events = queue.Queue()
+    cancel_event = threading.Event()
     while True:
-        event, values = window.read()
+        event, values = window.read(timeout=WORKER_POLL_MS if worker is not None else None)
+
+        # The worker queues its events instead of writing to the window, so it never waits on this thread
+        if event == sg.TIMEOUT_KEY:
+            latest = read_worker_event(worker_events)
+            if latest is None:
+                continue
+            event, values = latest[0], {latest[0]: latest[1]}
 
         if event in ('-Cancel-', sg.WIN_CLOSED):
+            # Stop training before leaving; the worker checks cancel_event between steps and never touches the window
+            if worker is not None:
+                cancel_event.set()
+                worker.join()
             window.close()
             return event, values
 
-        # Train button was pressed
-        elif event == '-Train-':
-            window['-IN PROGRESS-'].update(value='Training Model...')
-            model, report = train_model()
+        # Train button was pressed (or Update, which refreshes the current model with new rows instead)
+        elif event in ('-Train-', '-Update-'):
+            if worker is None:
+                model = None
+                mode = search_modes[values['-MODE-']] if event == '-Train-' else 'update'
+                cancel_event.clear()
+                window['-IN PROGRESS-'].update(value='Training Model...' if mode != 'update' else 'Updating Model...')
+                window['-REPORT-'].update(value='', visible=False)
+                window['-PROGRESS-'].update_bar(0)
+                window['-PROGRESS-'].update(visible=True)
+                window['-Train-'].update(disabled=True)
+                window['-Update-'].update(disabled=True)
+                window['-Stop-'].update(visible=True)
+                worker = threading.Thread(target=train_in_background,
+                                          args=(worker_events, mode, cancel_event),
+                                          daemon=True)
+                worker.start()
+
+        # Stop button was pressed
+        elif event == '-Stop-':
+            cancel_event.set()
+            window['-IN PROGRESS-'].update(value='Stopping...')
+
+        # Worker reported progress
+        elif event == '-Train Progress-':
+            progress = values['-Train Progress-']
+            window['-PROGRESS-'].update_bar(int(100 * progress['fraction']))
+            window['-IN PROGRESS-'].update(value=format_progress(progress))
+
+        # Worker finished (model is None if training was stopped, failed, or there was nothing to update)
+        elif event == '-Train Done-':
+            worker.join()
+            worker = None
+            model, report, failed = values['-Train Done-']
+            window['-Train-'].update(disabled=False)
+            window['-Update-'].update(disabled=False)
+            window['-Stop-'].update(visible=False)
+            window['-PROGRESS-'].update(visible=False)
 
-            # Display Report on model performance
-            report_df = pd.DataFrame(report)
-            window['-REPORT-'].update(value=str(report_df.T), visible=True)
-            window['-IN PROGRESS-'].update(value='Complete')
-            plt.show()
+            if model is not None:
+                # Display Report on model performance, and where training time and memory went
+                report_df = pd.DataFrame(report)
+                window['-REPORT-'].update(value=str(report_df.T) + '\n\n' +
+                                          format_training_profile(get_training_info(model)), visible=True)
+                window['-IN PROGRESS-'].update(value='Complete')
+                plot_model_confusion_matrix(model)
+                plt.show()
+            elif failed:
+                window['-IN PROGRESS-'].update(value='Training failed. See error log.')
+            elif cancel_event.is_set():
+                window['-IN PROGRESS-'].update(value='Training stopped')
+            else:
+                window['-IN PROGRESS-'].update(value='Model is already up to date')
 
         # Save button was pressed
         elif event == '-Save Model-':
@@ -698,209 +792,239 @@ def create_train():
             else:
                 create_alert('You must train a new model before saving', 'Error', 'black')
 
+
+def train_in_background(events, mode, cancel_event):
+    """
+    Trains or updates a model and queues progress and the result for the training window as events.
+    Never touches the window itself: Tk calls from this thread wait for the GUI thread, which may be joining it.
+    Logs error if unsuccessful.
+    :param events: queue.Queue receiving ('-Train Progress-', progress) and ('-Train Done-', result) tuples
+    :param mode: Hyperparameter search mode (see search_modes), or 'update' to refresh the current model with new rows
+    :param cancel_event: threading.Event that stops training when set
+    :return: None
+    """
+    try:
+        if mode == 'update':
+            # SQLite connections can't be shared between threads, so the worker reads from its own snapshot
+            with snapshot_conn() as conn:
+                if conn is None:
+                    raise ConnectionError('Could not connect to database')
+                model, report = update_model(conn=conn, cancel_event=cancel_event)
+        else:
+            model, report = train_model(mode=mode,
+                                        progress=lambda progress: events.put(('-Train Progress-', progress)),
+                                        cancel_event=cancel_event,
+                                        plot=False)
+        result = (model, report, False)
+    except Exception as exc:
+        log_error(exc, 'train_' + mode)
+        result = (None, None, True)
+    finally:
+        # Training reads through get_conn, which opened a connection for this thread
+        close_thread_conn()
+    events.put(('-Train Done-', result))
+
+
+def read_worker_event(events):
+    """
+    Takes every event the training worker has queued, keeping the latest: progress reports are cumulative,
+    and '-Train Done-' is always the last event a worker sends
+    :param events: queue.Queue filled by train_in_background
+    :return: Tuple of (event, value), or None if nothing was queued
+    """
+    latest = None
+    while True:
+        try:
+            latest = events.get_nowait()
+        except queue.Empty:
+            return latest
+
+
+def format_progress(progress):
+    """
+    Describes training progress for display
+    :param progress: Dictionary reported by train_model
+    :return: String
+    """
+    if 'candidates_total' not in progress or progress['phase'] != 'Tuning hyperparameters':
+        return progress['phase'] + '...'
+
+    text = '{} candidates evaluated ({}/{} folds)'.format(progress['candidates_done'], progress['folds_done'],
+                                                         progress['folds_total'])
+    if progress['best_score'] is not None:
+        text += ', best F1 {:.3f}'.format(progress['best_score'])
+    return text + ', about {:.0f}s left'.format(progress['eta'])
+
+
 # PLOT FUNCTIONS
 
 
-def plot_graphs_helper(window, fig1, fig2, fig3, fig4):
+def plot_graphs_helper(cells, graph1, graph2, graph3, graph4):
     """
-    Plots 4 figures onto canvases in a 2x2 grid
-    :param window: Window object to plot graphs on
-    :param fig1: Upper left figure
-    :param fig2: Upper right figure
-    :param fig3: Bottom left figure
-    :param fig4: Bottom right figure
-    :return: Canvas objects for each figure
+    Shows 4 graphs in the 2x2 grid, redrawing only the cells whose graph changed
+    :param cells: GraphCell objects for the upper left, upper right, bottom left, and bottom right cells
+    :param graph1: Upper left graph
+    :param graph2: Upper right graph
+    :param graph3: Bottom left graph
+    :param graph4: Bottom right graph
+    :return: Number of cells redrawn
     """
+    return sum(cell.show(graph) for cell, graph in zip(cells, (graph1, graph2, graph3, graph4)))
 
-    # Create Graphs
-    canvas1 = draw_figure(window["-CANVAS (0, 0)-"].TKCanvas, fig1)
-    canvas2 = draw_figure(window["-CANVAS (0, 1)-"].TKCanvas, fig2)
-    canvas3 = draw_figure(window["-CANVAS (1, 0)-"].TKCanvas, fig3)
-    canvas4 = draw_figure(window["-CANVAS (1, 1)-"].TKCanvas, fig4)
 
-    return canvas1, canvas2, canvas3, canvas4
+def bar_graph(x, heights, widths, colors, title, xlabel, ylabel, align='center', xticks=None, grid=False):
+    """
+    Describes a bar graph as plain values, so graphs can be compared and applied to an existing figure
+    :param x: Bar positions
+    :param heights: Bar heights
+    :param widths: Bar widths
+    :param colors: Bar colors
+    :param title: Graph title
+    :param xlabel: X-axis label
+    :param ylabel: Y-axis label
+    :param align: Bar alignment relative to x ('center' or 'edge')
+    :param xticks: Tick labels placed at each bar (None for numeric ticks)
+    :param grid: Set True to draw grid lines
+    :return: Graph dictionary
+    """
+    return {'x': list(x), 'heights': list(heights), 'widths': list(widths), 'colors': list(colors),
+            'title': title, 'xlabel': xlabel, 'ylabel': ylabel, 'align': align, 'xticks': xticks, 'grid': grid}
 
 
-def plot_fhs_overview(df):
+def plot_fhs_overview(status=None):
     """
-    Plots figure of patients split by fetal health status
-    :param df: Pandas DataFrame with fetal health data to be plotted
-    :return: Figure object
+    Builds graph of patients split by fetal health status
+    :param status: Fetal health status to highlight (None for all)
+    :return: Graph dictionary
     """
 
-    # Get all data and convert to percentages
-    all_df = Model.fetal_data
-    x = all_df["fetal_health"].value_counts(normalize=True).index.to_list()
-    y = [100 * all_df["fetal_health"].value_counts(normalize=True)[i] for i in x]
+    # Get cached counts for all data and convert to percentages, largest first
+    counts = dict(zip(fhs_values, get_aggregates().counts))
+    total = max(sum(counts.values()), 1)
+    x = sorted([i for i in counts if counts[i] > 0], key=lambda i: counts[i], reverse=True)
+    y = [100 * counts[i] / total for i in x]
 
     # Standard colors and labels
     xlabels = [fhs_dict[i] for i in x]
     xcolors = [fhs_color[i] for i in x]
-    y_pos = np.arange(len(xlabels))
+    y_pos = range(len(xlabels))
 
     # Change all but one bar color to gray if we're focusing on one
-    focal_statuses = df["fetal_health"].value_counts(normalize=True).index.to_list()
-    if len(focal_statuses) == 1:
-        xcolors = [fhs_color[i] if i == focal_statuses[0] else 'gray' for i in x]
+    if status is not None:
+        xcolors = [fhs_color[i] if i == status else 'gray' for i in x]
 
-    # Create bar graph and format
-    fig, ax = plt.subplots()
-    ax = plt.bar(y_pos, y, color=xcolors)
-    plt.xticks(y_pos, xlabels)
-    plt.ylabel('% of Patients')
-    plt.tick_params(labelbottom='off')
-    plt.title('Percent of Patients by Fetal Health Status')
+    return bar_graph(y_pos, y, [0.8] * len(y), xcolors,
+                     title='Percent of Patients by Fetal Health Status',
+                     xlabel='',
+                     ylabel='% of Patients',
+                     xticks=xlabels)
 
-    return fig
 
-
-def plot_accelerations(df):
+def plot_histogram(column, label, status=None):
     """
-    Plots Accelerations data
-    :param df: Pandas DataFrame with fetal health data to be plotted
-    :return: Figure object
+    Builds a histogram of one column from the cached dashboard aggregates
+    :param column: Column name (a key of hist_bins)
+    :param label: Name of the column shown in the title and x-axis
+    :param status: Fetal health status to plot (None for all)
+    :return: Graph dictionary
     """
 
-    fig, ax = plt.subplots()
-
-    # Determine Title and Color based on FHS
-    color = '#1f77b4'
-    statuses = df['fetal_health'].value_counts().index.to_list()
-    if len(statuses) > 1:
-        ax.set_title('Accelerations for All Statuses')
+    # Determine Title, Color, and counts based on FHS
+    bins = hist_bins[column]
+    histograms = get_aggregates().histograms[column]
+    if status is None:
+        title = label + ' for All Statuses'
+        color = '#1f77b4'
+        counts = histograms.sum(axis=0)
     else:
-        ax.set_title('Accelerations for ' + fhs_dict[statuses[0]] + ' Status')
-        color = fhs_color[statuses[0]]
+        title = label + ' for ' + fhs_dict[status] + ' Status'
+        color = fhs_color[status]
+        counts = histograms[fhs_values.index(status)]
 
-    # Standard formatting
-    ax = df['accelerations'].hist(bins=np.arange(0, 0.0105, 0.0005),
-                                  color=color)
-    ax.set_xlabel('Accelerations')
-    ax.set_ylabel('# of Patients')
+    # Standard formatting, matching DataFrame.hist
+    return bar_graph(bins[:-1].tolist(), counts.tolist(), np.diff(bins).tolist(), [color] * len(counts),
+                     title=title,
+                     xlabel=label,
+                     ylabel='# of Patients',
+                     align='edge',
+                     grid=True)
 
-    return fig
 
-
-def plot_baseline_fhr(df):
+def plot_accelerations(status=None):
     """
-    Plots Baseline Fetal Heart Rate histogram
-    :param df: Pandas DataFrame with fetal health data
-    :return: Figure object
+    Builds Accelerations histogram
+    :param status: Fetal health status to plot (None for all)
+    :return: Graph dictionary
     """
-    fig, ax = plt.subplots()
-
-    # Determine Title and Color
-    color = '#1f77b4'
-    statuses = df['fetal_health'].value_counts().index.to_list()
-    if len(statuses) > 1:
-        ax.set_title('Baseline Fetal Heart Rate for All Statuses')
-    else:
-        ax.set_title('Baseline Fetal Heart Rate for ' + fhs_dict[statuses[0]] + ' Status')
-        color = fhs_color[statuses[0]]
-
-    # Standard formatting
-    ax = df.baseline_value.hist(bins=np.arange(100, 180, 10),
-                                color=color)
-    ax.set_xlabel('Baseline Fetal Heart Rate')
-    ax.set_ylabel('# of Patients')
+    return plot_histogram('accelerations', 'Accelerations', status)
 
-    return fig
 
-
-def plot_prolongued_decelerations(df):
+def plot_baseline_fhr(status=None):
     """
-    Plots Prolongued Decelerations histogram
-    :param df: Pandas DataFrame with fetal health data
-    :return:
+    Builds Baseline Fetal Heart Rate histogram
+    :param status: Fetal health status to plot (None for all)
+    :return: Graph dictionary
     """
-    fig, ax = plt.subplots()
-
-    # Determine Title and Color
-    color = '#1f77b4'
-    statuses = df['fetal_health'].value_counts().index.to_list()
-    if len(statuses) > 1:
-        ax.set_title('Prolongued Decelerations for All Statuses')
-    else:
-        ax.set_title('Prolongued Decelerations for ' + fhs_dict[statuses[0]] + ' Status')
-        color = fhs_color[statuses[0]]
+    return plot_histogram('baseline_value', 'Baseline Fetal Heart Rate', status)
 
-    # Standard formatting
-    ax = df['prolongued_decelerations'].hist(bins=np.arange(0, 0.0065, 0.001),
-                                             color=color)
-    ax.set_xlabel('Prolongued Decelerations')
-    ax.set_ylabel('# of Patients')
 
-    return fig
+def plot_prolongued_decelerations(status=None):
+    """
+    Builds Prolongued Decelerations histogram
+    :param status: Fetal health status to plot (None for all)
+    :return: Graph dictionary
+    """
+    return plot_histogram('prolongued_decelerations', 'Prolongued Decelerations', status)
 
 
-def plot_all_accelerations(window):
+def plot_all_accelerations(cells):
     """
     Plots Accelerations graphs for each FHS category and combined
-    :param window: Window object to use for plotting
-    :return: Canvas objects with figures plotted onto each canvas
+    :param cells: GraphCell objects of the dashboard grid
+    :return: Number of cells redrawn
     """
+    return plot_graphs_helper(cells, *[plot_accelerations(status) for status in (None, 1.0, 2.0, 3.0)])
 
-    all_df = Model.fetal_data
-    fig1 = plot_accelerations(all_df)
-    fig2 = plot_accelerations(all_df[all_df['fetal_health'] == 1.0])
-    fig3 = plot_accelerations(all_df[all_df['fetal_health'] == 2.0])
-    fig4 = plot_accelerations(all_df[all_df['fetal_health'] == 3.0])
-
-    return plot_graphs_helper(window, fig1, fig2, fig3, fig4)
 
-
-def plot_all_baseline_fhr(window):
+def plot_all_baseline_fhr(cells):
     """
     Plots Baseline Fetal Heart Rate graphs for each FHS category and combined
-    :param window: Window object to use for plotting
-    :return: Canvas objects with figures plotted onto each canvas
+    :param cells: GraphCell objects of the dashboard grid
+    :return: Number of cells redrawn
     """
-    all_df = Model.fetal_data
-    fig1 = plot_baseline_fhr(all_df)
-    fig2 = plot_baseline_fhr(all_df[all_df['fetal_health'] == 1.0])
-    fig3 = plot_baseline_fhr(all_df[all_df['fetal_health'] == 2.0])
-    fig4 = plot_baseline_fhr(all_df[all_df['fetal_health'] == 3.0])
-
-    return plot_graphs_helper(window, fig1, fig2, fig3, fig4)
+    return plot_graphs_helper(cells, *[plot_baseline_fhr(status) for status in (None, 1.0, 2.0, 3.0)])
 
 
-def plot_all_prolongued_decelerations(window):
+def plot_all_prolongued_decelerations(cells):
     """
     Plots Prolongued Decelerations graphs for each FHS category and combined
-    :param window: Window object to use for plotting
-    :return: Canvas objects with figures plotted onto each canvas
+    :param cells: GraphCell objects of the dashboard grid
+    :return: Number of cells redrawn
     """
-    all_df = Model.fetal_data
-    fig1 = plot_prolongued_decelerations(all_df)
-    fig2 = plot_prolongued_decelerations(all_df[all_df['fetal_health'] == 1.0])
-    fig3 = plot_prolongued_decelerations(all_df[all_df['fetal_health'] == 2.0])
-    fig4 = plot_prolongued_decelerations(all_df[all_df['fetal_health'] == 3.0])
+    return plot_graphs_helper(cells, *[plot_prolongued_decelerations(status) for status in (None, 1.0, 2.0, 3.0)])
 
-    return plot_graphs_helper(window, fig1, fig2, fig3, fig4)
 
-
-def plot_all_graphs(window, df):
+def plot_all_graphs(cells, status=None):
     """
-    Plots all graphs (FHS, Baseline FHR, Accelerations, Prolongued Decelerations) for given dataset
-    :param window: Window object to plot graphs on
-    :param df: Pandas DataFrame with fetal health data to be plotted
-    :return: Canvas objects with figures plotted onto each canvas
+    Plots all graphs (FHS, Baseline FHR, Accelerations, Prolongued Decelerations) for given status
+    :param cells: GraphCell objects of the dashboard grid
+    :param status: Fetal health status to be plotted (None for all)
+    :return: Number of cells redrawn
     """
-    fig1 = plot_fhs_overview(df)
-    fig2 = plot_baseline_fhr(df)
-    fig3 = plot_accelerations(df)
-    fig4 = plot_prolongued_decelerations(df)
-
-    return plot_graphs_helper(window, fig1, fig2, fig3, fig4)
+    return plot_graphs_helper(cells,
+                              plot_fhs_overview(status),
+                              plot_baseline_fhr(status),
+                              plot_accelerations(status),
+                              plot_prolongued_decelerations(status))
 
 
-def plot_correlation_matrix(df):
+def plot_correlation_matrix(status=None):
     """
-    Creates a new window plotting a correlation matrix for fetal health data
-    :param df: Pandas DataFrame of fetal health data
+    Creates a new window plotting a correlation matrix for fetal health data, read from the cached aggregates
+    :param status: Fetal health status to correlate (None for all)
     :return: None
     """
-    corr_matrix = df.corr()
+    corr_matrix = get_correlation_matrix(status)
     fig, ax = plt.subplots(figsize=(20, 15))
     ax = sns.heatmap(corr_matrix,
                      annot=True,